@@ -1,7 +1,45 @@
 from django.contrib import admin
+from django.utils.decorators import method_decorator
 
-from games.models import Game 
+from games import thumbnails
+from games.models import Game
+from nat.routers import replica_reads, pin_primary
 
-"""Need to add games titles """
-admin.site.register(Game)
 
+class GameAdmin(admin.ModelAdmin):
+    '''
+        changelists read from a replica, except for an admin
+        who just saved or deleted a game (pinned to the primary
+        so the changelist shows the change)
+    '''
+    @method_decorator(replica_reads)
+    def changelist_view(self, request, extra_context=None):
+        return super(GameAdmin, self).changelist_view(request, extra_context)
+
+    # add_view and change_view save in a transaction: images go to the
+    # thumbnail pool once it has committed
+    def add_view(self, request, form_url='', extra_context=None):
+        response = super(GameAdmin, self).add_view(request, form_url, extra_context)
+        thumbnails.dispatch_deferred()
+        return response
+
+    def change_view(self, request, object_id, form_url='', extra_context=None):
+        response = super(GameAdmin, self).change_view(request, object_id, form_url, extra_context)
+        thumbnails.dispatch_deferred()
+        return response
+
+    # every admin write (add, change, list edits, delete, bulk delete) is logged
+    def log_addition(self, request, object):
+        pin_primary(request)
+        super(GameAdmin, self).log_addition(request, object)
+
+    def log_change(self, request, object, message):
+        pin_primary(request)
+        super(GameAdmin, self).log_change(request, object, message)
+
+    def log_deletion(self, request, object, object_repr):
+        pin_primary(request)
+        super(GameAdmin, self).log_deletion(request, object, object_repr)
+
+"""Need to add games titles """
+admin.site.register(Game, GameAdmin)
@@ -0,0 +1,98 @@
+"""
+    JSON API for dashboards and bots
+
+    every response carries a strong ETag built from the data versions
+    it depends on (games.versions, and the voting week for the
+    leaderboard), so a poll that sends the ETag back in If-None-Match
+    gets a 304 after one cache read, before the view or the database
+    is touched.  Those stamps mean the same thing in every worker only
+    with a shared cache; with a per-process one the ETag is a hash of
+    the body instead, which costs the view but is never stale.
+"""
+import hashlib
+import json
+from functools import wraps
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, HttpResponseNotModified, Http404
+from django.utils.http import parse_etags, quote_etag
+from django.views.decorators.http import condition, require_safe
+
+from games import versions
+from games.models import Game, Vote, LeaderboardEntry, voting_week
+
+
+def _etag(*names):
+    def etag(request, *args, **kwargs):
+        return '-'.join('%s%s' % (name[0], versions.get(name)) for name in names)
+    return etag
+
+
+def _weekly_etag(*names):
+    ''' _etag plus the voting week, so a new week never matches last week's body '''
+    versioned = _etag(*names)
+    def etag(request, *args, **kwargs):
+        return 'w%s-%s' % (voting_week().strftime('%Y%m%d'), versioned(request, *args, **kwargs))
+    return etag
+
+
+def _conditional(etag_func):
+    ''' condition(etag_func) when stamps are shared, else an ETag hashed from the body '''
+    def decorator(view):
+        versioned = condition(etag_func=etag_func)(view)
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            if versions.shared():
+                return versioned(request, *args, **kwargs)
+            response = view(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            etag = hashlib.sha1(response.content).hexdigest()
+            if etag in parse_etags(request.META.get('HTTP_IF_NONE_MATCH', '')):
+                response = HttpResponseNotModified()
+            response['ETag'] = quote_etag(etag)
+            return response
+        return wrapped
+    return decorator
+
+
+def _json(data):
+    return HttpResponse(json.dumps(data, cls=DjangoJSONEncoder),
+        content_type='application/json')
+
+
+@require_safe
+@_conditional(_weekly_etag(versions.CATALOG, versions.VOTES))
+def leaderboard(request):
+    ''' this week's most voted games; ?owned=0 or 1 to filter '''
+    owned = request.GET.get('owned')
+    if owned not in (None, '0', '1'):
+        raise Http404
+    week = voting_week()
+    entries = LeaderboardEntry.top(week, owned=None if owned is None else owned == '1')
+    return _json({
+        'week': week,
+        'games': [{'id': e.game_id, 'title': e.game.title, 'owned': e.owned,
+                   'votes': e.votes} for e in entries],
+    })
+
+
+@require_safe
+@_conditional(_etag(versions.CATALOG))
+def game_list(request):
+    ''' every game, alphabetically '''
+    return _json({'games': [{'id': pk, 'title': title, 'owned': owned, 'added': created}
+        for pk, title, owned, created in Game.objects.order_by('title').values_list(
+            'id', 'title', 'owned', 'created')]})
+
+
+@require_safe
+@_conditional(_etag(versions.CATALOG, versions.VOTES))
+def game_votes(request, game_id):
+    ''' all time votes for one game '''
+    try:
+        title, owned = Game.objects.values_list('title', 'owned').get(pk=game_id)
+    except Game.DoesNotExist:
+        raise Http404
+    return _json({'id': int(game_id), 'title': title, 'owned': owned,
+        'votes': Vote.counts([game_id]).get(int(game_id), 0)})
@@ -0,0 +1,155 @@
+"""
+    Per-view benchmarks
+
+    generate() fills the current database with a synthetic dataset:
+    game popularity and user activity both follow a Zipf-like skew,
+    so a few games get most votes and a few users vote most days.
+    bench() times each view against it and reports latency percentiles,
+    queries per request and peak RSS growth.
+    manage.py bench_views runs both against a throwaway test database.
+"""
+import bisect
+import random
+import resource
+import time
+from datetime import datetime, timedelta
+from itertools import count
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import Client
+from django.test.client import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from games import fuzzy, versions, views
+from games.models import Game, Vote, UserActivityLog, TitleTrigram, TIMEZONE, normalize_title
+
+BATCH = 5000
+
+
+class Zipf(object):
+    ''' draws indexes 0..n-1, index i weighted 1 / (i + 1) ** s '''
+    def __init__(self, n, s=1.1, rng=random):
+        total, self.cumulative = 0.0, []
+        for i in range(n):
+            total += 1.0 / (i + 1) ** s
+            self.cumulative.append(total)
+        self.total = total
+        self.rng = rng
+
+    def draw(self):
+        return bisect.bisect(self.cumulative, self.rng.random() * self.total)
+
+
+def generate(users, games, activity, days=365, seed=0, stdout=None):
+    ''' N users, M games (10% owned), K skewed vote/add rows over @days '''
+    rng = random.Random(seed)
+    tag = 'bench%d' % seed
+    with transaction.atomic():
+        User.objects.bulk_create([User(username='%s_%d' % (tag, i)) for i in range(users)])
+        user_ids = list(User.objects.filter(
+            username__startswith=tag + '_').order_by('id').values_list('id', flat=True))
+        now = datetime.now(tz=TIMEZONE)
+        titles = ['%s title %d' % (tag, i) for i in range(games)]
+        for start in range(0, games, BATCH):
+            chunk = [Game(title=t, title_key=normalize_title(t), owned=rng.random() < 0.1,
+                          user_id=rng.choice(user_ids), created=now)
+                     for t in titles[start:start + BATCH]]
+            Game.objects.bulk_create(chunk)
+        game_ids = list(Game.objects.filter(
+            title__startswith=tag + ' ').order_by('id').values_list('id', flat=True))
+        Vote.objects.bulk_create([Vote(game_id=pk, created=now) for pk in game_ids])
+        grams = []
+        for pk, title in zip(game_ids, titles):
+            grams.extend(TitleTrigram(gram=g, game_id=pk) for g in fuzzy.trigrams(title))
+        TitleTrigram.objects.bulk_create(grams)
+
+        popular, busy = Zipf(len(game_ids), rng=rng), Zipf(len(user_ids), rng=rng)
+        tally = {}
+        rows = []
+        for i in range(activity):
+            game_id = game_ids[popular.draw()]
+            action = 'voted' if rng.random() < 0.95 else 'added'
+            if action == 'voted':
+                tally[game_id] = tally.get(game_id, 0) + 1
+            rows.append(UserActivityLog(user_id=user_ids[busy.draw()], game_id=game_id,
+                action=action, created=now - timedelta(seconds=rng.randint(0, days * 86400))))
+            if len(rows) >= BATCH:
+                UserActivityLog.objects.bulk_create(rows)
+                rows = []
+        UserActivityLog.objects.bulk_create(rows)
+        for game_id, votes in tally.items():
+            Vote.objects.filter(game_id=game_id).update(settled=votes)
+    versions.bump(versions.CATALOG)
+    call_command('rebuild_leaderboard', stdout=stdout)
+    call_command('rebuild_vote_rollups', stdout=stdout)
+    return user_ids, game_ids
+
+
+def percentile(values, pct):
+    ''' nearest-rank percentile of @values '''
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    rank = max(int(round(pct / 100.0 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def _peak_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def measure(call, iterations):
+    ''' run @call @iterations times: latency ms, queries, rss growth '''
+    latencies, queries = [], []
+    rss = _peak_rss_kb()
+    for i in range(iterations):
+        with CaptureQueriesContext(connection) as captured:
+            started = time.time()
+            response = call(i)
+            if hasattr(response, 'render') and not getattr(response, 'is_rendered', True):
+                response.render()
+            latencies.append((time.time() - started) * 1000)
+        queries.append(len(captured))
+    return {
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+        'queries': float(sum(queries)) / len(queries),
+        'peak_rss_growth_kb': _peak_rss_kb() - rss,
+        'status': getattr(response, 'status_code', None),
+    }
+
+
+def bench(iterations, user_ids, game_ids):
+    ''' {view name : measurements} for the games views '''
+    client = Client()
+    factory = RequestFactory()
+    heavy = User.objects.get(id=user_ids[0])
+    serial = count()
+
+    def voter():
+        # a user with no history, so the eligibility rules let the vote through
+        return User.objects.create(username='bench_voter_%d_%d' % (time.time(), next(serial)))
+
+    def as_user(request, user):
+        request.user = user
+        return request
+
+    voters = [voter() for i in range(iterations * 2)]
+    unowned = list(Game.objects.filter(id__in=game_ids[:100], owned=False).values_list('id', flat=True))
+
+    cases = [
+        ('games', lambda i: client.get('/games/games/')),
+        ('vote_index', lambda i: client.get('/games/vote_index/')),
+        ('top_votes', lambda i: client.get('/games/top_votes/')),
+        ('AllVotes', lambda i: client.get('/games/all_votes/')),
+        ('my_votes', lambda i: views.my_votes(as_user(factory.get('/games/my_votes/'), heavy))),
+        ('game_vote', lambda i: views.game_vote(as_user(
+            factory.get('/games/vote/game_id/%d/' % unowned[i % len(unowned)]), voters[i]),
+            game_id=unowned[i % len(unowned)])),
+        ('game_add', lambda i: views.game_add(as_user(factory.post('/games/add/',
+            {'title': 'benchmark addition %d %d' % (time.time(), i)}), voters[iterations + i]))),
+    ]
+    return dict((name, measure(call, iterations)) for name, call in cases)
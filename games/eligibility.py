@@ -0,0 +1,158 @@
+"""
+    Vote / add eligibility
+
+    each user's last action time lives in a SQLite file
+    (settings.ELIGIBILITY_STORE_PATH) shared by every worker, so
+    can_act is a single local lookup against precomputed day
+    boundaries.  Users missing from the store are looked up in
+    the activity log once and cached; the activity log stays the
+    source of truth (manage.py rebuild_eligibility).
+"""
+import time
+from datetime import datetime, timedelta, time as day_start
+
+import pytz
+from django.conf import settings
+
+from games.localdb import LocalDB, to_epoch
+
+# stored for users with no activity, so they are not looked up again
+NEVER = 0.0
+
+
+class Day(object):
+    ''' today's local midnight-to-midnight window, as epoch seconds '''
+    def __init__(self, now):
+        tz = pytz.timezone(settings.TIME_ZONE)
+        today = datetime.fromtimestamp(now, tz=tz).date()
+        self.start = to_epoch(tz.localize(datetime.combine(today, day_start())))
+        self.end = to_epoch(tz.localize(
+            datetime.combine(today + timedelta(days=1), day_start())))
+        self.weekend = today.weekday() >= 5
+
+    def __contains__(self, seconds):
+        return self.start <= seconds < self.end
+
+_day = None
+
+def today(now=None):
+    ''' the Day containing @now, recomputed only when midnight passes '''
+    global _day
+    if now is None:
+        now = time.time()
+    if _day is None or now not in _day:
+        _day = Day(now)
+    return _day
+
+
+class EligibilityStore(LocalDB):
+    ''' username -> epoch seconds of the latest vote or add '''
+    schema = (
+        "CREATE TABLE IF NOT EXISTS last_action ("
+        "username TEXT PRIMARY KEY, acted REAL NOT NULL)",
+    )
+
+    def get(self, username):
+        row = self.db.execute("SELECT acted FROM last_action WHERE username = ?",
+            (username,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, username, acted):
+        ''' keep the later of the stored and the new time '''
+        self.db.execute("INSERT OR IGNORE INTO last_action (username, acted) "
+            "VALUES (?, ?)", (username, acted))
+        self.db.execute("UPDATE last_action SET acted = ? "
+            "WHERE username = ? AND acted < ?", (acted, username, acted))
+
+    def get_many(self, usernames):
+        ''' {username : acted} for the users present in the store '''
+        found = {}
+        usernames = list(usernames)
+        # stay under SQLite's 999 bound parameters
+        for i in range(0, len(usernames), 500):
+            chunk = usernames[i:i + 500]
+            found.update(self.db.execute(
+                "SELECT username, acted FROM last_action WHERE username IN (%s)"
+                % ", ".join("?" * len(chunk)), chunk).fetchall())
+        return found
+
+    def clear(self):
+        self.db.execute("DELETE FROM last_action")
+
+
+_store = None
+
+def get_store():
+    global _store
+    path = getattr(settings, 'ELIGIBILITY_STORE_PATH', 'eligibility.sqlite3')
+    if _store is None or _store.path != path:
+        _store = EligibilityStore(path)
+    return _store
+
+
+def last_action(username):
+    ''' epoch seconds of the user's last action, NEVER if none '''
+    store = get_store()
+    acted = store.get(username)
+    if acted is None:
+        # cold store: fall back to the activity log once
+        from games.models import UserActivityLog
+        last = UserActivityLog.last_acted(username)
+        acted = to_epoch(last) if last is not None else NEVER
+        store.put(username, acted)
+    return acted
+
+
+def last_actions(usernames):
+    ''' last_action for many users: one store read, one log query per 500 misses '''
+    store = get_store()
+    acted = store.get_many(usernames)
+    missing = [name for name in set(usernames) if name not in acted]
+    if missing:
+        from django.db.models import Max
+        from games.models import UserActivityLog
+        for i in range(0, len(missing), 500):
+            for name, last in UserActivityLog.objects.filter(
+                    user__username__in=missing[i:i + 500]).values_list(
+                    'user__username').annotate(Max('created')).order_by():
+                acted[name] = to_epoch(last)
+        for name in missing:
+            acted.setdefault(name, NEVER)
+            store.put(name, acted[name])
+    return acted
+
+
+def allowed(acted, day):
+    '''
+        once a day, and not on weekends;
+        users with no history may always act
+    '''
+    if acted == NEVER:
+        return True
+    if acted in day:
+        return False
+    return not day.weekend
+
+
+def can_act(username):
+    ''' may this user vote or add right now '''
+    return allowed(last_action(username), today())
+
+
+def can_act_many(usernames):
+    ''' {username : may act right now} '''
+    day = today()
+    return dict((name, allowed(acted, day))
+        for name, acted in last_actions(usernames).items())
+
+
+def record(username, when):
+    ''' write-through after a vote or add '''
+    get_store().put(username, to_epoch(when))
+
+
+def reset():
+    ''' forget everything; the store refills from the activity log '''
+    global _day
+    _day = None
+    get_store().clear()
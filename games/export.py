@@ -0,0 +1,84 @@
+"""
+    Streaming export of the activity log
+
+    rows are read in id order, CHUNK_SIZE at a time (WHERE id > last
+    LIMIT n) as plain tuples, and written out line by line, so memory
+    stays flat however many rows the export covers.
+"""
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from games.models import TIMEZONE, UserActivityLog
+
+CHUNK_SIZE = 2000
+
+COLUMNS = ('id', 'created', 'action', 'user_id', 'username', 'game_id', 'title')
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+}
+
+
+def parse_filters(date_from=None, date_to=None, action=None):
+    '''
+        YYYY-MM-DD strings (both days inclusive, local time) and an
+        action name -> queryset filter kwargs; ValueError on bad dates
+    '''
+    filters = {}
+    if date_from:
+        day = datetime.strptime(date_from, '%Y-%m-%d').date()
+        filters['created__gte'] = TIMEZONE.localize(datetime.combine(day, time()))
+    if date_to:
+        day = datetime.strptime(date_to, '%Y-%m-%d').date() + timedelta(days=1)
+        filters['created__lt'] = TIMEZONE.localize(datetime.combine(day, time()))
+    if action:
+        filters['action'] = action
+    return filters
+
+
+def activity_rows(chunk_size=CHUNK_SIZE, **filters):
+    ''' yield COLUMNS tuples for matching activity, one chunk in memory at a time '''
+    qs = UserActivityLog.objects.filter(**filters).order_by('id').values_list(
+        'id', 'created', 'action', 'user_id', 'user__username', 'game_id', 'game__title')
+    last = 0
+    while True:
+        chunk = list(qs.filter(id__gt=last)[:chunk_size])
+        for row in chunk:
+            yield row
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1][0]
+
+
+class _Line(object):
+    ''' file-like that hands back what csv.writer writes '''
+    def write(self, value):
+        return value
+
+
+def csv_lines(rows):
+    writer = csv.writer(_Line())
+    yield writer.writerow(COLUMNS)
+    for row in rows:
+        yield writer.writerow([_text(value) for value in row])
+
+
+def ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(dict(zip(COLUMNS, [_text(value) for value in row]))) + '\n'
+
+
+def lines(fmt, rows):
+    if fmt == 'csv':
+        return csv_lines(rows)
+    return ndjson_lines(rows)
+
+
+def _text(value):
+    if isinstance(value, datetime):
+        return value.astimezone(TIMEZONE).isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
@@ -1,27 +1,130 @@
 """ game vote form """
 from django import forms
-from games.models import Game
+from django.conf import settings
+from django.core.cache import cache
+from django.forms.util import flatatt
+from django.utils.encoding import force_text
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
+
+from games import versions
+from games.models import Game, Rating
 
 class GameAddForm(forms.Form):
     """ view.game_add: 
         simple text widget form 
+        confirmed: the user saw the similar titles and still wants a new game
     """
     title = forms.CharField(max_length=100)
+    confirmed = forms.BooleanField(required=False, widget=forms.HiddenInput)
+
+class GameChoice(object):
+    """ the id and title of a votable game, no database row attached """
+    __slots__ = ('id', 'title')
+
+    def __init__(self, id, title):
+        self.id = id
+        self.title = title
+
+    def __unicode__(self):
+        return self.title
+
+    def __str__(self):
+        return self.title.encode('utf-8')
+
+
+class GameChoices(object):
+    """ games not owned, as an id set and pre-rendered <option> html
+        cached per catalog version (bumped on game add, save, delete)
+    """
+    def __init__(self, version):
+        self.version = version
+        rows = list(Game.objects.filter(owned=False).order_by(
+            'title').values_list('id', 'title'))
+        self.titles = dict(rows)
+        self.html = u''.join(format_html(u'<option value="{0}">{1}</option>', pk, title)
+            for pk, title in rows)
+
+    _current = None
+
+    @classmethod
+    def get(cls):
+        version = versions.get(versions.CATALOG)
+        if cls._current is not None and cls._current.version == version:
+            return cls._current
+        key = 'games.vote_choices.%s' % version
+        choices = cache.get(key)
+        if choices is None:
+            choices = cls(version)
+            cache.set(key, choices, getattr(settings, 'VOTE_CHOICES_CACHE_TIMEOUT', 3600))
+        cls._current = choices
+        return choices
+
+
+class GameSelect(forms.Widget):
+    """ <select> around the cached option html """
+    def render(self, name, value, attrs=None):
+        html = GameChoices.get().html
+        if value:
+            pk = value.id if isinstance(value, GameChoice) else value
+            selected = u'value="%s"' % force_text(pk)
+            html = html.replace(selected + u'>', selected + u' selected="selected">', 1)
+        final_attrs = self.build_attrs(attrs, name=name)
+        return format_html(u'<select{0}>', flatatt(final_attrs)) + \
+            mark_safe(u'<option value="">---------</option>' + html + u'</select>')
+
+
+class GameChoiceField(forms.Field):
+    """ validates a posted game id against the cached choices, no query;
+        an id the cached choices lack (added since they were built)
+        is checked against the database once before it is refused
+    """
+    widget = GameSelect
+    default_error_messages = {
+        'invalid_choice': u'Select a valid choice. That choice is not one of the available choices.',
+    }
+
+    def to_python(self, value):
+        if value in self.empty_values:
+            return None
+        choices = GameChoices.get()
+        try:
+            pk = int(value)
+        except (TypeError, ValueError):
+            pk = None
+        title = choices.titles.get(pk)
+        if title is None and pk is not None:
+            title = Game.objects.filter(pk=pk, owned=False).values_list(
+                'title', flat=True).first()
+        if title is None:
+            raise forms.ValidationError(self.error_messages['invalid_choice'],
+                code='invalid_choice')
+        return GameChoice(pk, title)
+
 
 class GameVoteForm(forms.Form):
     """ views.game_vote:
         dropdown widget
         only show games not owned
     """
-    title = forms.ModelChoiceField(
-        queryset=Game.objects.filter(owned=False).order_by('title')
-        )
+    title = GameChoiceField()
+
+class RatingForm(forms.Form):
+    """ views.rate_game: one to five stars """
+    stars = forms.TypedChoiceField(choices=Rating.RATING_STARS, coerce=int)
 
 class VoteCountForm(forms.Form):
     """
         Get top voted games
         in a time period
     """
-    from_t = forms.DateTimeInput()
-    to_t = forms.DateTimeInput()
+    from_t = forms.DateTimeField()
+    to_t = forms.DateTimeField()
+
+    def clean(self):
+        cleaned_data = super(VoteCountForm, self).clean()
+        from_t, to_t = cleaned_data.get('from_t'), cleaned_data.get('to_t')
+        if from_t and to_t and from_t >= to_t:
+            raise forms.ValidationError("from_t must be before to_t")
+        return cleaned_data
 
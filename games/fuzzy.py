@@ -0,0 +1,160 @@
+"""
+    Fuzzy title matching for duplicate detection
+
+    titles are split into pg_trgm style character trigrams; similarity
+    is shared trigrams / all trigrams of the two titles (0..1).
+    The postings live in title_trigrams and, per process, in memory;
+    the in-memory copy reloads when the catalog version changes.
+    With PostgreSQL and the pg_trgm extension the database does the
+    matching instead (settings.FUZZY_BACKEND = 'auto').
+"""
+import re
+import threading
+from collections import defaultdict, namedtuple
+
+from django.conf import settings
+from django.db import connection
+
+from games import versions
+from games.models import Game, TitleTrigram
+
+Match = namedtuple('Match', 'id title owned similarity')
+
+_words = re.compile(r'\w+', re.UNICODE)
+
+
+def trigrams(title):
+    ''' set of trigrams, each word padded like pg_trgm does '''
+    grams = set()
+    for word in _words.findall(title.lower()):
+        padded = '  %s ' % word
+        for i in range(len(padded) - 2):
+            grams.add(padded[i:i + 3])
+    return grams
+
+
+class TrigramIndex(object):
+    ''' in-memory postings: trigram -> game ids '''
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.grams = {}
+        self.games = {}
+        self.version = None
+        self.lock = threading.Lock()
+
+    def load(self, version):
+        postings = defaultdict(set)
+        grams = defaultdict(set)
+        for gram, game_id in TitleTrigram.objects.values_list('gram', 'game_id').iterator():
+            postings[gram].add(game_id)
+            grams[game_id].add(gram)
+        games = dict((pk, (title, owned)) for pk, title, owned in
+            Game.objects.values_list('id', 'title', 'owned').iterator())
+        with self.lock:
+            self.postings, self.grams, self.games = postings, dict(grams), games
+            self.version = version
+
+    def add(self, game, grams):
+        with self.lock:
+            self.discard(game.pk)
+            for gram in grams:
+                self.postings[gram].add(game.pk)
+            self.grams[game.pk] = grams
+            self.games[game.pk] = (game.title, game.owned)
+
+    def remove(self, pk):
+        with self.lock:
+            self.discard(pk)
+
+    def discard(self, pk):
+        ''' drop @pk's postings; the caller holds the lock '''
+        for gram in self.grams.pop(pk, ()):
+            self.postings[gram].discard(pk)
+        self.games.pop(pk, None)
+
+    def search(self, title, limit, threshold):
+        query = trigrams(title)
+        if not query:
+            return []
+        shared = defaultdict(int)
+        matches = []
+        # add / load replace entries under the lock: a reader without it
+        # could see a posting whose game's grams are already gone
+        with self.lock:
+            for gram in query:
+                for pk in self.postings.get(gram, ()):
+                    shared[pk] += 1
+            for pk, common in shared.items():
+                score = float(common) / (len(query) + len(self.grams[pk]) - common)
+                if score >= threshold:
+                    title, owned = self.games[pk]
+                    matches.append(Match(pk, title, owned, score))
+        matches.sort(key=lambda m: (-m.similarity, m.title))
+        return matches[:limit]
+
+
+_index = TrigramIndex()
+
+def memory_index():
+    ''' this process' index, reloaded if another process changed the catalog '''
+    version = versions.get(versions.CATALOG)
+    if _index.version != version:
+        _index.load(version)
+    return _index
+
+
+_pg_trgm = None
+
+def use_postgres():
+    global _pg_trgm
+    backend = getattr(settings, 'FUZZY_BACKEND', 'auto')
+    if backend == 'memory' or connection.vendor != 'postgresql':
+        return False
+    if _pg_trgm is None:
+        cursor = connection.cursor()
+        cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+        _pg_trgm = cursor.fetchone() is not None
+    return _pg_trgm
+
+
+def _search_postgres(title, limit, threshold):
+    cursor = connection.cursor()
+    cursor.execute("SELECT id, title, owned, similarity(title, %s) AS sim "
+        "FROM games WHERE title %% %s AND similarity(title, %s) >= %s "
+        "ORDER BY sim DESC, title LIMIT %s", [title, title, title, threshold, limit])
+    return [Match(*row) for row in cursor.fetchall()]
+
+
+def similar(title, limit=5, threshold=None):
+    ''' games whose titles look like @title, best match first '''
+    if threshold is None:
+        threshold = getattr(settings, 'FUZZY_MATCH_THRESHOLD', 0.6)
+    if use_postgres():
+        return _search_postgres(title, limit, threshold)
+    return memory_index().search(title, limit, threshold)
+
+
+def index_game(game):
+    ''' replace the stored trigrams for @game '''
+    grams = trigrams(game.title)
+    TitleTrigram.objects.filter(game=game).delete()
+    TitleTrigram.objects.bulk_create(
+        [TitleTrigram(gram=gram, game=game) for gram in grams])
+    return grams
+
+
+def _catalog_changed(update):
+    ''' bump the catalog version, keep our own index if it was current '''
+    current = _index.version
+    version = versions.bump(versions.CATALOG)
+    if current is not None and version == current + 1:
+        update()
+        _index.version = version
+
+
+def game_saved(game):
+    grams = index_game(game)
+    _catalog_changed(lambda: _index.add(game, grams))
+
+def game_deleted(game):
+    _catalog_changed(lambda: _index.remove(game.pk))
@@ -0,0 +1,262 @@
+"""
+    Write-behind vote ingestion
+
+    with settings.VOTE_INGEST = 'buffered' the vote views append
+    (username, action, game id, time) to a local SQLite queue and
+    return; a flusher thread applies queued votes to the database
+    in batches of VOTE_QUEUE_FLUSH_SIZE every VOTE_QUEUE_FLUSH_INTERVAL
+    seconds.  Rows leave the queue only after their batch commits, so
+    votes queued before a crash are applied by the next flusher
+    (or manage.py flush_votes).  Delivery is at-least-once: a crash
+    between the database commit and the queue delete replays that batch,
+    so each batch records its newest queue row id (IngestMark) in the
+    vote transaction and rows at or below it are skipped on replay.
+"""
+import logging
+import threading
+import uuid
+from collections import defaultdict
+from datetime import datetime
+
+import pytz
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+from games import eligibility, tally, versions
+from games.localdb import LocalDB, to_epoch, from_epoch
+from games.models import Game, Vote, UserActivityLog, VoteDelta, IngestMark
+
+_log = logging.getLogger(__name__)
+
+
+def buffered():
+    ''' are votes going through the queue '''
+    return getattr(settings, 'VOTE_INGEST', 'sync') == 'buffered'
+
+
+class VoteQueue(LocalDB):
+    ''' durable FIFO of pending votes in a SQLite file '''
+    schema = (
+        "CREATE TABLE IF NOT EXISTS queue ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "username TEXT NOT NULL, action TEXT NOT NULL, "
+        "game_id INTEGER NOT NULL, created REAL NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)",
+    )
+
+    @property
+    def ident(self):
+        ''' random id of this queue file, made on first use '''
+        self.db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('ident', ?)",
+            (uuid.uuid4().hex,))
+        return self.db.execute("SELECT value FROM meta WHERE key = 'ident'").fetchone()[0]
+
+    def append(self, username, action, game_id, created):
+        self.db.execute("INSERT INTO queue (username, action, game_id, created) "
+            "VALUES (?, ?, ?, ?)", (username, action, game_id, to_epoch(created)))
+
+    def __len__(self):
+        return self.db.execute("SELECT COUNT(*) FROM queue").fetchone()[0]
+
+    def pending_for_game(self, game_id):
+        return self.db.execute("SELECT COUNT(*) FROM queue "
+            "WHERE game_id = ? AND action = 'voted'", (game_id,)).fetchone()[0]
+
+    def last_pending(self, username):
+        ''' local time of the user's newest queued action, or None '''
+        row = self.db.execute("SELECT MAX(created) FROM queue WHERE username = ?",
+            (username,)).fetchone()
+        if row[0] is None:
+            return None
+        return from_epoch(row[0])
+
+    def drain(self, apply, limit):
+        '''
+            hand this queue's id and up to @limit queued
+            (row id, username, action, game id, created) rows to @apply,
+            delete them once it returns
+            BEGIN IMMEDIATE keeps two flushers off the same rows
+        '''
+        ident = self.ident
+        db = self.db
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            rows = db.execute("SELECT id, username, action, game_id, created "
+                "FROM queue ORDER BY id LIMIT ?", (limit,)).fetchall()
+            if rows:
+                apply(ident, [(i, u, a, g, from_epoch(c)) for i, u, a, g, c in rows])
+                db.execute("DELETE FROM queue WHERE id <= ?", (rows[-1][0],))
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+        return len(rows)
+
+
+def _lookup(usernames, game_ids):
+    users = {}
+    usernames = list(set(usernames))
+    for i in range(0, len(usernames), 500):
+        users.update((u.username, u) for u in
+            User.objects.filter(username__in=usernames[i:i + 500]))
+    return users, Game.objects.in_bulk(set(game_ids))
+
+
+def _apply(actions, mark=None):
+    '''
+        write (user, action, game, created) actions in one transaction:
+        one shard update per game, bulk inserts into the activity log
+        and the pending vote deltas (games.tally folds those into the
+        leaderboard), and the (queue, last row id) @mark if they came
+        from a queue
+    '''
+    votes = defaultdict(int)
+    for user, action, game, created in actions:
+        if action == 'voted':
+            votes[game.id] += 1
+    with transaction.atomic():
+        for vote in Vote.objects.filter(game__in=votes.keys()):
+            vote.add(votes[vote.game_id])
+        VoteDelta.objects.bulk_create([VoteDelta(game_id=game_id, votes=n)
+            for game_id, n in votes.items()])
+        UserActivityLog.log_user_actions(actions)
+        if mark is not None:
+            IngestMark.advance(*mark)
+    if votes:
+        # readers that saw a bump inside the transaction may have cached old rows
+        versions.bump(versions.VOTES)
+        tally.settle()
+
+
+def apply_votes(queue, entries):
+    '''
+        apply (row id, username, action, game id, created) entries
+        from the queue with id @queue, skipping rows an earlier,
+        unacknowledged flush already applied
+    '''
+    applied = IngestMark.applied(queue)
+    replayed = [e for e in entries if e[0] <= applied]
+    if replayed:
+        _log.warning("skipping %d queued rows already applied from %s", len(replayed), queue)
+    entries = [e for e in entries if e[0] > applied]
+    if not entries:
+        return
+    users, games = _lookup([e[1] for e in entries], [e[3] for e in entries])
+    actions = []
+    for row_id, username, action, game_id, created in entries:
+        if username not in users or game_id not in games:
+            _log.error("dropping queued %s by %s for game %s", action, username, game_id)
+            continue
+        actions.append((users[username], action, games[game_id], created))
+    _apply(actions, (queue, entries[-1][0]))
+
+
+def vote_batch(pairs):
+    '''
+        votes on behalf of many users: [(username, game id)] ->
+        [status] in the same order, one of counted, unknown_user,
+        unknown_game, owned, too_soon, duplicate (the user already
+        has a vote earlier in this batch).  Eligibility is checked for
+        everyone at once and the counted votes commit together.
+    '''
+    users, games = _lookup([p[0] for p in pairs], [p[1] for p in pairs])
+    eligible = eligibility.can_act_many(users.keys())
+    now = datetime.now(tz=pytz.utc)
+    seen = set()
+    statuses, actions = [], []
+    for username, game_id in pairs:
+        if username not in users:
+            status = 'unknown_user'
+        elif game_id not in games:
+            status = 'unknown_game'
+        elif games[game_id].owned:
+            status = 'owned'
+        elif username in seen:
+            status = 'duplicate'
+        elif not eligible[username]:
+            status = 'too_soon'
+        else:
+            status = 'counted'
+            seen.add(username)
+            actions.append((users[username], 'voted', games[game_id], now))
+        statuses.append(status)
+    if actions:
+        _apply(actions)
+    return statuses
+
+
+def flush(limit=None):
+    ''' apply everything queued right now, return the number of rows '''
+    if limit is None:
+        limit = getattr(settings, 'VOTE_QUEUE_FLUSH_SIZE', 200)
+    total = 0
+    while True:
+        applied = get_queue().drain(apply_votes, limit)
+        total += applied
+        if applied < limit:
+            return total
+
+
+class Flusher(threading.Thread):
+    ''' background thread that flushes the queue every interval '''
+    daemon = True
+
+    def __init__(self, interval):
+        super(Flusher, self).__init__(name='vote-flusher')
+        self.interval = interval
+        self.wake = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                flush()
+            except Exception:
+                _log.exception("vote flush failed, retrying next interval")
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+
+_queue = None
+_flusher = None
+_lock = threading.Lock()
+
+def get_queue():
+    global _queue
+    path = getattr(settings, 'VOTE_QUEUE_PATH', 'vote_queue.sqlite3')
+    if _queue is None or _queue.path != path:
+        _queue = VoteQueue(path)
+    return _queue
+
+def _ensure_flusher():
+    ''' start (or restart after a fork) this process' flusher '''
+    global _flusher
+    interval = getattr(settings, 'VOTE_QUEUE_FLUSH_INTERVAL', 2.0)
+    if not interval:
+        return None
+    with _lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher = Flusher(interval)
+            _flusher.start()
+    return _flusher
+
+
+def enqueue_vote(username, game, action='voted'):
+    ''' queue one action, nudge the flusher once a batch is waiting '''
+    queue = get_queue()
+    now = datetime.now(tz=pytz.utc)
+    queue.append(username, action, game.id, now)
+    eligibility.record(username, now)
+    flusher = _ensure_flusher()
+    if flusher is not None and len(queue) >= getattr(settings, 'VOTE_QUEUE_FLUSH_SIZE', 200):
+        flusher.wake.set()
+
+
+def vote_total(game):
+    '''
+        read-your-own-vote count for game:
+        queued votes are read before the database so a vote
+        is never missed while its batch commits
+    '''
+    pending = get_queue().pending_for_game(game.id) if buffered() else 0
+    return Vote.counts([game.id]).get(game.id, 0) + pending
@@ -0,0 +1,237 @@
+"""
+    Live weekly leaderboard over server-sent events
+
+    the vote path calls changed(game ids) after its votes commit; that
+    appends to a small SQLite broker file shared by the workers on a
+    host (settings.LIVE_BROKER_PATH).  One Publisher thread per worker
+    tails the broker every LIVE_POLL_INTERVAL seconds, reads the new
+    totals of the changed games in one query, and hands the same
+    encoded diff to every connected viewer.  Viewers get the standings
+    from the publisher's memory on connect, so a thousand viewers
+    cost one query per change, not one per viewer per refresh.
+
+    Streams are opt-in (settings.LIVE_LEADERBOARD).  Each open stream
+    holds its request until the viewer leaves, so /games/live/ only
+    answers threaded or gevent workers (wsgi.multithread) and pages
+    connect to settings.LIVE_STREAM_URL, the route served by them.
+"""
+import json
+import logging
+import os
+import threading
+import time
+import Queue
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import close_old_connections
+
+from games.localdb import LocalDB
+from games.models import LeaderboardEntry, voting_week
+
+_log = logging.getLogger(__name__)
+
+RELOAD = None   # changed([RELOAD]): resend everything (leaderboard rebuilt)
+
+
+class Broker(LocalDB):
+    ''' append-only log of changed game ids '''
+    schema = (
+        "CREATE TABLE IF NOT EXISTS changes ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+        "game_id INTEGER, created REAL NOT NULL)",
+    )
+
+    def publish(self, game_ids):
+        now = time.time()
+        self.db.executemany("INSERT INTO changes (game_id, created) VALUES (?, ?)",
+            [(game_id, now) for game_id in game_ids])
+
+    def last_id(self):
+        return self.db.execute("SELECT COALESCE(MAX(id), 0) FROM changes").fetchone()[0]
+
+    def since(self, last_id):
+        return self.db.execute("SELECT id, game_id FROM changes WHERE id > ? ORDER BY id",
+            (last_id,)).fetchall()
+
+    def prune(self, age):
+        self.db.execute("DELETE FROM changes WHERE created < ?", (time.time() - age,))
+
+    def clear(self):
+        self.db.execute("DELETE FROM changes")
+
+
+def event(name, data):
+    ''' one SSE message '''
+    return "event: %s\ndata: %s\n\n" % (name, json.dumps(data, cls=DjangoJSONEncoder))
+
+
+def _rows(week, game_ids=None):
+    rows = LeaderboardEntry.objects.filter(week=week)
+    if game_ids is not None:
+        rows = rows.filter(game__in=game_ids)
+    return [{'id': pk, 'title': title, 'owned': owned, 'votes': votes}
+        for pk, title, owned, votes in rows.values_list('game_id', 'game__title', 'owned', 'votes')]
+
+
+class Publisher(object):
+    ''' this worker's fan-out of broker changes to its viewers '''
+    def __init__(self, broker):
+        self.broker = broker
+        self.subscribers = set()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.week = None
+        self.standings = {}
+        self.last_id = 0
+        self._snapshot = None
+
+    def load(self):
+        self.last_id = self.broker.last_id()
+        self.week = voting_week()
+        self.standings = dict((row['id'], row) for row in _rows(self.week) if row['votes'])
+        self._snapshot = None
+
+    def snapshot(self):
+        if self._snapshot is None:
+            games = sorted(self.standings.values(), key=lambda row: (-row['votes'], row['title']))
+            self._snapshot = event('standings', {'week': self.week, 'games': games})
+        return self._snapshot
+
+    def subscribe(self):
+        ''' a queue of SSE messages, starting with the standings '''
+        queue = Queue.Queue(getattr(settings, 'LIVE_QUEUE_SIZE', 100))
+        with self.lock:
+            if self.week is None:
+                self.load()
+            queue.put(self.snapshot())
+            self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        with self.lock:
+            self.subscribers.discard(queue)
+
+    def broadcast(self, message):
+        for queue in list(self.subscribers):
+            try:
+                queue.put_nowait(message)
+            except Queue.Full:
+                # a stalled viewer skips the backlog and starts over
+                with queue.mutex:
+                    queue.queue.clear()
+                queue.put_nowait(self.snapshot())
+
+    def poll(self):
+        ''' one round: apply new broker rows, send one diff to everyone '''
+        rows = self.broker.since(self.last_id)
+        with self.lock:
+            if rows:
+                self.last_id = rows[-1][0]
+            if not self.subscribers:
+                # nobody watching: reload when someone connects
+                self.week = None
+                return
+            ids = set(game_id for row_id, game_id in rows)
+            if RELOAD in ids or voting_week() != self.week:
+                self.load()
+                self.broadcast(self.snapshot())
+                return
+            if not ids:
+                return
+            changed = _rows(self.week, ids)
+            for row in changed:
+                self.standings[row['id']] = row
+            self._snapshot = None
+            self.broadcast(event('diff', {'week': self.week, 'games': changed}))
+
+    def run(self, interval):
+        pruned = time.time()
+        while True:
+            self.wake.wait(interval)
+            self.wake.clear()
+            try:
+                self.poll()
+                if time.time() - pruned > 3600:
+                    self.broker.prune(3600)
+                    pruned = time.time()
+            except Exception:
+                _log.exception("live leaderboard poll failed")
+            finally:
+                close_old_connections()
+
+
+_broker = None
+_publisher = None
+_publisher_pid = None
+_lock = threading.Lock()
+
+def get_broker():
+    global _broker
+    path = getattr(settings, 'LIVE_BROKER_PATH', 'live.sqlite3')
+    if _broker is None or _broker.path != path:
+        _broker = Broker(path)
+    return _broker
+
+
+def get_publisher():
+    ''' this process' publisher, polling in a thread unless LIVE_POLL_INTERVAL is 0 '''
+    global _publisher, _publisher_pid
+    with _lock:
+        if _publisher is None or _publisher_pid != os.getpid() \
+                or _publisher.broker is not get_broker():
+            _publisher = Publisher(get_broker())
+            _publisher_pid = os.getpid()
+            interval = getattr(settings, 'LIVE_POLL_INTERVAL', 0.5)
+            if interval:
+                thread = threading.Thread(target=_publisher.run, args=(interval,),
+                    name='live-publisher')
+                thread.daemon = True
+                thread.start()
+    return _publisher
+
+
+def enabled():
+    return getattr(settings, 'LIVE_LEADERBOARD', False)
+
+
+def page_context():
+    ''' template context for pages that follow the stream '''
+    return {
+        'live_url': getattr(settings, 'LIVE_STREAM_URL', '/games/live/') if enabled() else None,
+        'leaderboard_size': getattr(settings, 'LEADERBOARD_SIZE', 50),
+    }
+
+
+def changed(game_ids):
+    ''' votes for @game_ids have committed '''
+    if not enabled():
+        return
+    get_broker().publish(game_ids)
+    if _publisher is not None and _publisher_pid == os.getpid():
+        _publisher.wake.set()
+
+
+def reset():
+    ''' forget the viewers and the broker's backlog '''
+    global _publisher
+    with _lock:
+        _publisher = None
+    get_broker().clear()
+
+
+def stream(heartbeat=None):
+    ''' SSE lines for one viewer, until they disconnect '''
+    if heartbeat is None:
+        heartbeat = getattr(settings, 'LIVE_HEARTBEAT', 15)
+    publisher = get_publisher()
+    queue = publisher.subscribe()
+    try:
+        yield "retry: 3000\n\n"
+        while True:
+            try:
+                yield queue.get(timeout=heartbeat)
+            except Queue.Empty:
+                yield ": keepalive\n\n"
+    finally:
+        publisher.unsubscribe(queue)
@@ -0,0 +1,47 @@
+"""
+    Small SQLite files shared by every worker on a host
+    (vote ingest queue, eligibility store)
+"""
+import os
+import sqlite3
+import threading
+from datetime import datetime
+
+import pytz
+from django.conf import settings
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def to_epoch(when):
+    ''' aware datetime -> seconds since the epoch '''
+    return (when - EPOCH).total_seconds()
+
+def from_epoch(seconds):
+    ''' seconds since the epoch -> datetime in settings.TIME_ZONE '''
+    return datetime.fromtimestamp(seconds, tz=pytz.timezone(settings.TIME_ZONE))
+
+
+class LocalDB(object):
+    '''
+        SQLite file with one connection per thread,
+        reopened after a fork; @schema runs on connect
+    '''
+    schema = ()
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def db(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            for statement in self.schema:
+                conn.execute(statement)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
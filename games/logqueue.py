@@ -0,0 +1,177 @@
+"""
+    Non-blocking log handler
+
+    QueueHandler.emit only puts the record on an in-memory queue; a
+    background thread takes records off in batches and writes each
+    batch to a rotating log file with one write and one flush.  If the
+    queue is full the record is dropped (and counted) rather than
+    making a request wait on the disk; after a batch the writer logs a
+    warning with the count, at most every report_interval seconds (and
+    on flush), and resets it.
+
+    Records are formatted in the writer thread.  Arguments that are not
+    plain values (model instances, lazy objects) are merged into the
+    message before queueing, so the writer never touches the database.
+
+    SampleFilter keeps a fraction of DEBUG/INFO records per logger
+    (longest dotted prefix wins); WARNING and above are always kept.
+"""
+import logging
+import os
+import random
+import threading
+import time
+import Queue
+from datetime import date, datetime
+from logging.handlers import RotatingFileHandler
+
+_plain = (basestring, int, long, float, bool, type(None), date, datetime)
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rates=None):
+        logging.Filter.__init__(self)
+        self.rates = rates or {}
+
+    def rate(self, name):
+        while name:
+            if name in self.rates:
+                return self.rates[name]
+            name = name.rpartition('.')[0]
+        return self.rates.get('', 1.0)
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class BatchFileHandler(RotatingFileHandler):
+    ''' RotatingFileHandler that can write many records at once '''
+    def emit_batch(self, records):
+        self.acquire()
+        try:
+            if self.shouldRollover(records[0]):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            lines = []
+            for record in records:
+                line = self.format(record)
+                if isinstance(line, unicode) and not self.encoding:
+                    line = line.encode('utf-8')
+                lines.append(line)
+            self.stream.write('\n'.join(lines) + '\n')
+            self.stream.flush()
+        except Exception:
+            self.handleError(records[0])
+        finally:
+            self.release()
+
+
+class QueueHandler(logging.Handler):
+    ''' hands records to a writer thread that appends to @filename '''
+    def __init__(self, filename, maxBytes=0, backupCount=0, batch_size=500, capacity=10000,
+                 report_interval=60):
+        logging.Handler.__init__(self)
+        self.target = BatchFileHandler(filename, maxBytes=maxBytes,
+            backupCount=backupCount, delay=True)
+        self.batch_size = batch_size
+        self.capacity = capacity
+        self.report_interval = report_interval
+        self.dropped = 0
+        self.drop_lock = threading.Lock()
+        self.reported = time.time()
+        self.queue = None
+        self.pid = None
+        self.writer = None
+        self.start_lock = threading.Lock()
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def start(self):
+        ''' (re)start the writer; a forked worker gets its own '''
+        with self.start_lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = Queue.Queue(self.capacity)
+            self.writer = threading.Thread(target=self.write_loop, name='log-writer')
+            self.writer.daemon = True
+            self.writer.start()
+            self.pid = os.getpid()
+
+    def prepare(self, record):
+        if record.args and not all(isinstance(a, _plain) for a in
+                (record.args.values() if isinstance(record.args, dict) else record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            # tracebacks reference frames that will have moved on
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            with self.drop_lock:
+                self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def report_dropped(self, force=False):
+        ''' write a warning with the records dropped since the last one '''
+        now = time.time()
+        if not self.dropped or (not force and now - self.reported < self.report_interval):
+            return
+        with self.drop_lock:
+            dropped, self.dropped = self.dropped, 0
+        record = logging.LogRecord(__name__, logging.WARNING, __file__, 0,
+            "log queue full: dropped %d records in the last %.0fs",
+            (dropped, now - self.reported), None)
+        self.reported = now
+        self.target.emit_batch([record])
+
+    def write_loop(self):
+        queue = self.queue
+        while True:
+            # no timeout: Queue.get(timeout) polls, waking an idle writer
+            # every few milliseconds; drops only happen while records arrive
+            record = queue.get()
+            if record is None:
+                self.report_dropped(force=True)
+                return
+            batch = [record]
+            stop = False
+            while len(batch) < self.batch_size:
+                try:
+                    record = queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if record is None:
+                    stop = True
+                    break
+                batch.append(record)
+            self.target.emit_batch(batch)
+            self.report_dropped()
+            if stop:
+                self.report_dropped(force=True)
+                return
+
+    def flush(self):
+        ''' wait for everything queued so far to be written '''
+        if self.pid == os.getpid():
+            self.queue.put(None)
+            self.writer.join()
+            self.pid = None
+
+    def close(self):
+        self.flush()
+        self.target.close()
+        logging.Handler.close(self)
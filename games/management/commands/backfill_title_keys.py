@@ -0,0 +1,89 @@
+""" fill Game.title_key for rows saved before the column existed """
+from optparse import make_option
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count
+
+from games.models import Game, Vote, UserActivityLog, Rating, RatingAggregate, normalize_title
+
+
+def merge(duplicate, keeper):
+    '''
+        fold @duplicate (a game whose title differs from @keeper's only by
+        case, spacing or punctuation) into @keeper and delete it: activity
+        moves over, its votes are added, ratings move unless the user rated
+        @keeper too; leaderboard and rollup rows go with the deleted game
+    '''
+    UserActivityLog.objects.filter(game=duplicate).update(game=keeper)
+    raters = Rating.objects.filter(game=keeper).values_list('user_id', flat=True)
+    Rating.objects.filter(game=duplicate).exclude(user__in=list(raters)).update(game=keeper)
+    votes = Vote.counts([duplicate.id]).get(duplicate.id, 0)
+    if votes:
+        Vote.objects.get(game=keeper).add(votes)
+    if duplicate.owned and not keeper.owned:
+        keeper.owned = True
+        keeper.save()
+    duplicate.delete()
+
+    RatingAggregate.objects.filter(game=keeper).delete()
+    aggregate = RatingAggregate(game=keeper)
+    for row in Rating.objects.filter(game=keeper).values('rating').annotate(n=Count('id')):
+        stars = int(row['rating'])
+        aggregate.count += row['n']
+        aggregate.total += stars * row['n']
+        setattr(aggregate, 'stars_%d' % stars, row['n'])
+    if aggregate.count:
+        aggregate.save()
+
+
+class Command(BaseCommand):
+    help = ("Backfill normalized title keys in chunks; games whose key is taken "
+            "are reported, or merged into the keyed game with --merge")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=1000,
+            help='games per transaction'),
+        make_option('--merge', dest='merge', action='store_true', default=False,
+            help='merge each duplicate into the game that holds its key'),
+    )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        taken = dict(Game.objects.exclude(title_key=None).values_list('title_key', 'id'))
+        last, filled, clashes = 0, 0, []
+        while True:
+            chunk = list(Game.objects.filter(title_key=None, id__gt=last).order_by(
+                'id').values_list('id', 'title')[:batch_size])
+            if not chunk:
+                break
+            with transaction.atomic():
+                for pk, title in chunk:
+                    key = normalize_title(title)
+                    if key in taken:
+                        clashes.append((pk, taken[key]))
+                        continue
+                    Game.objects.filter(pk=pk).update(title_key=key)
+                    taken[key] = pk
+                    filled += 1
+            last = chunk[-1][0]
+            self.stdout.write("... %d keyed" % filled)
+        self.stdout.write("keyed %d games" % filled)
+        if not clashes:
+            return
+
+        games = Game.objects.in_bulk(set(pk for pair in clashes for pk in pair))
+        if not options['merge']:
+            for pk, keeper in clashes:
+                self.stderr.write("game %d %r duplicates game %d %r" % (
+                    pk, games[pk].title, keeper, games[keeper].title))
+            raise CommandError("%d games duplicate another title and have no key: "
+                "rename them, or rerun with --merge" % len(clashes))
+        for pk, keeper in clashes:
+            with transaction.atomic():
+                merge(games[pk], games[keeper])
+            self.stdout.write("merged game %d %r into game %d %r" % (
+                pk, games[pk].title, keeper, games[keeper].title))
+        # the merged games' weekly and hourly counts now belong to the keepers
+        call_command('rebuild_leaderboard', stdout=self.stdout)
+        call_command('rebuild_vote_rollups', stdout=self.stdout)
@@ -0,0 +1,85 @@
+"""
+    Per-view latency / query / memory benchmark
+
+    builds a throwaway test database, and for each scale
+    (users:games:activity) fills it with games.benchmarks.generate()
+    and times every games view.  The eligibility store and vote queue
+    go to temporary files, so nothing outside the test database is touched.
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+from optparse import make_option
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from games import benchmarks, eligibility
+
+DEFAULT_SCALES = '100:50:1000,1000:500:20000,5000:2000:100000'
+
+
+def parse_scales(value):
+    scales = []
+    for spec in value.split(','):
+        try:
+            users, games, activity = [int(n) for n in spec.split(':')]
+        except ValueError:
+            raise CommandError("scale %r is not users:games:activity" % spec)
+        scales.append((users, games, activity))
+    return scales
+
+
+class Command(BaseCommand):
+    help = "Benchmark the games views at several synthetic dataset sizes"
+    option_list = BaseCommand.option_list + (
+        make_option('--scales', dest='scales', default=DEFAULT_SCALES,
+            help='comma separated users:games:activity triples'),
+        make_option('--iterations', dest='iterations', type='int', default=30,
+            help='requests per view per scale'),
+        make_option('--seed', dest='seed', type='int', default=0),
+        make_option('--output', dest='output', default=None,
+            help='write the JSON report here (default: stdout)'),
+    )
+
+    def handle(self, *args, **options):
+        scales = parse_scales(options['scales'])
+        scratch = tempfile.mkdtemp(prefix='bench_views')
+        settings.ELIGIBILITY_STORE_PATH = os.path.join(scratch, 'eligibility.sqlite3')
+        settings.VOTE_QUEUE_PATH = os.path.join(scratch, 'vote_queue.sqlite3')
+        if 'south' in settings.INSTALLED_APPS:
+            from south.management.commands import patch_for_test_db_setup
+            patch_for_test_db_setup()
+        old_name = settings.DATABASES['default']['NAME']
+        connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        report = []
+        try:
+            for users, games, activity in scales:
+                call_command('flush', interactive=False, verbosity=0)
+                cache.clear()
+                eligibility.reset()
+                self.stderr.write("generating %d users, %d games, %d activity rows" % (
+                    users, games, activity))
+                user_ids, game_ids = benchmarks.generate(
+                    users, games, activity, seed=options['seed'], stdout=open(os.devnull, 'w'))
+                results = benchmarks.bench(options['iterations'], user_ids, game_ids)
+                for view in sorted(results):
+                    r = results[view]
+                    self.stderr.write("  %-10s p50 %7.1fms p95 %7.1fms p99 %7.1fms %5.1f queries" % (
+                        view, r['p50_ms'], r['p95_ms'], r['p99_ms'], r['queries']))
+                report.append({'users': users, 'games': games, 'activity': activity,
+                               'iterations': options['iterations'], 'views': results})
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            shutil.rmtree(scratch, ignore_errors=True)
+
+        out = open(options['output'], 'w') if options['output'] else sys.stdout
+        json.dump(report, out, indent=2, sort_keys=True)
+        out.write('\n')
+        if out is not sys.stdout:
+            out.close()
@@ -0,0 +1,119 @@
+"""
+    Query plans for the user_activity hot queries, without and with
+    the (user, created) / (action, created) indexes, on a synthetic
+    dataset.  Everything runs in a transaction that is rolled back.
+"""
+import random
+import time
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from games.models import Game, UserActivityLog, TIMEZONE
+
+TABLE = UserActivityLog._meta.db_table
+
+
+class Rollback(Exception):
+    pass
+
+
+def activity_indexes(cursor):
+    ''' names of the user_activity indexes built from index_together '''
+    wanted = [tuple(UserActivityLog._meta.get_field(f).column for f in fields)
+        for fields in UserActivityLog._meta.index_together]
+    if connection.vendor == 'sqlite':
+        cursor.execute("PRAGMA index_list(%s)" % TABLE)
+        names = [row[1] for row in cursor.fetchall()]
+        found = []
+        for name in names:
+            cursor.execute("PRAGMA index_info(%s)" % name)
+            if tuple(row[2] for row in cursor.fetchall()) in wanted:
+                found.append(name)
+        return found
+    cursor.execute("SELECT i.relname, array_agg(a.attname ORDER BY k.n) "
+        "FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid "
+        "JOIN pg_class t ON t.oid = x.indrelid "
+        "CROSS JOIN LATERAL unnest(x.indkey) WITH ORDINALITY AS k(attnum, n) "
+        "JOIN pg_attribute a ON a.attrelid = t.oid AND a.attnum = k.attnum "
+        "WHERE t.relname = %s GROUP BY i.relname", [TABLE])
+    return [name for name, columns in cursor.fetchall() if tuple(columns) in wanted]
+
+
+class Command(BaseCommand):
+    help = "EXPLAIN the activity log queries before and after indexing, on N synthetic rows"
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', dest='rows', type='int', default=100000,
+            help='synthetic activity rows'),
+        make_option('--users', dest='users', type='int', default=500),
+        make_option('--games', dest='games', type='int', default=2000),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.seed(options['rows'], options['users'], options['games'])
+                cursor = connection.cursor()
+                indexes = activity_indexes(cursor)
+                sid = transaction.savepoint()
+                for name in indexes:
+                    cursor.execute("DROP INDEX %s" % name)
+                self.report("without indexes", cursor)
+                transaction.savepoint_rollback(sid)
+                self.report("with indexes %s" % ", ".join(indexes), cursor)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def seed(self, rows, users, games):
+        tag = 'explain%d' % random.randint(0, 10 ** 6)
+        User.objects.bulk_create([User(username='%s_%d' % (tag, i))
+            for i in range(users)])
+        user_ids = list(User.objects.filter(
+            username__startswith=tag).values_list('id', flat=True))
+        Game.objects.bulk_create([Game(title='%s game %d' % (tag, i),
+            user_id=user_ids[0]) for i in range(games)])
+        game_ids = list(Game.objects.filter(
+            title__startswith=tag).values_list('id', flat=True))
+        self.user = User.objects.get(id=user_ids[0])
+        start = datetime.now(tz=TIMEZONE) - timedelta(days=365)
+        batch = []
+        for i in range(rows):
+            batch.append(UserActivityLog(user_id=random.choice(user_ids),
+                game_id=random.choice(game_ids),
+                action='voted' if random.random() < 0.9 else 'added',
+                created=start + timedelta(seconds=random.randint(0, 365 * 86400))))
+            if len(batch) == 5000:
+                UserActivityLog.objects.bulk_create(batch)
+                batch = []
+        UserActivityLog.objects.bulk_create(batch)
+        connection.cursor().execute("ANALYZE %s" % TABLE)
+        self.stdout.write("seeded %d activity rows" % rows)
+
+    def queries(self):
+        return (
+            ('last_acted', UserActivityLog.objects.filter(
+                user=self.user).order_by('-created')[:1]),
+            ('my_votes', UserActivityLog.objects.filter(
+                user=self.user, action='voted').order_by('-created')),
+            ('AllVotes', UserActivityLog.objects.filter(
+                action='voted').order_by('created')[:50]),
+        )
+
+    def report(self, label, cursor):
+        explain = 'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite' else 'EXPLAIN '
+        self.stdout.write("\n== %s" % label)
+        for name, qs in self.queries():
+            sql, params = qs.query.sql_with_params()
+            cursor.execute(explain + sql, params)
+            plan = [" ".join(str(col) for col in row) for row in cursor.fetchall()]
+            started = time.time()
+            cursor.execute(sql, params)
+            cursor.fetchall()
+            elapsed = (time.time() - started) * 1000
+            self.stdout.write("-- %s (%.2f ms)" % (name, elapsed))
+            for line in plan:
+                self.stdout.write("   %s" % line)
@@ -0,0 +1,39 @@
+""" stream the activity log to a file or stdout as csv or ndjson """
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from games import export
+
+
+class Command(BaseCommand):
+    help = "Export vote/add history joined with game and user, in bounded memory"
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+            help='csv or ndjson'),
+        make_option('--from', dest='date_from', default=None,
+            help='first day to include (YYYY-MM-DD)'),
+        make_option('--to', dest='date_to', default=None,
+            help='last day to include (YYYY-MM-DD)'),
+        make_option('--action', dest='action', default=None,
+            help='only this action (voted, added)'),
+        make_option('--output', dest='output', default=None,
+            help='file to write (default stdout)'),
+    )
+
+    def handle(self, *args, **options):
+        fmt = options['format']
+        if fmt not in export.FORMATS:
+            raise CommandError("--format must be one of %s" % ", ".join(export.FORMATS))
+        try:
+            filters = export.parse_filters(options['date_from'],
+                options['date_to'], options['action'])
+        except ValueError:
+            raise CommandError("dates must look like YYYY-MM-DD")
+        out = open(options['output'], 'wb') if options['output'] else self.stdout
+        try:
+            for line in export.lines(fmt, export.activity_rows(**filters)):
+                out.write(line)
+        finally:
+            if options['output']:
+                out.close()
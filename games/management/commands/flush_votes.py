@@ -0,0 +1,18 @@
+""" apply votes waiting in the write-behind ingest queue """
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from games import ingest
+
+
+class Command(BaseCommand):
+    help = "Flush the buffered vote queue into the database (also recovers after a crash)"
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int', default=None,
+            help='rows per transaction (default VOTE_QUEUE_FLUSH_SIZE)'),
+    )
+
+    def handle(self, *args, **options):
+        applied = ingest.flush(options['batch_size'])
+        self.stdout.write("applied %d queued actions" % applied)
@@ -0,0 +1,12 @@
+""" fold pending vote deltas into the leaderboard and rollups """
+from django.core.management.base import BaseCommand
+
+from games import tally
+
+
+class Command(BaseCommand):
+    help = "Fold pending votes into the leaderboard and vote rollups (VOTE_FOLD_INTERVAL 0 or no folder running)"
+
+    def handle(self, *args, **options):
+        folded = tally.fold_all()
+        self.stdout.write("folded %d vote deltas" % folded)
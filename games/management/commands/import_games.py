@@ -0,0 +1,171 @@
+"""
+    Bulk catalog import
+
+    reads a CSV (title[,owned][,user] header) or JSON catalog
+    (a loaddata style array, an array of {"title": ...} objects, or one
+    object per line) as a stream, drops titles already in the catalog
+    or repeated in the file (by normalized title), and bulk inserts
+    games, their vote rows and title trigrams a batch at a time.
+    No per-row save() or post_save signals are involved.
+"""
+import codecs
+import csv
+import json
+import sys
+import time
+from datetime import datetime
+from optparse import make_option
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from games import fuzzy, versions
+from games.models import Game, Vote, TitleTrigram, TIMEZONE, normalize_title
+
+
+def csv_records(stream):
+    for row in csv.DictReader(stream):
+        yield dict((k, v.decode('utf-8')) for k, v in row.items() if v is not None)
+
+
+def json_records(stream, chunk_size=65536):
+    ''' objects from a JSON array or JSON lines, without loading the whole file '''
+    decoder = json.JSONDecoder()
+    text = codecs.getreader('utf-8')(stream)
+    buf, pos = u'', 0
+    while True:
+        # skip separators between objects
+        while pos < len(buf) and buf[pos] in u' \t\r\n,[]':
+            pos += 1
+        try:
+            obj, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            more = text.read(chunk_size)
+            if not more:
+                if buf[pos:].strip():
+                    raise CommandError("unparseable JSON near %r" % buf[pos:pos + 40])
+                return
+            buf, pos = buf[pos:] + more, 0
+            continue
+        pos = end
+        if 'fields' in obj:
+            # dumpdata / loaddata format
+            if obj.get('model') != 'games.game':
+                continue
+            obj = obj['fields']
+        yield obj
+
+
+def _slices(values, size=500):
+    ''' keep IN (...) lists under SQLite's bound parameter limit '''
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _owned(value):
+    if isinstance(value, basestring):
+        return value.strip().lower() in ('1', 'true', 'yes', 'y')
+    return bool(value)
+
+
+class Command(BaseCommand):
+    help = "Import a CSV or JSON game catalog in batches, skipping known titles"
+    args = '<catalog file, - for stdin>'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None,
+            help='csv or json (default: from the file extension)'),
+        make_option('--user', dest='user', default=None,
+            help='username recorded as adding games that name no user'),
+        make_option('--batch-size', dest='batch_size', type='int', default=2000,
+            help='games per transaction'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("give one catalog file")
+        path = args[0]
+        fmt = options['format'] or ('csv' if path.endswith('.csv') else 'json')
+        if fmt not in ('csv', 'json'):
+            raise CommandError("--format must be csv or json")
+        if not options['user']:
+            raise CommandError("--user is required")
+        try:
+            self.default_user = User.objects.get(username=options['user']).pk
+        except User.DoesNotExist:
+            raise CommandError("no user %s" % options['user'])
+        self.users = {}
+
+        stream = sys.stdin if path == '-' else open(path, 'rb')
+        records = csv_records(stream) if fmt == 'csv' else json_records(stream)
+        self.started = time.time()
+        self.imported = self.skipped = 0
+        batch = []
+        try:
+            for record in records:
+                batch.append(record)
+                if len(batch) >= options['batch_size']:
+                    self.load(batch)
+                    batch = []
+            self.load(batch)
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        versions.bump(versions.CATALOG)
+        self.progress("done")
+
+    def user_id(self, value):
+        ''' user pk from a pk or a username, cached; default user if absent '''
+        if value in (None, u''):
+            return self.default_user
+        if value not in self.users:
+            field = 'pk' if isinstance(value, int) or value.isdigit() else 'username'
+            try:
+                self.users[value] = User.objects.values_list(
+                    'pk', flat=True).get(**{field: value})
+            except User.DoesNotExist:
+                raise CommandError("unknown user %r" % value)
+        return self.users[value]
+
+    def load(self, records):
+        if not records:
+            return
+        games = {}
+        for record in records:
+            title = (record.get('title') or u'').strip()
+            key = normalize_title(title)
+            if not key or key in games:
+                self.skipped += 1
+                continue
+            games[key] = (title, _owned(record.get('owned', False)), record.get('user'))
+        existing = set()
+        for keys in _slices(games.keys()):
+            existing.update(Game.objects.filter(
+                title_key__in=keys).values_list('title_key', flat=True))
+        self.skipped += len(existing)
+        now = datetime.now(tz=TIMEZONE)
+        new = [Game(title=title, title_key=key, owned=owned,
+                    user_id=self.user_id(user), created=now)
+               for key, (title, owned, user) in games.items() if key not in existing]
+        if not new:
+            return
+        with transaction.atomic():
+            Game.objects.bulk_create(new)
+            ids = []
+            for keys in _slices([g.title_key for g in new]):
+                ids.extend(Game.objects.filter(title_key__in=keys).values_list('id', 'title'))
+            votes, grams = [], []
+            for pk, title in ids:
+                votes.append(Vote(game_id=pk, created=now))
+                grams.extend(TitleTrigram(gram=gram, game_id=pk)
+                    for gram in fuzzy.trigrams(title))
+            Vote.objects.bulk_create(votes)
+            TitleTrigram.objects.bulk_create(grams)
+        self.imported += len(new)
+        self.progress("...")
+
+    def progress(self, label):
+        elapsed = max(time.time() - self.started, 0.001)
+        self.stdout.write("%s %d imported, %d skipped, %.0f games/s" % (
+            label, self.imported, self.skipped, self.imported / elapsed))
@@ -0,0 +1,149 @@
+"""
+    Weekly range partitioning of user_activity (PostgreSQL 11+)
+
+    --convert      rebuild user_activity as a table partitioned by voting
+                   week, copying existing rows (run once, in a quiet window)
+    --ahead N      make sure partitions exist for the next N weeks (cron weekly);
+                   rows the default partition caught for a new week move into it
+    --detach-before YYYY-MM-DD
+                   detach partitions for weeks ending before that date;
+                   they stay as plain tables to archive or drop
+"""
+from datetime import datetime, time, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from games.models import TIMEZONE, UserActivityLog, voting_week
+
+TABLE = UserActivityLog._meta.db_table
+
+
+def partition_name(monday):
+    return '%s_w%s' % (TABLE, monday.strftime('%Y%m%d'))
+
+
+def week_bounds(monday):
+    ''' local midnight monday .. next monday, as aware datetimes '''
+    start = TIMEZONE.localize(datetime.combine(monday, time()))
+    end = TIMEZONE.localize(datetime.combine(monday + timedelta(days=7), time()))
+    return start, end
+
+
+class Command(BaseCommand):
+    help = "Partition user_activity by voting week on PostgreSQL"
+    option_list = BaseCommand.option_list + (
+        make_option('--convert', action='store_true', dest='convert', default=False,
+            help='convert the existing table into a partitioned one'),
+        make_option('--ahead', dest='ahead', type='int', default=4,
+            help='weeks of future partitions to create'),
+        make_option('--detach-before', dest='detach_before', default=None,
+            help='detach partitions for weeks ending on or before this date'),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("weekly partitioning needs PostgreSQL, not %s"
+                % connection.vendor)
+        cursor = connection.cursor()
+        with transaction.atomic():
+            if options['convert']:
+                self.convert(cursor)
+            self.create_ahead(cursor, options['ahead'])
+            if options['detach_before']:
+                try:
+                    before = datetime.strptime(options['detach_before'], '%Y-%m-%d').date()
+                except ValueError:
+                    raise CommandError("--detach-before must look like YYYY-MM-DD")
+                self.detach(cursor, before)
+
+    def is_partitioned(self, cursor):
+        cursor.execute("SELECT 1 FROM pg_partitioned_table p "
+            "JOIN pg_class c ON c.oid = p.partrelid WHERE c.relname = %s", [TABLE])
+        return cursor.fetchone() is not None
+
+    def create_partition(self, cursor, monday):
+        '''
+            partition for the week of @monday, unless it exists; rows the
+            default partition caught for that week are moved into it first
+            (PostgreSQL refuses a partition whose range the default holds)
+        '''
+        name = partition_name(monday)
+        start, end = week_bounds(monday)
+        cursor.execute("SELECT to_regclass(%s)", [name])
+        if cursor.fetchone()[0] is not None:
+            return
+        cursor.execute("SELECT 1 FROM %s_default WHERE created >= %%s AND created < %%s "
+            "LIMIT 1" % TABLE, [start, end])
+        if cursor.fetchone() is None:
+            cursor.execute("CREATE TABLE %s PARTITION OF %s "
+                "FOR VALUES FROM (%%s) TO (%%s)" % (name, TABLE), [start, end])
+            return
+        cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+            % (name, TABLE))
+        cursor.execute("WITH moved AS (DELETE FROM %s_default WHERE created >= %%s "
+            "AND created < %%s RETURNING *) INSERT INTO %s SELECT * FROM moved"
+            % (TABLE, name), [start, end])
+        self.stdout.write("moved %d rows from %s_default to %s" % (cursor.rowcount, TABLE, name))
+        cursor.execute("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (%%s) TO (%%s)"
+            % (TABLE, name), [start, end])
+
+    def convert(self, cursor):
+        if self.is_partitioned(cursor):
+            raise CommandError("%s is already partitioned" % TABLE)
+        legacy = TABLE + '_unpartitioned'
+        cursor.execute("ALTER TABLE %s RENAME TO %s" % (TABLE, legacy))
+        # LIKE copies neither foreign keys nor indexes (and the legacy
+        # primary key index could not be used: the partition key has to be
+        # part of the primary key), so they are made again below
+        cursor.execute("CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS) "
+            "PARTITION BY RANGE (created)" % (TABLE, legacy))
+        cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (id, created)" % TABLE)
+        cursor.execute("ALTER SEQUENCE %s_id_seq OWNED BY %s.id" % (TABLE, TABLE))
+        cursor.execute("CREATE TABLE %s_default PARTITION OF %s DEFAULT" % (TABLE, TABLE))
+        for field in UserActivityLog._meta.fields:
+            if field.rel is None:
+                continue
+            target = field.rel.to._meta
+            cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s_%s_fk FOREIGN KEY (%s) "
+                "REFERENCES %s (%s) DEFERRABLE INITIALLY DEFERRED" % (
+                TABLE, TABLE, field.column, field.column,
+                target.db_table, target.get_field(field.rel.field_name).column))
+        indexed = [(field.column,) for field in UserActivityLog._meta.fields
+                   if field.db_index and not field.primary_key]
+        for fields in UserActivityLog._meta.index_together:
+            indexed.append(tuple(UserActivityLog._meta.get_field(f).column for f in fields))
+        for columns in indexed:
+            cursor.execute("CREATE INDEX %s_%s ON %s (%s)" % (
+                TABLE, '_'.join(columns), TABLE, ', '.join(columns)))
+
+        cursor.execute("SELECT MIN(created), MAX(created) FROM %s" % legacy)
+        first, last = cursor.fetchone()
+        if first is not None:
+            monday = voting_week(first)
+            while monday <= voting_week(last):
+                self.create_partition(cursor, monday)
+                monday += timedelta(days=7)
+        cursor.execute("INSERT INTO %s SELECT * FROM %s" % (TABLE, legacy))
+        cursor.execute("DROP TABLE %s" % legacy)
+        self.stdout.write("converted %s to weekly partitions" % TABLE)
+
+    def create_ahead(self, cursor, weeks):
+        if not self.is_partitioned(cursor):
+            raise CommandError("%s is not partitioned yet, run with --convert" % TABLE)
+        monday = voting_week()
+        for i in range(weeks + 1):
+            self.create_partition(cursor, monday + timedelta(days=7 * i))
+
+    def detach(self, cursor, before):
+        cursor.execute("SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = %s AND c.relname LIKE %s ORDER BY c.relname",
+            [TABLE, TABLE + '_w%'])
+        for (name,) in cursor.fetchall():
+            monday = datetime.strptime(name[-8:], '%Y%m%d').date()
+            if monday + timedelta(days=7) <= before:
+                cursor.execute("ALTER TABLE %s DETACH PARTITION %s" % (TABLE, name))
+                self.stdout.write("detached %s" % name)
@@ -0,0 +1,26 @@
+""" reload the shared eligibility store from the activity log """
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from games import eligibility, ingest
+from games.localdb import to_epoch
+from games.models import UserActivityLog
+
+
+class Command(BaseCommand):
+    help = "Rebuild each user's last-action time in the eligibility store"
+
+    def handle(self, *args, **options):
+        store = eligibility.get_store()
+        eligibility.reset()
+        users = 0
+        for row in UserActivityLog.objects.values('user__username').annotate(
+                last=Max('created')).iterator():
+            store.put(row['user__username'], to_epoch(row['last']))
+            users += 1
+        # votes still waiting in the ingest queue count too
+        if ingest.buffered():
+            for username, acted in ingest.get_queue().db.execute(
+                    "SELECT username, MAX(created) FROM queue GROUP BY username"):
+                store.put(username, acted)
+        self.stdout.write("stored last actions for %d users" % users)
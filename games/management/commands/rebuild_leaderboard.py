@@ -0,0 +1,59 @@
+""" rebuild the materialized leaderboard from votes and the activity log """
+from collections import defaultdict
+from datetime import datetime, time, timedelta
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from games import live, tally, versions
+from games.models import Game, Vote, UserActivityLog, LeaderboardEntry
+from games.models import TIMEZONE, voting_week
+
+
+class Command(BaseCommand):
+    help = "Rebuild leaderboard rows (every week, or one week with --week)"
+    option_list = BaseCommand.option_list + (
+        make_option('--week', dest='week', default=None,
+            help='only rebuild the voting week containing this date (YYYY-MM-DD)'),
+        make_option('--batch-size', dest='batch_size', type='int', default=None,
+            help='rows per bulk insert (default: as many as the database allows)'),
+    )
+
+    def handle(self, *args, **options):
+        # pending deltas are already in the activity log and shards, fold them
+        # first so they are not added on top of the rebuilt rows later
+        tally.fold_all()
+        activity = UserActivityLog.objects.filter(action='voted')
+        entries = LeaderboardEntry.objects.all()
+        monday = None
+        if options['week']:
+            try:
+                day = datetime.strptime(options['week'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("--week must look like YYYY-MM-DD")
+            monday = day - timedelta(days=day.weekday())
+            start = TIMEZONE.localize(datetime.combine(monday, time()))
+            activity = activity.filter(created__gte=start,
+                created__lt=start + timedelta(days=7))
+            entries = entries.filter(week=monday)
+
+        counts = defaultdict(int)
+        for game_id, created in activity.values_list('game_id', 'created').iterator():
+            counts[(voting_week(created), game_id)] += 1
+        if monday is None:
+            for game_id, count in Vote.counts().items():
+                if count > 0:
+                    counts[(LeaderboardEntry.ALL_TIME, game_id)] = count
+
+        owned = dict(Game.objects.values_list('id', 'owned'))
+        rows = [LeaderboardEntry(week=week, game_id=game_id,
+                    owned=owned.get(game_id, False), votes=votes)
+                for (week, game_id), votes in counts.items()]
+
+        with transaction.atomic():
+            entries.delete()
+            LeaderboardEntry.objects.bulk_create(rows, batch_size=options['batch_size'])
+        versions.bump(versions.VOTES)
+        live.changed([live.RELOAD])
+        self.stdout.write("rebuilt %d leaderboard rows" % len(rows))
@@ -0,0 +1,52 @@
+""" rebuild the hourly / daily vote rollups from the activity log """
+from collections import defaultdict
+from datetime import datetime, time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from games import tally
+from games.models import UserActivityLog, HourlyVotes, DailyVotes, TIMEZONE
+
+
+class Command(BaseCommand):
+    help = "Rebuild hourly and daily vote rollups (everything, or from --since on)"
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since', default=None,
+            help='only rebuild buckets from this local date on (YYYY-MM-DD)'),
+        make_option('--batch-size', dest='batch_size', type='int', default=None,
+            help='rows per bulk insert (default: as many as the database allows)'),
+    )
+
+    def handle(self, *args, **options):
+        # pending deltas are already in the activity log and shards, fold them
+        # first so they are not added on top of the rebuilt rows later
+        tally.fold_all()
+        activity = UserActivityLog.objects.filter(action='voted')
+        hourly_rows = HourlyVotes.objects.all()
+        daily_rows = DailyVotes.objects.all()
+        if options['since']:
+            try:
+                day = datetime.strptime(options['since'], '%Y-%m-%d').date()
+            except ValueError:
+                raise CommandError("--since must look like YYYY-MM-DD")
+            start = TIMEZONE.localize(datetime.combine(day, time()))
+            activity = activity.filter(created__gte=start)
+            hourly_rows = hourly_rows.filter(start__gte=start)
+            daily_rows = daily_rows.filter(start__gte=start)
+
+        hourly = defaultdict(int)
+        daily = defaultdict(int)
+        for game_id, created in activity.values_list('game_id', 'created').iterator():
+            hourly[(HourlyVotes.bucket(created), game_id)] += 1
+            daily[(DailyVotes.bucket(created), game_id)] += 1
+
+        with transaction.atomic():
+            hourly_rows.delete()
+            daily_rows.delete()
+            HourlyVotes.objects.bulk_create([HourlyVotes(start=start, game_id=game_id, votes=votes)
+                for (start, game_id), votes in hourly.items()], batch_size=options['batch_size'])
+            DailyVotes.objects.bulk_create([DailyVotes(start=start, game_id=game_id, votes=votes)
+                for (start, game_id), votes in daily.items()], batch_size=options['batch_size'])
+        self.stdout.write("rebuilt %d hourly and %d daily rollup rows" % (len(hourly), len(daily)))
@@ -0,0 +1,49 @@
+""" (re)make the resized variants of every game image """
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from games import thumbnails
+from games.models import Game
+
+
+class Command(BaseCommand):
+    help = "Regenerate thumbnail variants for existing game images in a process pool"
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', dest='workers', type='int', default=None,
+            help='pool size (default: THUMBNAIL_WORKERS, 0 = in this process)'),
+        make_option('--missing', dest='missing', action='store_true', default=False,
+            help='only games whose variants have not been made'),
+    )
+
+    def handle(self, *args, **options):
+        games = Game.objects.exclude(image='').exclude(image=None)
+        if options['missing']:
+            games = games.filter(image_hash='')
+        games = list(games.only('id', 'image'))
+        workers = options['workers']
+        if workers is None:
+            workers = getattr(settings, 'THUMBNAIL_WORKERS', 2)
+
+        jobs = [thumbnails.job(game) for game in games]
+        if workers:
+            from multiprocessing import Pool
+            pool = Pool(workers)
+            try:
+                digests = pool.map(_render, jobs, chunksize=8)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            digests = [_render(job) for job in jobs]
+
+        done = 0
+        for game, digest in zip(games, digests):
+            thumbnails.finished(game.pk, game.image.name, digest)
+            done += digest is not None
+        self.stdout.write("made variants for %d of %d images" % (done, len(games)))
+
+
+def _render(job):
+    return thumbnails.render_variants(*job)
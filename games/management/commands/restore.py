@@ -0,0 +1,59 @@
+""" load a binary snapshot written by manage.py snapshot """
+import time
+from optparse import make_option
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from games import live, snapshot, versions
+
+
+class Command(BaseCommand):
+    help = "Restore users, games, votes, activity and ratings from a snapshot, then rebuild derived tables"
+    args = '<snapshot file>'
+    option_list = BaseCommand.option_list + (
+        make_option('--replace', dest='replace', action='store_true', default=False,
+            help='delete the current games, votes, activity and ratings first '
+                '(users are always replaced one by one)'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("give one snapshot file")
+        occupied = snapshot.occupied()
+        if occupied and not options['replace']:
+            raise CommandError("%s already hold rows: restore into an empty database "
+                "or pass --replace" % ", ".join(occupied))
+        self.started = time.time()
+        try:
+            with open(args[0], 'rb') as stream:
+                # derived tables are rebuilt in the load transaction: a
+                # failure leaves the database as it was, nothing to resume
+                with transaction.atomic():
+                    if options['replace']:
+                        snapshot.clear()
+                    loaded = snapshot.load(stream, self.progress)
+                    snapshot.rebuild_trigrams()
+                    snapshot.rebuild_ratings()
+                    call_command('rebuild_leaderboard', stdout=self.stdout)
+                    call_command('rebuild_vote_rollups', stdout=self.stdout)
+        except (IOError, snapshot.SnapshotError) as e:
+            raise CommandError("cannot restore %s: %s" % (args[0], e))
+        for name, model, columns in snapshot.TABLES:
+            self.stdout.write("%s: %d rows" % (name, loaded[name]))
+
+        # the restored rows are committed; the eligibility store and the
+        # cache stamps live outside the database
+        for name in (versions.CATALOG, versions.VOTES, versions.RATINGS, versions.THUMBNAILS):
+            versions.bump(name)
+        live.changed([live.RELOAD])
+        try:
+            call_command('rebuild_eligibility', stdout=self.stdout)
+        except Exception as e:
+            raise CommandError("restored %s, but rebuilding the eligibility store failed (%s): "
+                "run  manage.py rebuild_eligibility  to finish" % (args[0], e))
+        self.stdout.write("done in %.1fs" % (time.time() - self.started))
+
+    def progress(self, table, rows):
+        self.stdout.write("... %s %d rows, %.1fs" % (table, rows, time.time() - self.started))
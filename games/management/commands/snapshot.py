@@ -0,0 +1,29 @@
+""" write the voting state to a compact binary snapshot """
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from games import snapshot
+
+
+class Command(BaseCommand):
+    help = "Snapshot users, games, votes, activity and ratings to a compressed column file"
+    args = '<snapshot file>'
+    option_list = BaseCommand.option_list + (
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=snapshot.CHUNK_SIZE, help='rows per compressed block'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("give one snapshot file")
+        self.started = time.time()
+        with open(args[0], 'wb') as out:
+            written = snapshot.write(out, options['chunk_size'], self.progress)
+        for name, model, columns in snapshot.TABLES:
+            self.stdout.write("%s: %d rows" % (name, written[name]))
+        self.stdout.write("done in %.1fs" % (time.time() - self.started))
+
+    def progress(self, table, rows):
+        self.stdout.write("... %s %d rows, %.1fs" % (table, rows, time.time() - self.started))
@@ -0,0 +1,47 @@
+""" report what a cold worker imports, and how long each import takes """
+import json
+import os
+import subprocess
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Time each module a fresh worker imports to load the site and serve one request"
+    option_list = BaseCommand.option_list + (
+        make_option('--path', dest='path', default='/games/games/',
+            help='URL of the first request'),
+        make_option('--limit', dest='limit', type='int', default=30,
+            help='modules to list'),
+        make_option('--sort', dest='sort', default='cumulative',
+            help='cumulative or self'),
+    )
+
+    def handle(self, *args, **options):
+        if options['sort'] not in ('cumulative', 'self'):
+            raise CommandError("--sort must be cumulative or self")
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', 'nat.settings')
+        # a web worker's INSTALLED_APPS, not this command's
+        env.pop('NAT_MANAGEMENT_APPS', None)
+        env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.getcwd(), env.get('PYTHONPATH')]))
+        # a new interpreter: this one has already imported everything
+        child = subprocess.Popen([sys.executable, '-m', 'nat.importtime', options['path']],
+            stdout=subprocess.PIPE, env=env)
+        output = child.communicate()[0]
+        if child.returncode:
+            raise CommandError("tracing failed (exit status %s)" % child.returncode)
+        report = json.loads(output.strip().splitlines()[-1])
+
+        self.stdout.write("startup %.3fs, first request %s %.3fs (%s), %d modules" % (
+            report['startup_seconds'], report['path'], report['request_seconds'],
+            report['status'], report['modules_loaded']))
+        self.stdout.write("%10s %10s  %-8s %s" % (options['sort'],
+            'self' if options['sort'] == 'cumulative' else 'cumulative', 'phase', 'module'))
+        other = 'self' if options['sort'] == 'cumulative' else 'cumulative'
+        for entry in sorted(report['imports'], key=lambda e: -e[options['sort']])[:options['limit']]:
+            self.stdout.write("%9.1fms %9.1fms  %-8s %s (from %s)" % (
+                entry[options['sort']] * 1000, entry[other] * 1000, entry['phase'],
+                entry['module'], entry['by']))
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from south.utils import datetime_utils as datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        # Adding model 'LeaderboardEntry'
+        db.create_table('leaderboard', (
+            (u'id', self.gf('django.db.models.fields.AutoField')(primary_key=True)),
+            ('week', self.gf('django.db.models.fields.DateField')()),
+            ('game', self.gf('django.db.models.fields.related.ForeignKey')(to=orm['games.Game'])),
+            ('owned', self.gf('django.db.models.fields.BooleanField')(default=False)),
+            ('votes', self.gf('django.db.models.fields.IntegerField')(default=0)),
+        ))
+        db.send_create_signal(u'games', ['LeaderboardEntry'])
+
+        # Adding unique constraint on 'LeaderboardEntry', fields ['week', 'game']
+        db.create_unique('leaderboard', ['week', 'game_id'])
+
+        # Adding index on 'LeaderboardEntry', fields ['week', 'owned', 'votes']
+        db.create_index('leaderboard', ['week', 'owned', 'votes'])
+
+
+    def backwards(self, orm):
+        # Removing index on 'LeaderboardEntry', fields ['week', 'owned', 'votes']
+        db.delete_index('leaderboard', ['week', 'owned', 'votes'])
+
+        # Removing unique constraint on 'LeaderboardEntry', fields ['week', 'game']
+        db.delete_unique('leaderboard', ['week', 'game_id'])
+
+        # Deleting model 'LeaderboardEntry'
+        db.delete_table('leaderboard')
+
+
+    models = {
+        u'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': u"orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        u'auth.permission': {
+            'Meta': {'ordering': "(u'content_type__app_label', u'content_type__model', u'codename')", 'unique_together': "((u'content_type', u'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['contenttypes.ContentType']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        u'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Group']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'symmetrical': 'False', 'related_name': "u'user_set'", 'blank': 'True', 'to': u"orm['auth.Permission']"}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        u'contenttypes.contenttype': {
+            'Meta': {'ordering': "('name',)", 'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        u'games.game': {
+            'Meta': {'ordering': "['-created']", 'object_name': 'Game', 'db_table': "'games'"},
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime(2026, 10, 18, 0, 0)'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'image': ('django.db.models.fields.files.ImageField', [], {'max_length': '100', 'null': 'True', 'blank': 'True'}),
+            'owned': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'title': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '255'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'games.leaderboardentry': {
+            'Meta': {'unique_together': "(('week', 'game'),)", 'object_name': 'LeaderboardEntry', 'db_table': "'leaderboard'", 'index_together': "[['week', 'owned', 'votes']]"},
+            'game': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['games.Game']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'owned': ('django.db.models.fields.BooleanField', [], {'default': 'False'}),
+            'votes': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            'week': ('django.db.models.fields.DateField', [], {})
+        },
+        u'games.rating': {
+            'Meta': {'object_name': 'Rating', 'db_table': "'rating'"},
+            'game': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['games.Game']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'rating': ('django.db.models.fields.CharField', [], {'max_length': '1'})
+        },
+        u'games.useractivitylog': {
+            'Meta': {'object_name': 'UserActivityLog', 'db_table': "'user_activity'"},
+            'action': ('django.db.models.fields.CharField', [], {'max_length': '16'}),
+            'created': ('django.db.models.fields.DateTimeField', [], {}),
+            'game': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['games.Game']"}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'user': ('django.db.models.fields.related.ForeignKey', [], {'to': u"orm['auth.User']"})
+        },
+        u'games.vote': {
+            'Meta': {'object_name': 'Vote', 'db_table': "'votes'"},
+            'created': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'game': ('django.db.models.fields.related.OneToOneField', [], {'to': u"orm['games.Game']", 'unique': 'True'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'settled': ('django.db.models.fields.IntegerField', [], {'default': '0', 'db_column': "'count'"})
+        },
+        u'games.voteshard': {
+            'Meta': {'unique_together': "(('vote', 'shard'),)", 'object_name': 'VoteShard', 'db_table': "'vote_shards'"},
+            'count': ('django.db.models.fields.IntegerField', [], {'default': '0'}),
+            u'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'shard': ('django.db.models.fields.PositiveSmallIntegerField', [], {}),
+            'vote': ('django.db.models.fields.related.ForeignKey', [], {'related_name': "'shards'", 'to': u"orm['games.Vote']"})
+        }
+    }
+
+    complete_apps = ['games']
\ No newline at end of file
@@ -2,19 +2,66 @@
     Game and Vote Models
 """
 import logging
-from django.db import models
-from django.db.models.signals import post_save
-from django.core.exceptions import ObjectDoesNotExist
+import random
+import re
+from django.core.cache import cache
+from django.db import models, transaction, IntegrityError
+from django.db.models import F, Q, Sum
+from django.db.models.signals import pre_save, post_save, post_delete, post_init
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.contrib.auth.models import User as Auth_User
-from datetime import datetime
-import pytz
+from datetime import datetime, date, timedelta, tzinfo
 from django.conf import settings
-from django.utils.timezone import activate
-activate(settings.TIME_ZONE)
-TIMEZONE = pytz.timezone(settings.TIME_ZONE)
- 
+from django.utils import timezone
+from games import eligibility, versions
+
 _log = logging.getLogger(__name__)
 
+
+class LocalTimezone(tzinfo):
+    '''
+        settings.TIME_ZONE, read from the zone file on first use
+        rather than when a worker imports the models; works with
+        datetime.now(tz=), astimezone() and pytz's localize()
+    '''
+    @staticmethod
+    def zone():
+        return timezone.get_default_timezone()
+
+    def fromutc(self, dt):
+        zone = self.zone()
+        return zone.fromutc(dt.replace(tzinfo=zone))
+
+    def utcoffset(self, dt):
+        return self.zone().localize(dt.replace(tzinfo=None)).utcoffset()
+
+    def dst(self, dt):
+        return self.zone().localize(dt.replace(tzinfo=None)).dst()
+
+    def tzname(self, dt):
+        return self.zone().localize(dt.replace(tzinfo=None)).tzname()
+
+    def __getattr__(self, name):
+        # localize, normalize, zone
+        return getattr(self.zone(), name)
+
+TIMEZONE = LocalTimezone()
+
+
+def voting_week(when=None):
+    ''' monday (local date) of the voting week containing @when '''
+    if when is None:
+        when = datetime.now(tz=TIMEZONE)
+    local = when.astimezone(TIMEZONE)
+    return local.date() - timedelta(days=local.weekday())
+
+
+_punctuation = re.compile(r'[\W_]+', re.UNICODE)
+
+def normalize_title(title):
+    ''' lower case, punctuation and runs of whitespace become one space '''
+    return _punctuation.sub(u' ', unicode(title).lower()).strip()
+
 class Game(models.Model):
     '''
         Game class
@@ -22,6 +69,8 @@ class Game(models.Model):
         owned: is title owned by nerdery
         gamer ; user the added game
         created: datetime of object
+        title_key: normalize_title(title), unique; look titles up by this
+        image_hash: sha1 of image once its resized variants exist (games.thumbnails)
 
         class method
             _is_owned(Game, @title) : 
@@ -29,10 +78,12 @@ class Game(models.Model):
     '''     
        
     title = models.CharField(max_length=255, unique=True)
+    title_key = models.CharField(max_length=255, unique=True, null=True, editable=False)
     owned = models.BooleanField(default=False)
     user = models.ForeignKey(Auth_User)
-    image = models.ImageField(upload_to='nat/media', height_field=450, width_field=600, null=True, blank=True)
-    created = models.DateTimeField(default=datetime.now(tz=TIMEZONE), blank=False)
+    image = models.ImageField(upload_to='nat/media', null=True, blank=True)
+    image_hash = models.CharField(max_length=40, blank=True, default='', editable=False)
+    created = models.DateTimeField(default=timezone.now, blank=False)
 
     def __unicode__(self):
         return self.title
@@ -42,27 +93,81 @@ class Game(models.Model):
         db_table = 'games'
         ordering = ["-created"]
 
+    def clean(self):
+        """ title_key is unique: refuse a title another game has up to case and punctuation """
+        key = normalize_title(self.title or '')
+        if not key:
+            raise ValidationError({'title': ["Title needs a letter or a digit"]})
+        other = Game.matching(self.title).exclude(pk=self.pk).first()
+        if other is not None:
+            raise ValidationError({'title': ["%s already exists" % other.title]})
+
+
+    @classmethod
+    def matching(cls, title):
+        """
+            games with title up to case, spacing and punctuation;
+            a game left without a key (a duplicate backfill_title_keys
+            has not merged yet) matches its own title, ignoring case
+        """
+        return cls.objects.filter(Q(title_key=normalize_title(title)) |
+            Q(title_key=None, title__iexact=unicode(title).strip()))
 
     @classmethod
     def is_added(cls, title):
-        """ case insentive search for title """
-        obj = cls.objects.filter(title__iexact=title)
-        if obj:
-            return True
-        else:
-            return False
+        """ case, space and punctuation insensitive search for title """
+        return cls.matching(title).exists()
+
+    @classmethod
+    def by_title(cls, title):
+        """ the game with this title (normalized), or DoesNotExist """
+        games = sorted(cls.matching(title), key=lambda game: game.title_key is None)
+        if not games:
+            raise cls.DoesNotExist("No game titled %r" % title)
+        return games[0]
+
+
+def set_title_key(sender, instance, **kwargs):
+    ''' keep title_key in step with title, fixtures included '''
+    instance.title_key = normalize_title(instance.title)
+
+pre_save.connect(set_title_key, sender=Game)
+
+def _image_name(game):
+    # the raw attribute: a str until the descriptor wraps it in a FieldFile
+    image = game.__dict__.get('image')
+    return getattr(image, 'name', image) or None
+
+def remember_image(sender, instance, **kwargs):
+    instance._saved_image = _image_name(instance)
+
+def image_changed(sender, instance, **kwargs):
+    ''' variants of the old image no longer apply '''
+    if _image_name(instance) != getattr(instance, '_saved_image', None):
+        instance.image_hash = ''
+
+def make_thumbnails(sender, instance, raw=False, **kwargs):
+    ''' hand a new image to the thumbnail pool '''
+    if instance.image and not instance.image_hash and not raw:
+        from games import thumbnails
+        thumbnails.generate(instance)
+    instance._saved_image = _image_name(instance)
+
+post_init.connect(remember_image, sender=Game)
+pre_save.connect(image_changed, sender=Game)
+post_save.connect(make_thumbnails, sender=Game)
 
 class Vote(models.Model):
     '''
         Vote class
         game: reference to associated Game object 
-        user: reference to associated django.models.User object
-        count: votes per user per game
+        settled: votes counted before sharding (the old count column)
+        count: settled plus the sum of the VoteShard rows, cached
         created: datetime vote was created
         method vote: increment vote count
     '''
     game = models.OneToOneField(Game)
-    count = models.IntegerField(default=0)
+    settled = models.IntegerField(default=0, db_column='count')
     created = models.DateTimeField(default=datetime.now, blank=False)
 
     class Meta:
@@ -72,15 +177,101 @@ class Vote(models.Model):
     def __unicode__(self):
         return "%s, %s" % ( self.game, self.count )
 
+    @property
+    def count(self):
+        ''' total votes, summed over the shards and cached '''
+        key = self._count_key(self.pk)
+        count = cache.get(key)
+        if count is None:
+            count = self.settled + (
+                self.shards.aggregate(total=Sum('count'))['total'] or 0)
+            cache.set(key, count, getattr(settings, 'VOTE_COUNT_CACHE_TIMEOUT', 60))
+        return count
+
+    @staticmethod
+    def _count_key(pk):
+        return 'games.vote.count.%s' % pk
+
+    def add(self, votes=1):
+        ''' atomically add @votes to one randomly picked shard '''
+        shard = random.randrange(getattr(settings, 'VOTE_COUNTER_SHARDS', 8))
+        rows = VoteShard.objects.filter(vote=self, shard=shard).update(
+            count=F('count') + votes)
+        if not rows:
+            try:
+                with transaction.atomic():
+                    VoteShard.objects.create(vote=self, shard=shard, count=votes)
+            except IntegrityError:
+                VoteShard.objects.filter(vote=self, shard=shard).update(
+                    count=F('count') + votes)
+        cache.delete(self._count_key(self.pk))
+        versions.bump(versions.VOTES)
+
+    @classmethod
+    def counts(cls, game_ids=None):
+        ''' {game id : total votes} in two queries, skipping the cache '''
+        votes = cls.objects.all()
+        shards = VoteShard.objects.all()
+        if game_ids is not None:
+            votes = votes.filter(game__in=game_ids)
+            shards = shards.filter(vote__game__in=game_ids)
+        totals = dict(votes.values_list('game_id', 'settled'))
+        for row in shards.values('vote__game_id').annotate(total=Sum('count')):
+            game_id = row['vote__game_id']
+            totals[game_id] = totals.get(game_id, 0) + row['total']
+        return totals
+
     @classmethod
-    def increment_count(cls, title):
+    def increment_count(cls, title, votes=1):
         ''' orm classes with classmethods, blech '''
         # if object does not exist, let the chips fall where they may
-        vote = cls.objects.get(game__title=title)
-        vote.count += 1
-        vote.save()
+        game = Game.by_title(title)
+        vote = cls.objects.get(game=game)
+        vote.game = game
+        vote.add(votes)
+        from games import tally
+        VoteDelta.objects.create(game=vote.game, votes=votes)
+        tally.settle()
         return vote
 
+
+class VoteShard(models.Model):
+    '''
+        One of VOTE_COUNTER_SHARDS counters per Vote
+        writers bump a random shard with UPDATE ... count = count + 1
+        so concurrent votes for the same game rarely share a row lock
+    '''
+    vote = models.ForeignKey(Vote, related_name='shards')
+    shard = models.PositiveSmallIntegerField()
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'vote_shards'
+        unique_together = (('vote', 'shard'),)
+
+    def __unicode__(self):
+        return "%s, %s, %s" % (self.vote_id, self.shard, self.count)
+
+
+class VoteDelta(models.Model):
+    '''
+        Votes not yet folded into the leaderboard and rollups
+        a vote appends one row instead of updating the game's
+        shared leaderboard / hourly / daily rows; games.tally
+        folds pending rows in batches, one update per row touched
+        created: when the votes were cast, for the weekly board and
+            the rollups; None for the all time board only
+    '''
+    game = models.ForeignKey(Game)
+    created = models.DateTimeField(null=True)
+    votes = models.IntegerField(default=1)
+
+    class Meta:
+        db_table = 'vote_deltas'
+
+    def __unicode__(self):
+        return "%s, %s, %s" % (self.game_id, self.created, self.votes)
+
     
 def create_new_vote(sender, instance, created, **kwargs):  
     ''' listen for signal to create vote ''' 
@@ -90,6 +281,12 @@ def create_new_vote(sender, instance, created, **kwargs):
 ''' nab signal '''
 post_save.connect(create_new_vote, sender=Game) 
 
+def votes_changed(sender, instance, **kwargs):
+    ''' vote rows removed, cached vote totals are stale '''
+    versions.bump(versions.VOTES)
+
+post_delete.connect(votes_changed, sender=Vote)
+
 
 class UserActivityLog(models.Model):
     '''
@@ -104,6 +301,9 @@ class UserActivityLog(models.Model):
 
     class Meta:
         db_table = 'user_activity'
+        # last_acted / my_votes filter on user, AllVotes on action,
+        # all of them order by created
+        index_together = [['user', 'created'], ['action', 'created']]
 
     def __unicode__(self):
         return "%s, %s, %s" % ( self.user, self.action, self.created ) 
@@ -116,12 +316,11 @@ class UserActivityLog(models.Model):
         except ObjectDoesNotExist:
             raise("failed to create user from name %s" % username)
         try:
-            ual = cls.objects.filter(user=user_obj).order_by('created')[:1].get()
+            ual = cls.objects.filter(user=user_obj).order_by('-created')[:1].get()
         except ObjectDoesNotExist:
             return None
         else:
-            _log.debug("last_acted: %s" % ual)
-            _log.debug("last_acted in this timezone: %s" % ual.created.astimezone(tz=TIMEZONE))
+            _log.debug("last_acted: %s %s", username, ual.created)
             # that is utc time
             # we need localtime
             return ual.created.astimezone(tz=TIMEZONE)
@@ -138,18 +337,188 @@ class UserActivityLog(models.Model):
             datetime stamp set in current tz
         '''
         now = datetime.now(tz=TIMEZONE)
-        _log.debug("what time is it? : %s " % now)
-        _log.debug("in what time zone? : %s " % TIMEZONE)
+        if isinstance(username, Auth_User):
+            # request.user, already resolved
+            user_obj = username
+        else:
+            try:
+                user_obj = Auth_User.objects.get(username=username)
+            except ObjectDoesNotExist:
+                raise("failed to create user from name %s" % username)
+
+        game = Game.by_title(game_title)
+        cls.objects.create(user=user_obj, created=now, action=action, game=game)
+        _log.debug("log user action : %s, %s, %s, %s", user_obj.username, action, game.title, now)
+        eligibility.record(user_obj.username, now)
+        if action == 'voted':
+            from games import tally
+            VoteDelta.objects.create(game=game, created=now)
+            tally.settle()
+
+    @classmethod
+    def log_user_actions(cls, actions):
+        '''
+            bulk log_user_action
+            @actions: (user, action, game, created) tuples
+            one INSERT per batch for the log and one for the vote deltas;
+            the caller runs tally.settle() once its transaction commits
+        '''
+        cls.objects.bulk_create([
+            cls(user=user, action=action, game=game, created=created)
+            for user, action, game, created in actions])
+        for user, action, game, created in actions:
+            eligibility.record(user.username, created)
+        VoteDelta.objects.bulk_create([VoteDelta(game=game, created=created)
+            for user, action, game, created in actions if action == 'voted'])
+
+
+
+class LeaderboardEntry(models.Model):
+    '''
+        Materialized vote totals
+        week: monday of the voting week, or ALL_TIME
+        owned: copy of game.owned so boards filter without a join
+        votes: votes cast for game in that week
+        votes land as VoteDelta rows, folded in by games.tally
+        rebuild with manage.py rebuild_leaderboard
+    '''
+    # a thursday, so it never collides with a real (monday) voting week
+    ALL_TIME = date(1970, 1, 1)
+
+    week = models.DateField()
+    game = models.ForeignKey(Game)
+    owned = models.BooleanField(default=False)
+    votes = models.IntegerField(default=0)
+
+    class Meta:
+        db_table = 'leaderboard'
+        unique_together = (('week', 'game'),)
+        index_together = [['week', 'owned', 'votes']]
+
+    def __unicode__(self):
+        return "%s, %s, %s" % (self.week, self.game, self.votes)
+
+    @classmethod
+    def record(cls, game, week, votes=1):
+        ''' add @votes to game's row for week, creating it on first vote '''
+        rows = cls.objects.filter(week=week, game=game).update(votes=F('votes') + votes)
+        if rows:
+            return
         try:
-            user_obj = Auth_User.objects.get(username=username)
-        except ObjectDoesNotExist:
-            raise("failed to create user from name %s" % username)
+            with transaction.atomic():
+                cls.objects.create(week=week, game=game, owned=game.owned, votes=votes)
+        except IntegrityError:
+            # another worker created the row first
+            cls.objects.filter(week=week, game=game).update(votes=F('votes') + votes)
 
-        ual = cls.objects.create(user=user_obj, created=now, action=action, game=Game.objects.get(title=game_title))
-        _log.debug("log user action : %s" %  ual )
-        ual.save()
+    @classmethod
+    def top(cls, week, owned=None, limit=None):
+        ''' top @limit games for week, most votes first '''
+        if limit is None:
+            limit = getattr(settings, 'LEADERBOARD_SIZE', 50)
+        qs = cls.objects.filter(week=week, votes__gt=0)
+        if owned is not None:
+            qs = qs.filter(owned=owned)
+        return qs.select_related('game').order_by('-votes', 'game')[:limit]
 
 
+class VoteRollup(models.Model):
+    '''
+        Votes cast for a game in one time bucket, folded in
+        from VoteDelta rows by games.tally; games.rollups sums
+        them for date range queries
+        rebuild with manage.py rebuild_vote_rollups
+    '''
+    start = models.DateTimeField()
+    game = models.ForeignKey(Game)
+    votes = models.IntegerField(default=0)
+
+    class Meta:
+        abstract = True
+        unique_together = (('start', 'game'),)
+
+    def __unicode__(self):
+        return "%s, %s, %s" % (self.start, self.game_id, self.votes)
+
+    @classmethod
+    def record(cls, game, when, votes=1):
+        ''' add @votes to game's bucket holding @when '''
+        start = cls.bucket(when)
+        rows = cls.objects.filter(start=start, game=game).update(votes=F('votes') + votes)
+        if rows:
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.create(start=start, game=game, votes=votes)
+        except IntegrityError:
+            # another worker created the row first
+            cls.objects.filter(start=start, game=game).update(votes=F('votes') + votes)
+
+    @classmethod
+    def totals(cls, start, end):
+        ''' {game id : votes} over the buckets starting in [start, end) '''
+        return dict(cls.objects.filter(start__gte=start, start__lt=end).values_list(
+            'game').annotate(Sum('votes')).order_by())
+
+
+class HourlyVotes(VoteRollup):
+    class Meta(VoteRollup.Meta):
+        db_table = 'votes_hourly'
+
+    @staticmethod
+    def bucket(when):
+        ''' start of the hour holding @when '''
+        return when.astimezone(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+class DailyVotes(VoteRollup):
+    class Meta(VoteRollup.Meta):
+        db_table = 'votes_daily'
+
+    @staticmethod
+    def bucket(when):
+        ''' local midnight starting the day holding @when '''
+        day = when.astimezone(TIMEZONE).date()
+        return TIMEZONE.localize(datetime.combine(day, datetime.min.time()))
+
+
+def sync_leaderboard_owned(sender, instance, created, **kwargs):
+    ''' keep leaderboard ownership in step with the game '''
+    if not created:
+        LeaderboardEntry.objects.filter(game=instance).exclude(
+            owned=instance.owned).update(owned=instance.owned)
+
+post_save.connect(sync_leaderboard_owned, sender=Game)
+
+
+class TitleTrigram(models.Model):
+    '''
+        Character trigram postings for Game.title
+        maintained by games.fuzzy on game save / delete
+    '''
+    gram = models.CharField(max_length=3, db_index=True)
+    game = models.ForeignKey(Game, related_name='trigrams')
+
+    class Meta:
+        db_table = 'title_trigrams'
+        unique_together = (('gram', 'game'),)
+
+    def __unicode__(self):
+        return "%s, %s" % (self.gram, self.game_id)
+
+
+def index_title(sender, instance, **kwargs):
+    ''' keep the fuzzy title index current '''
+    from games import fuzzy
+    fuzzy.game_saved(instance)
+
+def unindex_title(sender, instance, **kwargs):
+    from games import fuzzy
+    fuzzy.game_deleted(instance)
+
+post_save.connect(index_title, sender=Game)
+post_delete.connect(unindex_title, sender=Game)
+
 
 class Rating(models.Model):
     RATING_STARS = (
@@ -160,11 +529,123 @@ class Rating(models.Model):
         ('5', 'five stars'),
     )
     game = models.ForeignKey(Game)
+    user = models.ForeignKey(Auth_User, null=True, blank=True)
     rating = models.CharField(max_length=1, choices=RATING_STARS)
 
     class Meta:
         db_table = 'rating'
+        unique_together = (('game', 'user'),)
     
     def __unicode__(self):
         return "%s, %s" % (self.game, self.rating )
 
+    @classmethod
+    def rate(cls, game, user, stars):
+        '''
+            user gives game 1-5 stars, replacing
+            their earlier rating of it; the game's
+            RatingAggregate changes in the same transaction
+        '''
+        stars = int(stars)
+        with transaction.atomic():
+            try:
+                old = cls.objects.select_for_update().get(game=game, user=user)
+            except ObjectDoesNotExist:
+                try:
+                    with transaction.atomic():
+                        cls.objects.create(game=game, user=user, rating=str(stars))
+                except IntegrityError:
+                    # the same user's first rating committed just now (two tabs)
+                    old = cls.objects.select_for_update().get(game=game, user=user)
+                else:
+                    RatingAggregate.add(game, stars)
+                    old = None
+            if old is not None:
+                if int(old.rating) == stars:
+                    return
+                cls.objects.filter(pk=old.pk).update(rating=str(stars))
+                RatingAggregate.add(game, stars, replaces=int(old.rating))
+        versions.bump(versions.RATINGS)
+
+
+class RatingAggregate(models.Model):
+    '''
+        Rating count, star total and 1-5 histogram per game,
+        kept current by Rating.rate so lists show the average
+        without reading the rating rows
+    '''
+    game = models.OneToOneField(Game, primary_key=True, related_name='rating_summary')
+    count = models.PositiveIntegerField(default=0)
+    total = models.PositiveIntegerField(default=0)
+    stars_1 = models.PositiveIntegerField(default=0)
+    stars_2 = models.PositiveIntegerField(default=0)
+    stars_3 = models.PositiveIntegerField(default=0)
+    stars_4 = models.PositiveIntegerField(default=0)
+    stars_5 = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        db_table = 'rating_aggregate'
+
+    def __unicode__(self):
+        return "%s, %s, %s" % (self.game_id, self.count, self.average)
+
+    @property
+    def average(self):
+        if not self.count:
+            return None
+        return float(self.total) / self.count
+
+    @property
+    def histogram(self):
+        ''' [one star count, ..., five star count] '''
+        return [getattr(self, 'stars_%d' % n) for n in range(1, 6)]
+
+    @classmethod
+    def add(cls, game, stars, replaces=None):
+        ''' count a new rating, or move one from @replaces stars to @stars '''
+        column = 'stars_%d' % stars
+        changes = {column: F(column) + 1}
+        if replaces is None:
+            changes.update(count=F('count') + 1, total=F('total') + stars)
+        else:
+            old = 'stars_%d' % replaces
+            changes.update(total=F('total') + (stars - replaces), **{old: F(old) - 1})
+        if cls.objects.filter(game=game).update(**changes):
+            return
+        # first rating of this game
+        try:
+            with transaction.atomic():
+                cls.objects.create(game=game, count=1, total=stars, **{column: 1})
+        except IntegrityError:
+            cls.objects.filter(game=game).update(**changes)
+
+
+
+class IngestMark(models.Model):
+    '''
+        Newest queue row applied from one vote queue file,
+        written in the same transaction as the votes so a
+        replayed batch (crash before the queue delete) is skipped
+        queue: the queue file's random id, so a recreated file
+        (ids restarting at 1) starts a fresh mark
+    '''
+    queue = models.CharField(max_length=32, primary_key=True)
+    last_id = models.BigIntegerField(default=0)
+
+    class Meta:
+        db_table = 'ingest_marks'
+
+    def __unicode__(self):
+        return "%s, %s" % (self.queue, self.last_id)
+
+    @classmethod
+    def applied(cls, queue):
+        ''' id of the newest row from @queue already applied, 0 if none '''
+        return cls.objects.filter(queue=queue).values_list('last_id', flat=True).first() or 0
+
+    @classmethod
+    def advance(cls, queue, last_id):
+        ''' rows of @queue up to @last_id are applied (call inside the vote transaction) '''
+        if cls.objects.filter(queue=queue).update(last_id=last_id):
+            return
+        cls.objects.create(queue=queue, last_id=last_id)
@@ -0,0 +1,92 @@
+"""
+    Keyset (cursor) pagination on (created, id)
+
+    pages are fetched with WHERE (created, id) > cursor ... LIMIT n+1,
+    so page 10,000 costs the same as page 1 and a request never holds
+    more than one page of rows.  Cursors are opaque urlsafe tokens.
+"""
+import base64
+import json
+from datetime import datetime
+
+import pytz
+from django.db.models import Q
+from django.http import Http404
+
+_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(obj, direction):
+    ''' token for the page after (next) or before (prev) @obj '''
+    key = [obj.created.astimezone(pytz.utc).strftime(_FORMAT), obj.pk, direction]
+    return base64.urlsafe_b64encode(json.dumps(key)).rstrip('=')
+
+
+def decode_cursor(token):
+    ''' token -> (created, id, direction), 404 on anything malformed '''
+    try:
+        padded = str(token) + '=' * (-len(token) % 4)
+        created, pk, direction = json.loads(base64.urlsafe_b64decode(padded))
+        created = datetime.strptime(created, _FORMAT).replace(tzinfo=pytz.utc)
+        if direction not in ('next', 'prev'):
+            raise ValueError(direction)
+        return created, int(pk), direction
+    except (TypeError, ValueError, UnicodeError):
+        raise Http404("bad page cursor")
+
+
+class KeysetPage(object):
+    ''' one page of rows plus the tokens either side of it '''
+    def __init__(self, object_list, next_token=None, prev_token=None):
+        self.object_list = object_list
+        self.next_token = next_token
+        self.prev_token = prev_token
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_token is not None
+
+    def has_previous(self):
+        return self.prev_token is not None
+
+
+def _after(created, pk, descending):
+    if descending:
+        return Q(created__lt=created) | Q(created=created, pk__lt=pk)
+    return Q(created__gt=created) | Q(created=created, pk__gt=pk)
+
+
+def paginate(queryset, token, per_page, descending=False):
+    '''
+        page of @queryset ordered by (created, id), newest first
+        when @descending; @token comes from a previous page
+    '''
+    order = ('-created', '-pk') if descending else ('created', 'pk')
+    reverse = ('created', 'pk') if descending else ('-created', '-pk')
+    direction = 'next'
+    if token:
+        created, pk, direction = decode_cursor(token)
+        if direction == 'next':
+            queryset = queryset.filter(_after(created, pk, descending))
+        else:
+            queryset = queryset.filter(_after(created, pk, not descending))
+
+    if direction == 'next':
+        rows = list(queryset.order_by(*order)[:per_page + 1])
+        has_next, has_prev = len(rows) > per_page, bool(token)
+        rows = rows[:per_page]
+    else:
+        rows = list(queryset.order_by(*reverse)[:per_page + 1])
+        has_next, has_prev = True, len(rows) > per_page
+        rows = rows[:per_page][::-1]
+
+    if not rows:
+        return KeysetPage(rows)
+    return KeysetPage(rows,
+        next_token=encode_cursor(rows[-1], 'next') if has_next else None,
+        prev_token=encode_cursor(rows[0], 'prev') if has_prev else None)
@@ -0,0 +1,64 @@
+"""
+    Vote totals for an arbitrary time range
+
+    [start, end) is split into whole local days (DailyVotes), the
+    whole hours either side of them (HourlyVotes), and at most an
+    hour of raw activity at each ragged end, read through the
+    (action, created) index.  A range of any length costs at most
+    three bucket queries and two short activity scans.
+"""
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count
+
+from games.models import Game, UserActivityLog, HourlyVotes, DailyVotes
+
+HOUR = timedelta(hours=1)
+
+
+def _ceil(bucket, when, step):
+    start = bucket(when)
+    return start if start == when else bucket(start + step)
+
+
+def _raw(start, end):
+    return dict(UserActivityLog.objects.filter(action='voted',
+        created__gte=start, created__lt=end).values_list(
+        'game').annotate(Count('id')).order_by())
+
+
+def votes_between(start, end):
+    ''' {game id : votes cast in [start, end)} '''
+    totals = defaultdict(int)
+    if start >= end:
+        return totals
+    first_hour, last_hour = _ceil(HourlyVotes.bucket, start, HOUR), HourlyVotes.bucket(end)
+    if first_hour >= last_hour:
+        parts = [_raw(start, end)]
+    else:
+        parts = [_raw(start, first_hour), _raw(last_hour, end)]
+        # days are local, so they may be 23 or 25 hours long
+        first_day = _ceil(DailyVotes.bucket, first_hour, timedelta(hours=25))
+        last_day = DailyVotes.bucket(last_hour)
+        if first_day < last_day:
+            parts.append(HourlyVotes.totals(first_hour, first_day))
+            parts.append(DailyVotes.totals(first_day, last_day))
+            parts.append(HourlyVotes.totals(last_day, last_hour))
+        else:
+            parts.append(HourlyVotes.totals(first_hour, last_hour))
+    for part in parts:
+        for game_id, votes in part.items():
+            totals[game_id] += votes
+    return totals
+
+
+def top(start, end, limit=None):
+    ''' [(game, votes)] most voted in [start, end), most votes first '''
+    if limit is None:
+        limit = getattr(settings, 'LEADERBOARD_SIZE', 50)
+    totals = votes_between(start, end)
+    best = sorted(totals.items(), key=lambda item: (-item[1], item[0]))[:limit]
+    games = Game.objects.in_bulk([game_id for game_id, votes in best])
+    return [(games[game_id], votes) for game_id, votes in best if game_id in games]
@@ -0,0 +1,373 @@
+"""
+    Binary snapshots of the voting state
+
+    manage.py snapshot writes users (those referenced by games, votes,
+    activity or ratings), games, vote totals, the activity log and
+    ratings to one file; manage.py restore loads it back.  Each table
+    is read in id order CHUNK_SIZE rows at a time, and each chunk is
+    stored column by column: integers and times delta encoded as
+    int64, strings as int64 lengths plus UTF-8 bytes, every column zlib
+    compressed on its own.  Sorted ids and times compress to almost
+    nothing, and the loader inserts each decoded chunk with one COPY
+    (PostgreSQL) or executemany, without building model instances.
+
+    file: MAGIC, then blocks of
+        4 byte big endian header length, JSON header
+            {"table": name, "rows": n, "columns": [[name, kind, [part lengths]]]}
+        the columns' compressed parts (values, then a null mask if any)
+
+    Derived tables (vote shards, leaderboard, rollups, trigrams, rating
+    aggregates, the eligibility store) are not stored; restore rebuilds
+    them.  Vote totals are restored as settled counts with no shards.
+    The whole file is read in one repeatable read transaction, so the
+    tables agree with each other however long the write takes.
+    Users are merged one by one: a stored user updates the current one
+    with the same id; a current user with the same username but another
+    id hands its rows over to the stored user and is deleted; every
+    other account (staff who never voted, say) is left alone.
+"""
+import json
+import struct
+import zlib
+from array import array
+from cStringIO import StringIO
+from calendar import timegm
+from datetime import datetime, timedelta
+from itertools import chain, izip
+
+from django.contrib.auth.models import User
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
+
+from games import fuzzy
+from games.models import Game, Vote, UserActivityLog, Rating, RatingAggregate, TitleTrigram
+
+MAGIC = 'NATSNAP\x01'
+
+CHUNK_SIZE = 50000
+
+# ids per IN (...) list, under SQLite's 999 variable limit
+IN_SIZE = 400
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+# (name, model, (field attname, kind)), in foreign key order
+TABLES = (
+    ('users', User, (
+        ('id', 'int'), ('username', 'str'), ('password', 'str'),
+        ('first_name', 'str'), ('last_name', 'str'), ('email', 'str'),
+        ('is_staff', 'bool'), ('is_active', 'bool'), ('is_superuser', 'bool'),
+        ('last_login', 'time'), ('date_joined', 'time'))),
+    ('games', Game, (
+        ('id', 'int'), ('title', 'str'), ('title_key', 'str'), ('owned', 'bool'),
+        ('user_id', 'int'), ('image', 'str'), ('image_hash', 'str'), ('created', 'time'))),
+    ('votes', Vote, (
+        ('id', 'int'), ('game_id', 'int'), ('settled', 'int'), ('created', 'time'))),
+    ('activity', UserActivityLog, (
+        ('id', 'int'), ('user_id', 'int'), ('game_id', 'int'),
+        ('action', 'str'), ('created', 'time'))),
+    ('ratings', Rating, (
+        ('id', 'int'), ('game_id', 'int'), ('user_id', 'int'), ('rating', 'str'))),
+)
+
+MODELS = dict((name, (model, columns)) for name, model, columns in TABLES)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def _int64s(values):
+    return struct.pack('<%dq' % len(values), *values)
+
+
+def _from_int64s(raw):
+    return struct.unpack('<%dq' % (len(raw) // 8), raw)
+
+
+def _deltas(values):
+    return [b - a for a, b in izip(chain((0,), values), values)]
+
+
+def _running(deltas):
+    total, out = 0, []
+    for delta in deltas:
+        total += delta
+        out.append(total)
+    return out
+
+
+def _micros(when):
+    return timegm(when.utctimetuple()) * 1000000 + when.microsecond
+
+
+def encode(kind, values):
+    ''' compressed parts of one column '''
+    nulls = [v is None for v in values]
+    if kind == 'str':
+        encoded = ['' if v is None else v.encode('utf-8') for v in values]
+        parts = [_int64s([len(v) for v in encoded]), ''.join(encoded)]
+    elif kind == 'bool':
+        parts = [array('b', [1 if v else 0 for v in values]).tostring()]
+    elif kind == 'time':
+        parts = [_int64s(_deltas([0 if v is None else _micros(v) for v in values]))]
+    else:
+        parts = [_int64s(_deltas([v or 0 for v in values]))]
+    if any(nulls):
+        parts.append(array('b', nulls).tostring())
+    return [zlib.compress(part, 6) for part in parts]
+
+
+def decode(kind, parts, rows):
+    ''' values of one column from its compressed parts '''
+    parts = [zlib.decompress(part) for part in parts]
+    if kind == 'str':
+        text, pos, values = parts[1], 0, []
+        for length in _from_int64s(parts[0]):
+            values.append(text[pos:pos + length].decode('utf-8'))
+            pos += length
+        nulls = parts[2:]
+    elif kind == 'bool':
+        values = [bool(v) for v in array('b', parts[0])]
+        nulls = parts[1:]
+    elif kind == 'time':
+        values = [EPOCH + timedelta(microseconds=v) for v in _running(_from_int64s(parts[0]))]
+        nulls = parts[1:]
+    else:
+        values = _running(_from_int64s(parts[0]))
+        nulls = parts[1:]
+    if len(values) != rows:
+        raise SnapshotError("column has %d values, expected %d" % (len(values), rows))
+    if nulls:
+        values = [None if null else v for v, null in izip(values, array('b', nulls[0]))]
+    return values
+
+
+def _chunks(qs, fields, chunk_size):
+    ''' id ordered values_list chunks, WHERE id > last LIMIT n '''
+    qs = qs.order_by('id').values_list(*fields)
+    last = 0
+    while True:
+        chunk = list(qs.filter(id__gt=last)[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            return
+        last = chunk[-1][0]
+
+
+def _rows(name, chunk_size):
+    model, columns = MODELS[name]
+    fields = [field for field, kind in columns]
+    if name == 'users':
+        referenced = set(Game.objects.values_list('user_id', flat=True))
+        referenced.update(UserActivityLog.objects.values_list('user_id', flat=True).distinct())
+        referenced.update(Rating.objects.exclude(user=None).values_list(
+            'user_id', flat=True).distinct())
+        for chunk in _chunks(model.objects.all(), fields, chunk_size):
+            yield [row for row in chunk if row[0] in referenced]
+    elif name == 'votes':
+        # shards folded into the settled count
+        for chunk in _chunks(model.objects.all(), fields, chunk_size):
+            totals = {}
+            for i in range(0, len(chunk), IN_SIZE):
+                totals.update(Vote.counts([row[1] for row in chunk[i:i + IN_SIZE]]))
+            yield [(pk, game_id, totals.get(game_id, settled), created)
+                   for pk, game_id, settled, created in chunk]
+    else:
+        for chunk in _chunks(model.objects.all(), fields, chunk_size):
+            yield chunk
+
+
+def write(out, chunk_size=CHUNK_SIZE, progress=None):
+    ''' snapshot every table to the file @out; {table : rows} '''
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost and connection.vendor in ('postgresql', 'mysql'):
+            # first statement of the transaction: every later read sees the same data
+            # (SQLite holds its read lock from the first SELECT to the end anyway)
+            connection.cursor().execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        return _write(out, chunk_size, progress)
+
+
+def _write(out, chunk_size, progress):
+    out.write(MAGIC)
+    written = {}
+    for name, model, columns in TABLES:
+        written[name] = 0
+        for chunk in _rows(name, chunk_size):
+            if not chunk:
+                continue
+            header = {'table': name, 'rows': len(chunk), 'columns': []}
+            body = []
+            for (field, kind), values in izip(columns, izip(*chunk)):
+                parts = encode(kind, values)
+                header['columns'].append([field, kind, [len(part) for part in parts]])
+                body.extend(parts)
+            header = json.dumps(header)
+            out.write(struct.pack('>I', len(header)))
+            out.write(header)
+            for part in body:
+                out.write(part)
+            written[name] += len(chunk)
+            if progress:
+                progress(name, written[name])
+    return written
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise SnapshotError("snapshot is truncated")
+    return data
+
+
+def read(stream):
+    ''' (table, field names, rows) for each block of the file @stream '''
+    if stream.read(len(MAGIC)) != MAGIC:
+        raise SnapshotError("not a snapshot file")
+    while True:
+        size = stream.read(4)
+        if not size:
+            return
+        if len(size) != 4:
+            raise SnapshotError("snapshot is truncated")
+        header = json.loads(_read_exactly(stream, struct.unpack('>I', size)[0]))
+        if header['table'] not in MODELS:
+            raise SnapshotError("unknown table %r" % header['table'])
+        fields, columns = [], []
+        for field, kind, lengths in header['columns']:
+            parts = [_read_exactly(stream, length) for length in lengths]
+            fields.append(field)
+            columns.append(decode(kind, parts, header['rows']))
+        yield header['table'], fields, zip(*columns)
+
+
+def _copy_value(value):
+    ''' one field of COPY's text format '''
+    if value is None:
+        return '\\N'
+    if value is True or value is False:
+        return 't' if value else 'f'
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, basestring):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace(
+            '\n', '\\n').replace('\r', '\\r').encode('utf-8')
+    return str(value)
+
+
+def insert(name, fields, rows):
+    ''' decoded @rows into table @name: one COPY on PostgreSQL, else one executemany '''
+    model, columns = MODELS[name]
+    qn = connection.ops.quote_name
+    column = dict((field.attname, field.column) for field in model._meta.fields)
+    table = qn(model._meta.db_table)
+    db_columns = ', '.join(qn(column[field]) for field in fields)
+    cursor = connection.cursor()
+    if connection.vendor == 'postgresql':
+        data = StringIO('\n'.join('\t'.join(_copy_value(v) for v in row) for row in rows) + '\n')
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table, db_columns), data)
+        return
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (table, db_columns, ', '.join(['%s'] * len(fields)))
+    cursor.executemany(sql, rows)
+
+
+def merge_users(fields, rows):
+    '''
+        write stored user @rows over the current users: same id is updated
+        in place, new ids are inserted, and a current user holding a stored
+        username under another id is merged into the stored user (every
+        row pointing at it is moved over) and only its auth_user row deleted
+    '''
+    pk, username = fields.index('id'), fields.index('username')
+    stored = dict((row[username], row[pk]) for row in rows)
+    existing, clashes = set(), {}
+    for i in range(0, len(rows), IN_SIZE // 2):
+        chunk = rows[i:i + IN_SIZE // 2]
+        for user_id, name in User.objects.filter(Q(id__in=[row[pk] for row in chunk])
+                | Q(username__in=[row[username] for row in chunk])).values_list('id', 'username'):
+            if name in stored and stored[name] != user_id:
+                clashes[user_id] = stored[name]
+            if user_id in stored.values():
+                existing.add(user_id)
+
+    # free the usernames first: stored users may swap names
+    for user_id in clashes:
+        User.objects.filter(pk=user_id).update(username='~restore-%d' % user_id)
+    updates = [row for row in rows if row[pk] in existing]
+    for row in updates:
+        User.objects.filter(pk=row[pk]).update(**dict((field, value)
+            for field, value in izip(fields, row) if field != 'id'))
+    insert('users', fields, [row for row in rows if row[pk] not in existing])
+
+    merged = dict((old, new) for old, new in clashes.items() if old not in existing)
+    if not merged:
+        return
+    for related in User._meta.get_all_related_objects(include_hidden=True):
+        for old, new in merged.items():
+            related.model._base_manager.filter(**{related.field.name: old}).update(
+                **{related.field.name: new})
+    qn = connection.ops.quote_name
+    connection.cursor().execute('DELETE FROM %s WHERE %s IN (%s)' % (
+        qn(User._meta.db_table), qn(User._meta.pk.column), ', '.join(['%s'] * len(merged))),
+        list(merged))
+
+
+def load(stream, progress=None):
+    ''' insert every block of @stream; {table : rows} '''
+    loaded = dict((name, 0) for name in MODELS)
+    for name, fields, rows in read(stream):
+        if name == 'users':
+            merge_users(fields, rows)
+        else:
+            insert(name, fields, rows)
+        loaded[name] += len(rows)
+        if progress:
+            progress(name, loaded[name])
+    # rows came with their ids: move the sequences past them
+    cursor = connection.cursor()
+    for sql in connection.ops.sequence_reset_sql(no_style(), [model for model, columns in MODELS.values()]):
+        cursor.execute(sql)
+    return loaded
+
+
+def occupied():
+    ''' snapshot tables, users aside, that already hold rows '''
+    return [name for name, model, columns in TABLES
+        if model is not User and model.objects.exists()]
+
+
+def clear():
+    ''' empty the snapshot tables but users, and the tables derived from them '''
+    from games.models import VoteShard, VoteDelta, LeaderboardEntry, HourlyVotes, DailyVotes
+    cursor = connection.cursor()
+    for model in (RatingAggregate, Rating, UserActivityLog, HourlyVotes, DailyVotes,
+                  LeaderboardEntry, VoteDelta, TitleTrigram, VoteShard, Vote, Game):
+        cursor.execute('DELETE FROM %s' % connection.ops.quote_name(model._meta.db_table))
+
+
+def rebuild_ratings():
+    ''' RatingAggregate rows from the rating rows '''
+    aggregates = {}
+    for row in Rating.objects.values('game_id', 'rating').annotate(n=Count('id')).iterator():
+        stars = int(row['rating'])
+        aggregate = aggregates.setdefault(row['game_id'], RatingAggregate(game_id=row['game_id']))
+        aggregate.count += row['n']
+        aggregate.total += stars * row['n']
+        setattr(aggregate, 'stars_%d' % stars, row['n'])
+    RatingAggregate.objects.bulk_create(aggregates.values(), batch_size=500)
+
+
+def rebuild_trigrams(chunk_size=CHUNK_SIZE):
+    ''' TitleTrigram rows for every game, a chunk of games per executemany '''
+    qn = connection.ops.quote_name
+    sql = 'INSERT INTO %s (%s, %s) VALUES (%%s, %%s)' % (qn(TitleTrigram._meta.db_table),
+        qn(TitleTrigram._meta.get_field('gram').column),
+        qn(TitleTrigram._meta.get_field('game').column))
+    cursor = connection.cursor()
+    for chunk in _chunks(Game.objects.all(), ('id', 'title'), chunk_size):
+        cursor.executemany(sql, [(gram, pk) for pk, title in chunk
+            for gram in fuzzy.trigrams(title)])
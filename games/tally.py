@@ -0,0 +1,126 @@
+"""
+    Deferred leaderboard and rollup writes
+
+    every vote for a game used to update the same leaderboard row
+    (all time and this week) and the same hourly / daily rollup rows,
+    so concurrent votes for a popular game queued on those row locks.
+    Votes now append VoteDelta rows (insert only, no shared row) and
+    fold() sums a batch of them into one update per row touched.
+    With VOTE_FOLD_INTERVAL seconds > 0 a background thread folds
+    every interval; 0 folds as soon as a vote is logged.
+    manage.py fold_votes folds whatever is pending.
+"""
+import logging
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from games import live, versions
+from games.models import Game, VoteDelta, LeaderboardEntry, HourlyVotes, DailyVotes
+from games.models import voting_week
+
+_log = logging.getLogger(__name__)
+
+FOLD_SIZE = 400
+
+
+class Claimed(Exception):
+    ''' another folder took some of the batch first '''
+
+
+def fold(limit=FOLD_SIZE):
+    '''
+        fold up to @limit pending deltas, oldest first, into the
+        leaderboard and rollups; return how many were folded
+        the batch is claimed by deleting it, so two folders never
+        count the same delta: whoever deletes fewer rows than it
+        read rolls back and leaves the batch to the other
+    '''
+    try:
+        with transaction.atomic():
+            deltas = list(VoteDelta.objects.order_by('id').values_list(
+                'id', 'game_id', 'created', 'votes')[:limit])
+            if not deltas:
+                return 0
+            ids = [d[0] for d in deltas]
+            cursor = connection.cursor()
+            cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (
+                connection.ops.quote_name(VoteDelta._meta.db_table),
+                ', '.join(['%s'] * len(ids))), ids)
+            if cursor.rowcount != len(ids):
+                raise Claimed
+
+            weekly = defaultdict(int)
+            hourly = defaultdict(int)
+            daily = defaultdict(int)
+            for pk, game_id, created, votes in deltas:
+                if created is None:
+                    weekly[(LeaderboardEntry.ALL_TIME, game_id)] += votes
+                    continue
+                weekly[(voting_week(created), game_id)] += votes
+                hourly[(HourlyVotes.bucket(created), game_id)] += votes
+                daily[(DailyVotes.bucket(created), game_id)] += votes
+            games = Game.objects.in_bulk(set(d[1] for d in deltas))
+            for (week, game_id), votes in weekly.items():
+                if game_id in games:
+                    LeaderboardEntry.record(games[game_id], week, votes)
+            for rollup, buckets in ((HourlyVotes, hourly), (DailyVotes, daily)):
+                for (start, game_id), votes in buckets.items():
+                    if game_id in games:
+                        rollup.record(games[game_id], start, votes)
+    except Claimed:
+        return 0
+    versions.bump(versions.VOTES)
+    live.changed(games.keys())
+    return len(deltas)
+
+
+def fold_all(limit=FOLD_SIZE):
+    ''' fold until nothing is pending, return the number of deltas '''
+    total = 0
+    while True:
+        folded = fold(limit)
+        total += folded
+        if not folded and not VoteDelta.objects.exists():
+            return total
+
+
+class Folder(threading.Thread):
+    ''' background thread that folds pending deltas every interval '''
+    daemon = True
+
+    def __init__(self, interval):
+        super(Folder, self).__init__(name='vote-folder')
+        self.interval = interval
+        self.wake = threading.Event()
+
+    def run(self):
+        while True:
+            try:
+                while fold() == FOLD_SIZE:
+                    pass
+            except Exception:
+                _log.exception("vote fold failed, retrying next interval")
+            self.wake.wait(self.interval)
+            self.wake.clear()
+
+
+_folder = None
+_lock = threading.Lock()
+
+def settle():
+    '''
+        after logging votes: fold them now (VOTE_FOLD_INTERVAL 0),
+        or make sure this process' folder is running
+    '''
+    global _folder
+    interval = getattr(settings, 'VOTE_FOLD_INTERVAL', 1.0)
+    if not interval:
+        fold_all()
+        return
+    with _lock:
+        if _folder is None or not _folder.is_alive():
+            _folder = Folder(interval)
+            _folder.start()
@@ -0,0 +1,11 @@
+""" {{ game|thumbnail:"small" }} or {{ game|thumbnail:250 }} -> variant URL """
+from django import template
+
+from games import thumbnails
+
+register = template.Library()
+
+
+@register.filter
+def thumbnail(game, size=None):
+    return thumbnails.url(game, size)
@@ -1,10 +1,24 @@
 #from django.test import TestCase
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 
+import json
+import logging
+import os
+import sys
+import tempfile
 import unittest
+from StringIO import StringIO
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.core.management.base import CommandError
+from django.core.exceptions import ValidationError
 from django.test import Client
+from django.test.utils import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection
 from django.test.client import RequestFactory
-from django.contrib.auth.models import User
+from django.contrib.auth.models import User, AnonymousUser
 from datetime import datetime, timedelta, date
 import pytz
 
@@ -14,11 +28,21 @@ activate(settings.TIME_ZONE)
 
 # Create your tests here.
 from games.models import Game, Vote, UserActivityLog
-from games.views import login, games, main
-from games.views import vote_index, top_votes, \
+from games.models import LeaderboardEntry, VoteShard, VoteDelta, TitleTrigram, voting_week
+from games.models import Rating, RatingAggregate, HourlyVotes, DailyVotes
+from games.models import normalize_title, TIMEZONE
+from django.db import IntegrityError
+from django.http import Http404
+from games.views import login, games, main, AllVotes, export_activity, rate_game
+from games.views import vote_index, top_votes, vote_range, \
     game_vote, game_add
 
-from games.forms import GameAddForm, GameVoteForm, VoteCountForm
+from games import api, benchmarks, eligibility, export, fuzzy, ingest, logqueue, rollups
+from games import live, snapshot, tally, thumbnails, versions
+from games.localdb import to_epoch
+from games.pagination import paginate
+from games.forms import GameAddForm, GameChoices, GameVoteForm, VoteCountForm
+from nat import importtime, metrics
 
 class MockDateTime(datetime):
     @classmethod
@@ -35,6 +59,8 @@ class GamesTests(TestCase):
     fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
     ''' boilerplate test case '''
     def setUp(self):
+        cache.clear()
+        eligibility.reset()
         self.factory = RequestFactory()
         self.user= User.objects.get(username="alee")
 
@@ -231,3 +257,1466 @@ class GamesTests(TestCase):
 
     
 
+class LeaderboardTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        self.factory = RequestFactory()
+
+    def _vote(self, username, game):
+        request = self.factory.get('/games/vote/game_id/%d/' % game.id)
+        request.user = User.objects.get(username=username)
+        return game_vote(request, game_id=game.id)
+
+    def test_vote_updates_weekly_board(self):
+        game = Game.objects.get(title="Arctic Thunder")
+        self._vote("rich", game)
+        self._vote("john", game)
+        week = LeaderboardEntry.objects.get(week=voting_week(), game=game)
+        self.assertEqual(week.votes, 2)
+        alltime = LeaderboardEntry.objects.get(week=LeaderboardEntry.ALL_TIME, game=game)
+        self.assertEqual(alltime.votes, 2)
+
+    def test_top_votes_ordered(self):
+        first = Game.objects.get(title="Arctic Thunder")
+        second = Game.objects.get(title="AMF Bowling 2004")
+        self._vote("rich", second)
+        self._vote("john", first)
+        self._vote("mary", first)
+        response = top_votes(self.factory.get('/games/top_votes/'))
+        content = response.content
+        self.assertTrue(content.index(first.title) < content.index(second.title))
+
+    def test_owned_game_leaves_unowned_board(self):
+        game = Game.objects.get(title="Arctic Thunder")
+        self._vote("rich", game)
+        game.owned = True
+        game.save()
+        board = LeaderboardEntry.top(voting_week(), owned=False)
+        self.assertFalse([e for e in board if e.game_id == game.id])
+
+    def test_rebuild_command(self):
+        game = Game.objects.get(title="Arctic Thunder")
+        self._vote("rich", game)
+        LeaderboardEntry.objects.all().delete()
+        call_command('rebuild_leaderboard', stdout=StringIO())
+        self.assertEqual(
+            LeaderboardEntry.objects.get(week=voting_week(), game=game).votes, 1)
+        self.assertEqual(
+            LeaderboardEntry.objects.get(week=LeaderboardEntry.ALL_TIME, game=game).votes, 1)
+
+    def test_votes_only_append_until_folded(self):
+        # concurrent votes for one game must not queue on its leaderboard or
+        # rollup rows: a vote only bumps a random shard and inserts deltas
+        game = Game.objects.get(title="Arctic Thunder")
+        shared = [LeaderboardEntry._meta.db_table, HourlyVotes._meta.db_table,
+                  DailyVotes._meta.db_table]
+        settle = tally.settle
+        tally.settle = lambda: None
+        try:
+            with CaptureQueriesContext(connection) as captured:
+                for username in ("rich", "john", "mary"):
+                    self._vote(username, game)
+        finally:
+            tally.settle = settle
+        writes = [q['sql'] for q in captured.captured_queries
+                  if q['sql'].startswith(('UPDATE', 'INSERT'))]
+        self.assertFalse([sql for sql in writes if any(t in sql for t in shared)])
+        self.assertFalse(LeaderboardEntry.objects.filter(game=game).exists())
+        self.assertEqual(VoteDelta.objects.filter(game=game).count(), 6)
+
+        self.assertEqual(tally.fold(), 6)
+        self.assertFalse(VoteDelta.objects.exists())
+        self.assertEqual(LeaderboardEntry.objects.get(week=voting_week(), game=game).votes, 3)
+        self.assertEqual(
+            LeaderboardEntry.objects.get(week=LeaderboardEntry.ALL_TIME, game=game).votes, 3)
+        self.assertEqual(sum(HourlyVotes.objects.filter(game=game).values_list(
+            'votes', flat=True)), 3)
+        self.assertEqual(sum(DailyVotes.objects.filter(game=game).values_list(
+            'votes', flat=True)), 3)
+
+    def test_fold_skips_a_claimed_batch(self):
+        game = Game.objects.get(title="Arctic Thunder")
+        VoteDelta.objects.create(game=game, votes=2)
+        # another folder deletes the batch between our read and our claim
+        original = VoteDelta.objects.order_by
+        def read_then_lose(*args):
+            rows = list(original(*args).values_list('id', 'game_id', 'created', 'votes'))
+            VoteDelta.objects.all().delete()
+            return FakeRows(rows)
+        class FakeRows(list):
+            def values_list(self, *fields):
+                return self
+        VoteDelta.objects.order_by = read_then_lose
+        try:
+            self.assertEqual(tally.fold(), 0)
+        finally:
+            del VoteDelta.objects.order_by
+        self.assertFalse(LeaderboardEntry.objects.filter(game=game).exists())
+
+
+class VoteCounterTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        self.game = Game.objects.get(title="Arctic Thunder")
+
+    def test_increments_spread_over_shards(self):
+        for i in range(20):
+            Vote.increment_count(self.game.title)
+        vote = Vote.objects.get(game=self.game)
+        self.assertEqual(vote.count, 20)
+        shards = VoteShard.objects.filter(vote=vote)
+        self.assertTrue(shards.count() <= settings.VOTE_COUNTER_SHARDS)
+        self.assertEqual(sum(s.count for s in shards), 20)
+
+    def test_settled_count_is_kept(self):
+        vote = Vote.objects.get(game=self.game)
+        vote.settled = 5
+        vote.save()
+        Vote.increment_count(self.game.title)
+        self.assertEqual(Vote.objects.get(game=self.game).count, 6)
+        self.assertEqual(Vote.counts([self.game.id]), {self.game.id: 6})
+
+    def test_count_is_cached(self):
+        Vote.increment_count(self.game.title)
+        vote = Vote.objects.get(game=self.game)
+        self.assertEqual(vote.count, 1)
+        with self.assertNumQueries(0):
+            self.assertEqual(vote.count, 1)
+
+
+class BufferedIngestTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        self.factory = RequestFactory()
+        fd, self.path = tempfile.mkstemp(suffix='.sqlite3')
+        os.close(fd)
+        self.settings = override_settings(VOTE_INGEST='buffered',
+            VOTE_QUEUE_PATH=self.path, VOTE_QUEUE_FLUSH_INTERVAL=0)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        os.remove(self.path)
+
+    def _vote(self, username, game):
+        request = self.factory.get('/games/vote/game_id/%d/' % game.id)
+        request.user = User.objects.get(username=username)
+        return game_vote(request, game_id=game.id)
+
+    def test_vote_is_queued_then_flushed(self):
+        game = Game.objects.get(title="Arctic Thunder")
+        response = self._vote("rich", game)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue("now has 1 votes" in response.content)
+        self.assertEqual(Vote.objects.get(game=game).count, 0)
+        self.assertEqual(ingest.get_queue().pending_for_game(game.id), 1)
+
+        self.assertEqual(ingest.flush(), 1)
+        cache.clear()
+        eligibility.reset()
+        self.assertEqual(Vote.objects.get(game=game).count, 1)
+        self.assertEqual(UserActivityLog.objects.filter(
+            game=game, action='voted').count(), 1)
+        self.assertEqual(LeaderboardEntry.objects.get(
+            week=voting_week(), game=game).votes, 1)
+        self.assertEqual(len(ingest.get_queue()), 0)
+
+    def test_queued_vote_blocks_second_vote(self):
+        self._vote("john", Game.objects.get(title="Arctic Thunder"))
+        response = self._vote("john", Game.objects.get(title="AMF Bowling 2004"))
+        self.assertNotEqual(response.status_code, 200)
+
+    def test_failed_flush_keeps_queue(self):
+        game = Game.objects.get(title="Arctic Thunder")
+        self._vote("mary", game)
+        def boom(queue, entries):
+            raise RuntimeError("database went away")
+        self.assertRaises(RuntimeError, ingest.get_queue().drain, boom, 10)
+        self.assertEqual(len(ingest.get_queue()), 1)
+
+    def test_replayed_batch_is_not_counted_twice(self):
+        game = Game.objects.get(title="Arctic Thunder")
+        self._vote("mary", game)
+        def crash(queue, entries):
+            # votes commit, then the worker dies before the queue delete
+            ingest.apply_votes(queue, entries)
+            raise RuntimeError("killed")
+        self.assertRaises(RuntimeError, ingest.get_queue().drain, crash, 10)
+        self.assertEqual(len(ingest.get_queue()), 1)
+        self.assertEqual(ingest.flush(), 1)
+        cache.clear()
+        self.assertEqual(Vote.objects.get(game=game).count, 1)
+        self.assertEqual(UserActivityLog.objects.filter(
+            game=game, action='voted').count(), 1)
+        self.assertEqual(len(ingest.get_queue()), 0)
+
+
+class EligibilityTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        eligibility.reset()
+        self.game = Game.objects.get(title="Arctic Thunder")
+
+    def test_no_queries_once_stored(self):
+        self.assertTrue(eligibility.can_act("tom"))
+        with self.assertNumQueries(0):
+            self.assertTrue(eligibility.can_act("tom"))
+
+    def test_vote_blocks_rest_of_day(self):
+        UserActivityLog.log_user_action("tom", "voted", self.game.title)
+        with self.assertNumQueries(0):
+            self.assertFalse(eligibility.can_act("tom"))
+
+    def test_last_acted_is_newest(self):
+        user = User.objects.get(username="tom")
+        tz = pytz.timezone(settings.TIME_ZONE)
+        old = datetime.now(tz) - timedelta(days=30)
+        UserActivityLog.objects.create(user=user, action='voted', game=self.game, created=old)
+        UserActivityLog.log_user_action("tom", "voted", self.game.title)
+        self.assertTrue(UserActivityLog.last_acted("tom") > old)
+
+    def test_day_rules(self):
+        tz = pytz.timezone(settings.TIME_ZONE)
+        monday = tz.localize(datetime(2014, 3, 24, 12))
+        day = eligibility.Day(to_epoch(monday))
+        self.assertFalse(day.weekend)
+        self.assertFalse(eligibility.allowed(to_epoch(monday - timedelta(hours=11)), day))
+        self.assertTrue(eligibility.allowed(to_epoch(monday - timedelta(hours=13)), day))
+        self.assertTrue(eligibility.allowed(eligibility.NEVER, day))
+        saturday = eligibility.Day(to_epoch(monday + timedelta(days=5)))
+        self.assertTrue(saturday.weekend)
+        self.assertFalse(eligibility.allowed(to_epoch(monday), saturday))
+
+    def test_rebuild_from_activity_log(self):
+        UserActivityLog.log_user_action("tom", "voted", self.game.title)
+        eligibility.reset()
+        call_command('rebuild_eligibility', stdout=StringIO())
+        with self.assertNumQueries(0):
+            self.assertFalse(eligibility.can_act("tom"))
+
+
+class ActivityIndexTests(TestCase):
+
+    def test_explain_activity(self):
+        out = StringIO()
+        call_command('explain_activity', rows=200, users=5, games=5, stdout=out)
+        self.assertTrue("== without indexes" in out.getvalue())
+        self.assertEqual(UserActivityLog.objects.count(), 0)
+
+
+class KeysetPaginationTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = User.objects.get(username="tom")
+        game = Game.objects.get(title="Arctic Thunder")
+        start = datetime.now(pytz.timezone(settings.TIME_ZONE)) - timedelta(days=10)
+        # two rows share a timestamp so the id tiebreak matters
+        for i in (0, 1, 2, 2, 3, 4, 5):
+            UserActivityLog.objects.create(user=self.user, game=game,
+                action='voted', created=start + timedelta(days=i))
+        self.qs = UserActivityLog.objects.filter(user=self.user)
+
+    def _walk(self, descending):
+        seen, token = [], None
+        while True:
+            page = paginate(self.qs, token, 3, descending=descending)
+            seen.extend(row.pk for row in page)
+            if not page.has_next():
+                return seen, page
+            token = page.next_token
+
+    def test_forward_walk_sees_every_row_once(self):
+        seen, last = self._walk(False)
+        expected = list(self.qs.order_by('created', 'pk').values_list('pk', flat=True))
+        self.assertEqual(seen, expected)
+        seen, last = self._walk(True)
+        self.assertEqual(seen, expected[::-1])
+
+    def test_previous_page(self):
+        first = paginate(self.qs, None, 3)
+        second = paginate(self.qs, first.next_token, 3)
+        back = paginate(self.qs, second.prev_token, 3)
+        self.assertEqual([r.pk for r in back], [r.pk for r in first])
+        self.assertFalse(back.has_previous())
+        self.assertFalse(first.has_previous())
+
+    def test_bad_cursor_404(self):
+        self.assertRaises(Http404, paginate, self.qs, 'not-a-cursor', 3)
+
+    def test_all_votes_view_pages(self):
+        view = AllVotes.as_view(paginate_by=3)
+        response = view(self.factory.get('/games/all_votes/'))
+        response.render()
+        self.assertEqual(len(response.context_data['activity']), 3)
+        self.assertTrue('?cursor=' in response.content)
+
+
+class ExportTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        game = Game.objects.get(title="Arctic Thunder")
+        tz = pytz.timezone(settings.TIME_ZONE)
+        for i, name in enumerate(("tom", "jim", "sam", "bob", "jen")):
+            UserActivityLog.objects.create(user=User.objects.get(username=name),
+                game=game, action='voted' if i else 'added',
+                created=tz.localize(datetime(2014, 3, 3 + i, 12)))
+
+    def test_chunks_cover_every_row(self):
+        rows = list(export.activity_rows(chunk_size=2))
+        self.assertEqual([r[0] for r in rows],
+            list(UserActivityLog.objects.order_by('id').values_list('id', flat=True)))
+        self.assertEqual(rows[0][4], u"tom")
+
+    def test_filters(self):
+        filters = export.parse_filters('2014-03-04', '2014-03-05', 'voted')
+        self.assertEqual([r[4] for r in export.activity_rows(**filters)], [u"jim", u"sam"])
+
+    def test_streaming_view(self):
+        request = self.factory.get('/games/export/ndjson/', {'action': 'added'})
+        request.user = User.objects.get(username="alee")
+        response = export_activity(request, fmt='ndjson')
+        self.assertTrue(response.streaming)
+        lines = "".join(response.streaming_content).splitlines()
+        self.assertEqual(len(lines), 1)
+        self.assertEqual(json.loads(lines[0])['username'], "tom")
+
+    def test_csv_command(self):
+        out = StringIO()
+        call_command('export_activity', format='csv', stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[0], ",".join(export.COLUMNS))
+        self.assertEqual(len(lines), 6)
+
+
+class FuzzyTitleTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        self.factory = RequestFactory()
+        self.user = User.objects.get(username="tim")
+
+    def test_trigrams(self):
+        self.assertEqual(fuzzy.trigrams("Cat"), set(["  c", " ca", "cat", "at "]))
+
+    def test_near_duplicates_ranked(self):
+        matches = fuzzy.similar("artic thunder", limit=3, threshold=0.3)
+        self.assertEqual(matches[0].title, "Arctic Thunder")
+        self.assertTrue(matches[0].similarity < 1)
+        self.assertEqual(fuzzy.similar("zzqx"), [])
+
+    def test_index_follows_save_and_delete(self):
+        game = Game.objects.create(title="Halo Combat Evolved", user=self.user)
+        self.assertEqual(fuzzy.similar("halo combat evolved")[0].id, game.id)
+        game.title = "Fable"
+        game.save()
+        self.assertEqual(fuzzy.similar("halo combat evolved"), [])
+        game.delete()
+        self.assertEqual(fuzzy.similar("fable"), [])
+        self.assertFalse(TitleTrigram.objects.filter(game_id=game.id).exists())
+
+    def test_search_waits_for_writers(self):
+        import threading
+        index = fuzzy.TrigramIndex()
+        game = Game.objects.get(title="Arctic Thunder")
+        index.add(game, fuzzy.trigrams(game.title))
+        found = []
+        reader = threading.Thread(target=lambda: found.extend(
+            index.search("arctic thunder", 5, 0.5)))
+        with index.lock:
+            reader.start()
+            reader.join(0.1)
+            self.assertTrue(reader.is_alive())
+            index.discard(game.pk)
+        reader.join()
+        self.assertEqual(found, [])
+
+    def _add(self, data):
+        request = self.factory.post('/games/add/', data)
+        request.user = self.user
+        return game_add(request)
+
+    def test_add_same_key_votes(self):
+        response = self._add({'title': 'arctic thunder!'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Game.objects.filter(title__icontains="arctic").count(), 1)
+        self.assertEqual(Vote.objects.get(game__title="Arctic Thunder").count, 1)
+
+    def test_add_near_duplicate_suggests(self):
+        game = Game.objects.get(title="AMF Bowling 2004")
+        response = self._add({'title': 'AMF Bowling 2005'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue("Did you mean" in response.content)
+        self.assertTrue("/games/vote/game_id/%d/" % game.id in response.content)
+        self.assertFalse(Game.objects.filter(title="AMF Bowling 2005").exists())
+        self.assertEqual(Vote.objects.get(game=game).count, 0)
+
+        response = self._add({'title': 'AMF Bowling 2005', 'confirmed': 'True'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Game.objects.filter(title="AMF Bowling 2005").exists())
+        self.assertEqual(Vote.objects.get(game=game).count, 0)
+
+
+class TitleKeyTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        self.factory = RequestFactory()
+
+    def test_normalize(self):
+        self.assertEqual(normalize_title(u"  Halo:  Combat_Evolved!! "), u"halo combat evolved")
+
+    def test_key_set_on_save_and_fixture_load(self):
+        self.assertEqual(Game.objects.get(title="Arctic Thunder").title_key, u"arctic thunder")
+        self.assertTrue(Game.is_added("ARCTIC   thunder."))
+        self.assertFalse(Game.is_added("Arctic"))
+
+    def test_case_variant_duplicate_rejected(self):
+        user = User.objects.get(username="tim")
+        self.assertRaises(IntegrityError, Game.objects.create,
+            title="arctic THUNDER", user=user)
+
+    def test_increment_by_variant_title(self):
+        vote = Vote.increment_count("arctic-thunder")
+        self.assertEqual(vote.game.title, "Arctic Thunder")
+
+    def test_add_variant_counts_as_vote(self):
+        request = self.factory.post('/games/add/', {'title': ' AMF bowling, 2004 '})
+        request.user = User.objects.get(username="sam")
+        response = game_add(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Vote.objects.get(game__title="AMF Bowling 2004").count, 1)
+
+    def test_clean_rejects_key_of_another_game(self):
+        user = User.objects.get(username="tim")
+        game = Game(title="arctic THUNDER", user=user)
+        self.assertRaises(ValidationError, game.full_clean)
+        Game.objects.get(title="Arctic Thunder").full_clean()
+
+    def test_unkeyed_game_found_by_title(self):
+        # rows saved before title_key existed, until they are backfilled
+        Game.objects.filter(title="Arctic Thunder").update(title_key=None)
+        self.assertTrue(Game.is_added("arctic thunder"))
+        self.assertEqual(Game.by_title("ARCTIC THUNDER").title, "Arctic Thunder")
+        vote = Vote.increment_count("Arctic Thunder")
+        self.assertEqual(vote.count, 1)
+        user = User.objects.get(username="tim")
+        self.assertRaises(ValidationError, Game(title="arctic thunder", user=user).full_clean)
+
+    def test_backfill_command(self):
+        Game.objects.update(title_key=None)
+        call_command('backfill_title_keys', batch_size=5, stdout=StringIO())
+        self.assertFalse(Game.objects.filter(title_key=None).exists())
+
+    def _duplicate(self):
+        keeper = Game.objects.get(title="Arctic Thunder")
+        Game.objects.filter(pk=keeper.pk).update(title_key=None)
+        duplicate = Game.objects.create(title="arctic-thunder", user=keeper.user)
+        Game.objects.filter(pk__in=[keeper.pk, duplicate.pk]).update(title_key=None)
+        return keeper, duplicate
+
+    def test_backfill_reports_duplicates(self):
+        keeper, duplicate = self._duplicate()
+        err = StringIO()
+        self.assertRaises(CommandError, call_command, 'backfill_title_keys',
+            stdout=StringIO(), stderr=err)
+        self.assertTrue("game %d" % duplicate.pk in err.getvalue())
+        self.assertTrue(Game.objects.filter(pk=duplicate.pk, title_key=None).exists())
+
+    def test_backfill_merges_duplicates(self):
+        keeper, duplicate = self._duplicate()
+        Vote.objects.get(game=keeper).add(1)
+        Vote.objects.get(game=duplicate).add(2)
+        UserActivityLog.objects.create(user=User.objects.get(username="tim"),
+            action='voted', game=duplicate, created=datetime.now(pytz.utc))
+        call_command('backfill_title_keys', merge=True, stdout=StringIO())
+        self.assertFalse(Game.objects.filter(pk=duplicate.pk).exists())
+        self.assertFalse(Game.objects.filter(title_key=None).exists())
+        self.assertEqual(Vote.counts([keeper.pk])[keeper.pk], 3)
+        self.assertEqual(UserActivityLog.objects.filter(game=keeper, action='voted').count(), 1)
+
+
+class VoteChoiceTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        self.game = Game.objects.get(title="Arctic Thunder")
+
+    def test_render_and_validate_without_queries(self):
+        GameVoteForm().as_p()
+        with self.assertNumQueries(0):
+            html = GameVoteForm().as_p()
+            form = GameVoteForm({'title': str(self.game.id)})
+            self.assertTrue(form.is_valid())
+        self.assertTrue('<option value="%d">Arctic Thunder</option>' % self.game.id in html)
+        self.assertEqual(form.cleaned_data['title'].title, "Arctic Thunder")
+
+    def test_game_missing_from_stale_choices_is_checked(self):
+        GameVoteForm().as_p()
+        game = Game.objects.create(title="Jade Empire", user=User.objects.get(username="tom"))
+        # another worker's choices, built before the game was added
+        stale = GameChoices._current
+        stale.titles.pop(game.id, None)
+        original = GameChoices.__dict__['get']
+        GameChoices.get = classmethod(lambda cls: stale)
+        try:
+            with self.assertNumQueries(1):
+                form = GameVoteForm({'title': str(game.id)})
+                self.assertTrue(form.is_valid())
+            self.assertEqual(form.cleaned_data['title'].title, "Jade Empire")
+            with self.assertNumQueries(1):
+                self.assertFalse(GameVoteForm({'title': '999999'}).is_valid())
+        finally:
+            GameChoices.get = original
+
+    def test_owned_game_drops_out(self):
+        GameVoteForm().as_p()
+        self.game.owned = True
+        self.game.save()
+        self.assertFalse(GameVoteForm({'title': str(self.game.id)}).is_valid())
+        self.assertFalse("Arctic Thunder" in GameVoteForm().as_p())
+
+    def test_bad_choice(self):
+        self.assertFalse(GameVoteForm({'title': 'nope'}).is_valid())
+        self.assertFalse(GameVoteForm({'title': '999999'}).is_valid())
+
+
+class SharedVersionTests(TestCase):
+    def test_bump_in_another_process_is_seen(self):
+        import subprocess
+        self.assertTrue(versions.shared())
+        before = versions.get(versions.CATALOG)
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='nat.settings',
+            CACHE_DIR=settings.CACHES['default']['LOCATION'],
+            PYTHONPATH=os.pathsep.join(filter(None, [os.getcwd(), os.environ.get('PYTHONPATH')])))
+        env.pop('MEMCACHED_LOCATION', None)
+        child = subprocess.Popen([sys.executable, '-c',
+            'from games import versions; print versions.bump(versions.CATALOG)'],
+            stdout=subprocess.PIPE, env=env)
+        bumped = int(child.communicate()[0])
+        self.assertEqual(child.returncode, 0)
+        self.assertNotEqual(bumped, before)
+        self.assertEqual(versions.get(versions.CATALOG), bumped)
+
+
+class GamesPageCacheTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        self.factory = RequestFactory()
+
+    def _page(self, user=None):
+        request = self.factory.get('/games/games/')
+        request.user = user or AnonymousUser()
+        return games(request)
+
+    def test_second_view_runs_no_queries(self):
+        self._page()
+        with self.assertNumQueries(0):
+            self._page()
+
+    def test_vote_links_only_for_users(self):
+        game = Game.objects.get(title="Arctic Thunder")
+        link = '/games/vote/game_id/%d/' % game.id
+        self.assertFalse(link in self._page().content)
+        self.assertTrue(link in self._page(User.objects.get(username="tom")).content)
+        self.assertFalse(link in self._page().content)
+
+    def test_signed_in_viewers_share_cached_rows(self):
+        tom = User.objects.get(username="tom")
+        self._page()
+        with self.assertNumQueries(0):
+            content = self._page(tom).content
+        game = Game.objects.get(title="Arctic Thunder")
+        self.assertTrue('/games/vote/game_id/%d/' % game.id in content)
+
+    def test_vote_refreshes_voted_section(self):
+        game = Game.objects.get(title="Arctic Thunder")
+        self.assertFalse("1  Votes" in self._page().content)
+        Vote.increment_count(game.title)
+        self.assertTrue("1  Votes" in self._page().content)
+
+    def test_owned_flip_refreshes_sections(self):
+        game = Game.objects.get(title="Arctic Thunder")
+        content = self._page().content
+        self.assertTrue(content.index("Arctic Thunder") > content.index("Added"))
+        game.owned = True
+        game.save()
+        content = self._page().content
+        self.assertTrue(content.index("Arctic Thunder") < content.index("Voted for"))
+
+
+class ImportGamesTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def _import(self, content, suffix, **options):
+        fd, path = tempfile.mkstemp(suffix=suffix)
+        os.write(fd, content)
+        os.close(fd)
+        out = StringIO()
+        try:
+            call_command('import_games', path, user='alee', stdout=out, **options)
+        finally:
+            os.remove(path)
+        return out.getvalue()
+
+    def test_csv_import_dedupes(self):
+        before = Game.objects.count()
+        out = self._import("title,owned\nHalo 2,1\nhalo 2!,0\nArctic Thunder,0\nFable,\n",
+            '.csv', batch_size=2)
+        self.assertEqual(Game.objects.count(), before + 2)
+        self.assertTrue(Game.objects.get(title="Halo 2").owned)
+        self.assertTrue("2 imported, 2 skipped" in out)
+        fable = Game.objects.get(title_key="fable")
+        self.assertEqual(Vote.objects.get(game=fable).count, 0)
+        self.assertTrue(TitleTrigram.objects.filter(game=fable).exists())
+
+    def test_json_formats(self):
+        loaddata = json.dumps([
+            {"model": "games.game", "pk": 900, "fields": {"title": "Jade Empire", "user": 2}},
+            {"model": "auth.user", "pk": 5, "fields": {"username": "x"}},
+        ])
+        self._import(loaddata, '.json', batch_size=1)
+        self.assertEqual(Game.objects.get(title="Jade Empire").user_id, 2)
+        lines = '{"title": "Ninja Gaiden"}\n{"title": "Crackdown", "user": "jim"}\n'
+        self._import(lines, '.json')
+        self.assertEqual(Game.objects.get(title="Crackdown").user.username, "jim")
+        self.assertTrue(Game.is_added("ninja gaiden"))
+
+
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+
+    def test_generate_and_bench(self):
+        user_ids, game_ids = benchmarks.generate(20, 10, 300, stdout=StringIO())
+        self.assertEqual((len(user_ids), len(game_ids)), (20, 10))
+        self.assertEqual(UserActivityLog.objects.count(), 300)
+        voted = UserActivityLog.objects.filter(action='voted').count()
+        self.assertEqual(sum(Vote.counts(game_ids).values()), voted)
+        # skewed: the first game is the most popular
+        top = LeaderboardEntry.top(LeaderboardEntry.ALL_TIME, limit=1)[0]
+        self.assertEqual(top.game_id, game_ids[0])
+
+        results = benchmarks.bench(2, user_ids, game_ids)
+        self.assertEqual(set(results), set(['games', 'vote_index', 'top_votes',
+            'AllVotes', 'my_votes', 'game_vote', 'game_add']))
+        for r in results.values():
+            self.assertEqual(r['status'], 200)
+            self.assertTrue(r['p50_ms'] <= r['p95_ms'] <= r['p99_ms'])
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual(benchmarks.percentile(values, 50), 50)
+        self.assertEqual(benchmarks.percentile(values, 99), 99)
+        self.assertEqual(benchmarks.percentile([3], 95), 3)
+
+
+class MetricsTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+
+    def test_histogram_exposition(self):
+        h = metrics.Histogram('t_seconds', 'Test.', (0.1, 1.0))
+        for value in (0.05, 0.5, 0.7, 3.0):
+            h.observe('v', value)
+        lines = h.exposition()
+        self.assertTrue('# TYPE t_seconds histogram' in lines)
+        self.assertTrue('t_seconds_bucket{view="v",le="0.1"} 1' in lines)
+        self.assertTrue('t_seconds_bucket{view="v",le="1.0"} 3' in lines)
+        self.assertTrue('t_seconds_bucket{view="v",le="+Inf"} 4' in lines)
+        self.assertTrue('t_seconds_count{view="v"} 4' in lines)
+
+    def _series(self, histogram, view):
+        return histogram.series.get(view, [[0], 0.0])
+
+    def test_middleware_records_view(self):
+        view = 'games.views.vote_index'
+        before = sum(self._series(metrics.REQUEST_SECONDS, view)[0])
+        sql_before = self._series(metrics.SQL_QUERIES, view)[1]
+        client = Client()
+        client.get('/games/vote_index/')
+        self.assertEqual(sum(self._series(metrics.REQUEST_SECONDS, view)[0]), before + 1)
+        self.assertTrue(self._series(metrics.SQL_QUERIES, view)[1] > sql_before)
+        self.assertTrue(self._series(metrics.TEMPLATE_SECONDS, view)[1] > 0)
+        self.assertTrue(self._series(metrics.RESPONSE_BYTES, view)[1] > 0)
+
+        response = client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertTrue('nat_request_seconds_count{view="%s"}' % view in response.content)
+        self.assertTrue('# TYPE nat_sql_seconds histogram' in response.content)
+
+    @override_settings(METRICS_ALLOWED_IPS=['10.0.0.5'], METRICS_TOKENS=['scrape-key'])
+    def test_endpoint_needs_allowed_address_or_token(self):
+        client = Client()
+        self.assertEqual(client.get('/metrics').status_code, 404)
+        self.assertEqual(client.get('/metrics',
+            HTTP_AUTHORIZATION='Bearer wrong-key').status_code, 404)
+        self.assertEqual(client.get('/metrics',
+            HTTP_AUTHORIZATION='Bearer scrape-key').status_code, 200)
+        self.assertEqual(client.get('/metrics', REMOTE_ADDR='10.0.0.5').status_code, 200)
+
+
+class LogQueueTests(TestCase):
+    def _handler(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        handler = logqueue.QueueHandler(path, batch_size=3)
+        handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        return handler, path
+
+    def _record(self, msg, *args, **kwargs):
+        return logging.LogRecord(kwargs.get('name', 'games.views'),
+            kwargs.get('level', logging.DEBUG), __file__, 1, msg, args, None)
+
+    def test_records_written_in_batches(self):
+        handler, path = self._handler()
+        for i in range(7):
+            handler.handle(self._record("vote %d by %s", i, u'b\xe9tty'))
+        handler.flush()
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 7)
+        self.assertEqual(lines[6], "DEBUG vote 6 by b\xc3\xa9tty")
+        # the writer restarts on the next record
+        handler.handle(self._record("after flush"))
+        handler.close()
+        with open(path) as f:
+            self.assertTrue(f.read().endswith("DEBUG after flush\n"))
+
+    def test_dropped_records_reported(self):
+        handler, path = self._handler()
+        handler.handle(self._record("first"))
+        with handler.drop_lock:
+            handler.dropped += 4
+        handler.handle(self._record("second"))
+        handler.flush()
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertTrue(lines[-1].startswith("WARNING log queue full: dropped 4 records"), lines)
+        self.assertEqual(handler.dropped, 0)
+        handler.close()
+
+    def test_objects_formatted_before_queueing(self):
+        handler, path = self._handler()
+        user = User(username='sam')
+        record = handler.prepare(self._record("user %s, count %d", user, 3))
+        self.assertEqual((record.msg, record.args), ("user sam, count 3", None))
+        record = handler.prepare(self._record("count %d", 3))
+        self.assertEqual(record.args, (3,))
+
+    def test_sampling(self):
+        sample = logqueue.SampleFilter({'': 1.0, 'games.views': 0.0, 'games.views.x': 0.5})
+        self.assertEqual(sample.rate('games.views.x.y'), 0.5)
+        self.assertEqual(sample.rate('django.request'), 1.0)
+        self.assertFalse(sample.filter(self._record("dropped")))
+        self.assertTrue(sample.filter(self._record("kept", level=logging.ERROR)))
+        self.assertTrue(sample.filter(self._record("kept", name='games.models')))
+
+
+class RatingTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.game = Game.objects.get(title="Arctic Thunder")
+
+    def test_aggregate_follows_ratings(self):
+        tom, sam = User.objects.get(username="tom"), User.objects.get(username="sam")
+        Rating.rate(self.game, tom, 5)
+        Rating.rate(self.game, sam, 2)
+        agg = RatingAggregate.objects.get(game=self.game)
+        self.assertEqual((agg.count, agg.total, agg.histogram), (2, 7, [0, 1, 0, 0, 1]))
+        self.assertEqual(agg.average, 3.5)
+        # rating again replaces the earlier rating
+        Rating.rate(self.game, tom, 3)
+        agg = RatingAggregate.objects.get(game=self.game)
+        self.assertEqual((agg.count, agg.total, agg.histogram), (2, 5, [0, 1, 1, 0, 0]))
+        self.assertEqual(Rating.objects.filter(game=self.game).count(), 2)
+
+    def test_concurrent_first_rating_becomes_update(self):
+        tom = User.objects.get(username="tom")
+        Rating.rate(self.game, tom, 5)
+        # the other request's lookup ran before this rating committed
+        manager, calls = Rating.objects, []
+        def select_for_update():
+            calls.append(1)
+            if len(calls) == 1:
+                return manager.none()
+            return manager.get_queryset().select_for_update()
+        manager.select_for_update = select_for_update
+        try:
+            Rating.rate(self.game, tom, 2)
+        finally:
+            del manager.select_for_update
+        self.assertEqual(len(calls), 2)
+        agg = RatingAggregate.objects.get(game=self.game)
+        self.assertEqual((agg.count, agg.total, agg.histogram), (1, 2, [0, 1, 0, 0, 0]))
+        self.assertEqual(Rating.objects.get(game=self.game, user=tom).rating, '2')
+
+    def test_rate_view_and_games_page(self):
+        request = self.factory.post('/games/rate/%d/' % self.game.id, {'stars': '4'})
+        request.user = User.objects.get(username="tom")
+        self.assertEqual(rate_game(request, game_id=self.game.id).status_code, 200)
+        request = self.factory.post('/games/rate/%d/' % self.game.id, {'stars': '9'})
+        request.user = User.objects.get(username="tom")
+        self.assertTrue("errorlist" in rate_game(request, game_id=self.game.id).content)
+
+        request = self.factory.get('/games/games/')
+        request.user = AnonymousUser()
+        with self.assertNumQueries(3):
+            content = games(request).content
+        self.assertTrue("4.0 stars (1 ratings)" in content)
+
+
+class VoteRollupTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        self.tz = pytz.timezone(settings.TIME_ZONE)
+        self.user = User.objects.get(username="tom")
+        self.games = list(Game.objects.filter(owned=False)[:3])
+        # 20 days of votes, every 7 hours 13 minutes, around a DST change
+        start = self.tz.localize(datetime(2013, 10, 25, 5, 17))
+        rows = [UserActivityLog(user=self.user, action='voted',
+                    game=self.games[i % 3], created=start + timedelta(minutes=433 * i))
+                for i in range(66)]
+        UserActivityLog.objects.bulk_create(rows)
+        call_command('rebuild_vote_rollups', stdout=StringIO())
+
+    def _raw(self, start, end):
+        counts = {}
+        for game_id in UserActivityLog.objects.filter(action='voted',
+                created__gte=start, created__lt=end).values_list('game', flat=True):
+            counts[game_id] = counts.get(game_id, 0) + 1
+        return counts
+
+    def test_ranges_match_raw_activity(self):
+        windows = [
+            (datetime(2013, 10, 25, 0, 0), datetime(2013, 11, 15, 0, 0)),
+            (datetime(2013, 10, 27, 13, 41), datetime(2013, 11, 6, 2, 5)),
+            (datetime(2013, 11, 2, 22, 30), datetime(2013, 11, 3, 3, 30)),
+            (datetime(2013, 11, 1, 10, 10), datetime(2013, 11, 1, 10, 50)),
+        ]
+        for start, end in windows:
+            start, end = self.tz.localize(start), self.tz.localize(end)
+            self.assertEqual(dict(rollups.votes_between(start, end)), self._raw(start, end))
+
+    def test_live_votes_feed_rollups(self):
+        game = self.games[0]
+        before = DailyVotes.objects.filter(game=game).count()
+        Vote.increment_count(game.title)
+        UserActivityLog.log_user_action(self.user, 'voted', game.title)
+        now = datetime.now(tz=self.tz)
+        self.assertEqual(HourlyVotes.objects.get(game=game, start=HourlyVotes.bucket(now)).votes, 1)
+        self.assertEqual(DailyVotes.objects.filter(game=game).count(), before + 1)
+        totals = rollups.votes_between(now - timedelta(days=3), now + timedelta(hours=1))
+        self.assertEqual(totals[game.id], 1)
+
+    def test_vote_range_view(self):
+        request = RequestFactory().get('/games/vote_range/',
+            {'from_t': '2013-10-25 00:00', 'to_t': '2013-11-15 00:00'})
+        request.user = AnonymousUser()
+        content = vote_range(request).content
+        self.assertTrue("%s - 22 votes" % self.games[0].title in content)
+        request = RequestFactory().get('/games/vote_range/',
+            {'from_t': '2013-11-15 00:00', 'to_t': '2013-10-25 00:00'})
+        request.user = AnonymousUser()
+        self.assertTrue("from_t must be before to_t" in vote_range(request).content)
+
+
+class ApiTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        self.client = Client()
+        self.game = Game.objects.get(title="Arctic Thunder")
+
+    def test_leaderboard_etag(self):
+        Vote.increment_count(self.game.title)
+        UserActivityLog.log_user_action(User.objects.get(username="tom"), "voted", self.game.title)
+        response = self.client.get('/games/api/leaderboard/')
+        self.assertEqual(response['Content-Type'], 'application/json')
+        data = json.loads(response.content)
+        self.assertEqual(data['games'][0], {'id': self.game.id, 'title': "Arctic Thunder",
+            'owned': False, 'votes': 1})
+        etag = response['ETag']
+        self.assertTrue(etag.startswith('"'))
+
+        with self.assertNumQueries(0):
+            response = self.client.get('/games/api/leaderboard/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        UserActivityLog.log_user_action(User.objects.get(username="sam"), "voted", self.game.title)
+        response = self.client.get('/games/api/leaderboard/', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_etag_from_body_without_shared_cache(self):
+        shared = versions.shared
+        versions.shared = lambda: False
+        try:
+            etag = self.client.get('/games/api/leaderboard/')['ETag']
+            response = self.client.get('/games/api/leaderboard/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 304)
+            # a vote this process never heard about still changes the tag
+            LeaderboardEntry.record(self.game, voting_week(), 2)
+            response = self.client.get('/games/api/leaderboard/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+        finally:
+            versions.shared = shared
+
+    def test_leaderboard_etag_changes_with_week(self):
+        etag = self.client.get('/games/api/leaderboard/')['ETag']
+        week = voting_week()
+        api.voting_week = lambda: week + timedelta(days=7)
+        try:
+            response = self.client.get('/games/api/leaderboard/', HTTP_IF_NONE_MATCH=etag)
+        finally:
+            api.voting_week = voting_week
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['week'], str(week + timedelta(days=7)))
+
+    def test_game_list_and_votes(self):
+        response = self.client.get('/games/api/games/')
+        titles = [g['title'] for g in json.loads(response.content)['games']]
+        self.assertEqual(titles, sorted(titles))
+        etag = response['ETag']
+        # votes do not change the game list
+        Vote.increment_count(self.game.title)
+        self.assertEqual(self.client.get('/games/api/games/',
+            HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        Game.objects.create(title="Jade Empire", user=User.objects.get(username="tom"))
+        self.assertEqual(self.client.get('/games/api/games/',
+            HTTP_IF_NONE_MATCH=etag).status_code, 200)
+
+        response = self.client.get('/games/api/games/%d/votes/' % self.game.id)
+        self.assertEqual(json.loads(response.content)['votes'], 1)
+        self.assertEqual(self.client.get('/games/api/games/99999/votes/').status_code, 404)
+        self.assertEqual(self.client.post('/games/api/games/').status_code, 405)
+
+
+class ThumbnailTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        import shutil
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+        self.media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.media)
+        data = StringIO()
+        Image.new('RGB', (800, 600), (200, 30, 30)).save(data, 'PNG')
+        self.upload = SimpleUploadedFile('cover.png', data.getvalue())
+
+    def test_variants_made_on_save(self):
+        with self.settings(MEDIA_ROOT=self.media, MEDIA_URL='/media/', THUMBNAIL_WORKERS=0):
+            game = Game.objects.get(title="Arctic Thunder")
+            game.image = self.upload
+            game.save()
+            digest = Game.objects.get(pk=game.pk).image_hash
+            self.assertEqual(len(digest), 40)
+            self.assertEqual(game.image_hash, digest)
+            from PIL import Image
+            small = Image.open(os.path.join(self.media, 'thumbs', '%s-120x90.jpg' % digest))
+            self.assertEqual(small.size, (120, 90))
+            self.assertEqual(thumbnails.url(game, 'medium'), '/media/thumbs/%s-300x225.jpg' % digest)
+            self.assertEqual(thumbnails.url(game, 200), '/media/thumbs/%s-300x225.jpg' % digest)
+
+            # another save keeps the variants; a new image starts over
+            game.owned = True
+            game.save()
+            self.assertEqual(Game.objects.get(pk=game.pk).image_hash, digest)
+            fresh = Game.objects.get(pk=game.pk)
+            fresh.image = 'nat/media/missing.png'
+            fresh.save()
+            self.assertEqual(Game.objects.get(pk=game.pk).image_hash, '')
+            self.assertEqual(thumbnails.url(fresh, 'small'), '/media/nat/media/missing.png')
+
+    def test_finished_leaves_catalog_version(self):
+        game = Game.objects.get(title="Arctic Thunder")
+        Game.objects.filter(pk=game.pk).update(image='nat/media/cover.png')
+        catalog, thumbs = versions.get(versions.CATALOG), versions.get(versions.THUMBNAILS)
+        thumbnails.finished(game.pk, 'nat/media/cover.png', 'a' * 40)
+        self.assertEqual(versions.get(versions.CATALOG), catalog)
+        self.assertNotEqual(versions.get(versions.THUMBNAILS), thumbs)
+
+    def test_regenerate_command(self):
+        with self.settings(MEDIA_ROOT=self.media, MEDIA_URL='/media/', THUMBNAIL_WORKERS=0):
+            game = Game.objects.get(title="Arctic Thunder")
+            game.image = self.upload
+            game.save()
+            Game.objects.filter(pk=game.pk).update(image_hash='')
+            out = StringIO()
+            call_command('regenerate_thumbnails', missing=True, workers=2, stdout=out)
+            self.assertTrue("made variants for 1 of 1 images" in out.getvalue())
+            self.assertEqual(Game.objects.get(pk=game.pk).image_hash, game.image_hash)
+
+
+
+class ThumbnailCommitTests(TransactionTestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def test_pool_job_waits_for_commit(self):
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from django.db import transaction
+        from PIL import Image
+        import shutil
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media)
+        data = StringIO()
+        Image.new('RGB', (800, 600), (200, 30, 30)).save(data, 'PNG')
+
+        class Pool(object):
+            jobs = []
+            def apply_async(self, func, args, callback):
+                self.jobs.append((func, args, callback))
+        get_pool = thumbnails.get_pool
+        thumbnails.get_pool = lambda: Pool()
+        try:
+            with self.settings(MEDIA_ROOT=media, MEDIA_URL='/media/'):
+                game = Game.objects.get(title="Arctic Thunder")
+                with transaction.atomic():
+                    game.image = SimpleUploadedFile('cover.png', data.getvalue())
+                    game.save()
+                    thumbnails.dispatch_deferred()
+                    self.assertEqual(Pool.jobs, [])
+                thumbnails.dispatch_deferred()
+                self.assertEqual(len(Pool.jobs), 1)
+                func, args, callback = Pool.jobs[0]
+                callback(func(*args))
+        finally:
+            thumbnails.get_pool = get_pool
+        self.assertEqual(len(Game.objects.get(pk=game.pk).image_hash), 40)
+
+
+class CachedIdentityTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        self.user = User.objects.get(username="tom")
+        self.user.set_password('secret')
+        self.user.save()
+        self.client = Client()
+        self.assertTrue(self.client.login(username="tom", password="secret"))
+
+    def test_identity_without_queries(self):
+        self.client.get('/games/my_votes/')
+        # only the page's own activity query
+        with self.assertNumQueries(1):
+            response = self.client.get('/games/my_votes/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context['user'].username, "tom")
+
+    def test_deactivated_user_is_logged_out(self):
+        self.assertEqual(self.client.get('/games/my_votes/').status_code, 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get('/games/my_votes/').status_code, 302)
+
+    def test_user_read_from_database_without_shared_cache(self):
+        self.client.get('/games/my_votes/')
+        shared = versions.shared
+        versions.shared = lambda: False
+        try:
+            # deactivated by another worker: no signal reaches this process
+            User.objects.filter(pk=self.user.pk).update(is_active=False)
+            self.assertEqual(self.client.get('/games/my_votes/').status_code, 302)
+        finally:
+            versions.shared = shared
+
+    def test_logout_ends_session(self):
+        self.client.get('/logout/')
+        self.assertEqual(self.client.get('/games/my_votes/').status_code, 302)
+
+
+@override_settings(REPLICA_DATABASES=['replica'])
+class ReplicaRouterTests(TransactionTestCase):
+    # committed rows, so the replica connection sees them
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        from django.db import connections
+        from django.test.utils import CaptureQueriesContext
+        cache.clear()
+        eligibility.reset()
+        self.capture = lambda alias: CaptureQueriesContext(connections[alias])
+        user = User.objects.get(username="tom")
+        user.set_password('secret')
+        user.save()
+        self.client = Client()
+        self.client.login(username="tom", password="secret")
+
+    def test_reads_on_replica_until_vote(self):
+        with self.capture('default') as primary, self.capture('replica') as replica:
+            self.assertEqual(self.client.get('/games/top_votes/').status_code, 200)
+            self.assertEqual(self.client.get('/games/all_votes/').status_code, 200)
+        self.assertTrue(len(replica) >= 2)
+        self.assertFalse([q for q in primary if 'leaderboard' in q['sql']])
+
+        game = Game.objects.get(title="Arctic Thunder")
+        with self.capture('default') as primary:
+            self.assertEqual(self.client.get('/games/vote/game_id/%d/' % game.id).status_code, 200)
+        self.assertTrue(any('INSERT INTO "user_activity"' in q['sql'] for q in primary))
+
+        # pinned: this session now reads its own vote from the primary
+        with self.capture('default') as primary, self.capture('replica') as replica:
+            response = self.client.get('/games/top_votes/')
+        self.assertEqual(len(replica), 0)
+        self.assertTrue("Arctic Thunder - 1 votes" in response.content)
+
+        # other sessions stay on the replica
+        with self.capture('replica') as replica:
+            Client().get('/games/top_votes/')
+        self.assertTrue(len(replica) >= 1)
+
+    def test_admin_changelist_pinned_after_save(self):
+        User.objects.filter(username="tom").update(is_staff=True, is_superuser=True)
+        self.client.login(username="tom", password="secret")
+        game = Game.objects.get(title="Arctic Thunder")
+        with self.capture('replica') as replica:
+            self.assertEqual(self.client.get('/admin/games/game/').status_code, 200)
+        self.assertTrue(len(replica) >= 1)
+
+        response = self.client.post('/admin/games/game/%d/' % game.id, {
+            'title': "Arctic Thunder", 'owned': 'on', 'user': game.user_id,
+            'created_0': '2014-01-01', 'created_1': '12:00:00'})
+        self.assertEqual(response.status_code, 302)
+        with self.capture('replica') as replica:
+            self.assertEqual(self.client.get('/admin/games/game/').status_code, 200)
+        self.assertEqual(len(replica), 0)
+
+
+class BatchVoteTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        UserActivityLog.objects.create(user=User.objects.get(username="jim"), action='voted',
+            game_id=1, created=datetime.now(tz=pytz.timezone(settings.TIME_ZONE)))
+        self.client = Client()
+        staff = User.objects.get(username="alee")
+        staff.set_password('secret')
+        staff.save()
+        self.client.login(username="alee", password="secret")
+
+    def _post(self, votes):
+        return self.client.post('/games/vote/batch/', json.dumps({'votes': votes}),
+            content_type='application/json')
+
+    def test_statuses(self):
+        response = self._post([
+            {'user': 'tom', 'game': 2}, {'user': 'sam', 'game': 2},
+            {'user': 'tom', 'game': 3}, {'user': 'jim', 'game': 2},
+            {'user': 'nobody', 'game': 2}, {'user': 'ann', 'game': 999},
+            {'user': 'ann', 'game': 4}, {'user': 'ann', 'game': 13},
+        ])
+        data = json.loads(response.content)
+        self.assertEqual([r['status'] for r in data['results']], ['counted', 'counted',
+            'duplicate', 'too_soon', 'unknown_user', 'unknown_game', 'owned', 'counted'])
+        self.assertEqual(data['counted'], 3)
+        self.assertEqual(Vote.counts([2, 13]), {2: 2, 13: 1})
+        self.assertEqual(UserActivityLog.objects.filter(action='voted').count(), 4)
+        self.assertEqual(LeaderboardEntry.top(voting_week())[0].votes, 2)
+        self.assertFalse(eligibility.can_act('tom'))
+
+    def test_queries_do_not_grow_with_batch(self):
+        def run(names, game):
+            votes = [{'user': name, 'game': game} for name in names]
+            with CaptureQueriesContext(connection) as captured:
+                ingest.vote_batch([(v['user'], v['game']) for v in votes])
+            return len(captured)
+        small = run(['tom', 'sam'], 2)
+        large = run(['tim', 'betty', 'bob', 'jen', 'joe', 'rich', 'john', 'ann'], 3)
+        self.assertEqual(small, large)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.client.get('/games/vote/batch/').status_code, 405)
+        self.assertEqual(self.client.post('/games/vote/batch/', '{"votes": 3}',
+            content_type='application/json').status_code, 400)
+        client = Client()
+        client.login(username="tom", password="x")
+        self.assertEqual(client.post('/games/vote/batch/', '{"votes": []}',
+            content_type='application/json').status_code, 302)
+
+    def test_session_needs_csrf_token(self):
+        client = Client(enforce_csrf_checks=True)
+        client.login(username="alee", password="secret")
+        body = json.dumps({'votes': [{'user': 'tom', 'game': 2}]})
+        self.assertEqual(client.post('/games/vote/batch/', body,
+            content_type='application/json').status_code, 403)
+        client.cookies['csrftoken'] = 'a' * 32
+        response = client.post('/games/vote/batch/', body,
+            content_type='application/json', HTTP_X_CSRFTOKEN='a' * 32)
+        self.assertEqual(json.loads(response.content)['counted'], 1)
+
+    @override_settings(VOTE_BATCH_TOKENS=['kiosk-key'])
+    def test_api_token_skips_csrf(self):
+        client = Client(enforce_csrf_checks=True)
+        body = json.dumps({'votes': [{'user': 'tom', 'game': 2}]})
+        self.assertEqual(client.post('/games/vote/batch/', body, content_type='application/json',
+            HTTP_AUTHORIZATION='Token wrong-key').status_code, 302)
+        response = client.post('/games/vote/batch/', body, content_type='application/json',
+            HTTP_AUTHORIZATION='Token kiosk-key')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['counted'], 1)
+
+
+@override_settings(LIVE_LEADERBOARD=True)
+class LiveLeaderboardTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        live.reset()
+
+    def _data(self, message, name):
+        self.assertTrue(message.startswith('event: %s\n' % name), message)
+        return json.loads(message.split('data: ', 1)[1])
+
+    def test_standings_then_diffs(self):
+        LeaderboardEntry.record(Game.objects.get(pk=2), voting_week(), 3)
+        stream = live.stream(heartbeat=0.01)
+        self.assertTrue(next(stream).startswith('retry:'))
+        standings = self._data(next(stream), 'standings')
+        self.assertEqual(standings['week'], voting_week().isoformat())
+        self.assertEqual([(g['id'], g['votes']) for g in standings['games']], [(2, 3)])
+        self.assertEqual(next(stream), ': keepalive\n\n')
+
+        UserActivityLog.log_user_action('tom', 'voted', Game.objects.get(pk=13).title)
+        ingest.vote_batch([('sam', 2), ('ann', 2)])
+        with self.assertNumQueries(1):
+            live.get_publisher().poll()
+        diff = self._data(next(stream), 'diff')
+        self.assertEqual(sorted((g['id'], g['votes']) for g in diff['games']),
+            [(2, 5), (13, 1)])
+
+        stream.close()
+        self.assertFalse(live.get_publisher().subscribers)
+
+    def test_viewers_share_one_publisher(self):
+        first, second = live.stream(), live.stream()
+        next(first), next(second)
+        self.assertEqual(next(first), next(second))
+        live.changed([13])
+        live.get_publisher().poll()
+        diff = next(first)
+        self.assertEqual(diff, next(second))
+        self.assertEqual(self._data(diff, 'diff')['games'], [])
+
+    def test_rebuild_resends_standings(self):
+        stream = live.stream()
+        next(stream), next(stream)
+        call_command('rebuild_leaderboard', stdout=StringIO())
+        live.get_publisher().poll()
+        self._data(next(stream), 'standings')
+
+    def test_view(self):
+        response = Client().get('/games/live/', **{'wsgi.multithread': True})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        content = iter(response.streaming_content)
+        next(content)
+        self._data(next(content), 'standings')
+        response.close()
+
+    def test_sync_worker_refused(self):
+        response = Client().get('/games/live/', **{'wsgi.multithread': False})
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(live.get_publisher().subscribers)
+
+    def test_pages_follow_stream(self):
+        for path in ('/games/top_votes/', '/games/vote_index/'):
+            self.assertTrue("EventSource('/games/live/')" in Client().get(path).content)
+        with self.settings(LIVE_LEADERBOARD=False):
+            for path in ('/games/top_votes/', '/games/vote_index/'):
+                self.assertFalse("EventSource" in Client().get(path).content)
+            self.assertEqual(Client().get('/games/live/',
+                **{'wsgi.multithread': True}).status_code, 404)
+
+
+class SnapshotTests(TestCase):
+    fixtures = ['games/fixtures/users.json', 'games/fixtures/games.json']
+
+    def setUp(self):
+        cache.clear()
+        eligibility.reset()
+        self.path = tempfile.mktemp(suffix='.snap')
+        tom = User.objects.get(username='tom')
+        now = datetime.now(tz=pytz.timezone(settings.TIME_ZONE))
+        for game_id, days in ((2, 1), (2, 3), (13, 9)):
+            UserActivityLog.objects.create(user=tom, action='voted', game_id=game_id,
+                created=now - timedelta(days=days, microseconds=days))
+        Vote.objects.get(game=2).add(2)
+        Rating.rate(Game.objects.get(pk=2), tom, 4)
+        Rating.objects.create(game_id=13, rating='2')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _state(self):
+        return {
+            'users': list(User.objects.order_by('id').values_list(
+                'id', 'username', 'password', 'is_staff', 'last_login')),
+            'games': list(Game.objects.order_by('id').values_list(
+                'id', 'title', 'title_key', 'owned', 'user_id', 'image', 'created')),
+            'votes': Vote.counts(),
+            'activity': list(UserActivityLog.objects.order_by('id').values_list(
+                'id', 'user_id', 'game_id', 'action', 'created')),
+            'ratings': list(Rating.objects.order_by('id').values_list(
+                'id', 'game_id', 'user_id', 'rating')),
+        }
+
+    def test_round_trip(self):
+        before = self._state()
+        # vote totals are read a few games per query
+        snapshot.IN_SIZE, in_size = 2, snapshot.IN_SIZE
+        try:
+            call_command('snapshot', self.path, chunk_size=3, stdout=StringIO())
+        finally:
+            snapshot.IN_SIZE = in_size
+        self.assertRaises(CommandError, call_command, 'restore', self.path, stdout=StringIO())
+
+        call_command('restore', self.path, replace=True, stdout=StringIO())
+        after = self._state()
+        self.assertEqual(after, before)
+        self.assertEqual(Vote.objects.get(game=2).count, 2)
+        self.assertEqual(RatingAggregate.objects.get(game=2).histogram, [0, 0, 0, 1, 0])
+        self.assertTrue(TitleTrigram.objects.filter(game=2).exists())
+        self.assertEqual(LeaderboardEntry.top(LeaderboardEntry.ALL_TIME)[0].game_id, 2)
+        self.assertFalse(eligibility.can_act('tom'))
+
+    def test_restore_keeps_other_users(self):
+        call_command('snapshot', self.path, stdout=StringIO())
+        admin = User.objects.create_superuser('root', 'root@example.com', 'secret')
+        tom = User.objects.get(username='tom')
+        User.objects.filter(pk=tom.pk).update(email='changed@example.com')
+        call_command('restore', self.path, replace=True, stdout=StringIO())
+        self.assertTrue(User.objects.get(pk=admin.pk).is_superuser)
+        self.assertEqual(User.objects.get(pk=tom.pk).email, tom.email)
+
+    def test_restore_merges_renumbered_user(self):
+        from django.contrib.admin.models import LogEntry, ADDITION
+        from django.contrib.contenttypes.models import ContentType
+        call_command('snapshot', self.path, stdout=StringIO())
+        sam = User.objects.get(username='sam')
+        games = Game.objects.filter(user=sam).count()
+        User.objects.filter(pk=sam.pk).update(username='sam-old')
+        again = User.objects.create_user('sam', 'sam@example.com', 'secret')
+        LogEntry.objects.log_action(again.pk, ContentType.objects.get_for_model(Game).pk,
+            2, 'Arctic Thunder', ADDITION)
+
+        call_command('restore', self.path, replace=True, stdout=StringIO())
+        self.assertEqual(User.objects.get(username='sam').pk, sam.pk)
+        self.assertFalse(User.objects.filter(pk=again.pk).exists())
+        self.assertEqual(LogEntry.objects.get(object_repr='Arctic Thunder').user_id, sam.pk)
+        self.assertEqual(Game.objects.filter(user=sam).count(), games)
+
+    def test_failed_rebuild_rolls_back(self):
+        call_command('snapshot', self.path, stdout=StringIO())
+        before = self._state()
+        fold_all = tally.fold_all
+        def fail():
+            raise RuntimeError("rebuild failed")
+        tally.fold_all = fail
+        try:
+            self.assertRaises(RuntimeError, call_command, 'restore', self.path,
+                replace=True, stdout=StringIO())
+        finally:
+            tally.fold_all = fold_all
+        self.assertEqual(self._state(), before)
+        self.assertTrue(TitleTrigram.objects.filter(game=2).exists())
+
+    def test_copy_format(self):
+        when = datetime(2014, 3, 1, 12, 0, 0, 5, tzinfo=pytz.utc)
+        self.assertEqual([snapshot._copy_value(v) for v in (None, True, 7, when, u'a\tb\\c\xe9')],
+            ['\\N', 't', '7', '2014-03-01T12:00:00.000005+00:00', 'a\\tb\\\\c\xc3\xa9'])
+
+    def test_columns(self):
+        for kind, values in (('int', [5, 3, None, 2 ** 40]), ('str', [u'caf\xe9', None, u'']),
+                ('bool', [True, False]), ('time', [datetime(2014, 3, 1, 12, 0, 0, 5, tzinfo=pytz.utc)])):
+            self.assertEqual(snapshot.decode(kind, snapshot.encode(kind, values), len(values)),
+                values)
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as f:
+            f.write('[{"model": "games.game"}]')
+        self.assertRaises(snapshot.SnapshotError, list, snapshot.read(open(self.path, 'rb')))
+
+
+class ColdStartTests(TestCase):
+    def test_tracer_times_new_imports(self):
+        directory = tempfile.mkdtemp()
+        with open(os.path.join(directory, 'traced_module.py'), 'w') as f:
+            f.write("import traced_dependency\n")
+        with open(os.path.join(directory, 'traced_dependency.py'), 'w') as f:
+            f.write("VALUE = 1\n")
+        sys.path.insert(0, directory)
+        tracer = importtime.Tracer()
+        tracer.install()
+        try:
+            import traced_module
+            import traced_module
+        finally:
+            tracer.uninstall()
+            sys.path.remove(directory)
+            sys.modules.pop('traced_module', None)
+            sys.modules.pop('traced_dependency', None)
+        self.assertEqual([(e['module'], e['by']) for e in tracer.modules],
+            [('traced_dependency', 'traced_module'), ('traced_module', __name__)])
+        dependency, module = tracer.modules
+        self.assertTrue(module['cumulative'] >= dependency['cumulative'])
+        self.assertTrue(module['self'] <= module['cumulative'] - dependency['cumulative'] + 1e-6)
+
+    def test_local_timezone(self):
+        zone = pytz.timezone(settings.TIME_ZONE)
+        when = datetime(2014, 7, 4, 17, 30, tzinfo=pytz.utc)
+        self.assertEqual(when.astimezone(TIMEZONE), when.astimezone(zone))
+        self.assertEqual(when.astimezone(TIMEZONE).utcoffset(), timedelta(hours=-5))
+        self.assertEqual(TIMEZONE.localize(datetime(2014, 1, 6)).utcoffset(), timedelta(hours=-6))
+        self.assertEqual(voting_week(when), date(2014, 6, 30))
+
+    def test_admin_urls_load_on_demand(self):
+        response = Client().get('/admin/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(reverse('admin:games_game_changelist'), '/admin/games/game/')
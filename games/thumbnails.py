@@ -0,0 +1,179 @@
+"""
+    Resized variants of Game.image, made off the request thread
+
+    a saved game whose image changed is handed to a process pool
+    (settings.THUMBNAIL_WORKERS processes, 0 = inline).  Each worker
+    resizes and recompresses the original to every THUMBNAIL_SIZES
+    entry and writes them as MEDIA_ROOT/thumbs/<sha1 of original>-WxH.jpg.
+    When a game's variants are ready its image_hash is set, and
+    {{ game|thumbnail:"small" }} (games.templatetags.thumbnails) can
+    build their URLs without touching the disk.
+    Identical uploads share their variants.
+    A save inside a transaction (every admin save) is handed over only
+    once it commits: the pool's callback writes image_hash on another
+    connection, which would not see the uncommitted row.
+"""
+import hashlib
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connection
+
+from games import versions
+
+_log = logging.getLogger(__name__)
+
+DIRECTORY = 'thumbs'
+
+
+def sizes():
+    ''' {name : (max width, max height)}, smallest first '''
+    sizes = getattr(settings, 'THUMBNAIL_SIZES', {
+        'small': (120, 90), 'medium': (300, 225), 'large': (600, 450)})
+    return sorted(sizes.items(), key=lambda item: item[1])
+
+
+def variant_name(digest, size):
+    return '%s/%s-%dx%d.jpg' % (DIRECTORY, digest, size[0], size[1])
+
+
+def render_variants(path, media_root, size_list, quality):
+    '''
+        runs in a pool worker: resize @path to each of @size_list,
+        return the sha1 of the original (None if it is not an image)
+    '''
+    from PIL import Image
+
+    try:
+        with open(path, 'rb') as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        original = Image.open(path)
+        original.load()
+    except IOError:
+        return None
+    if original.mode not in ('RGB', 'L'):
+        original = original.convert('RGB')
+    for size in size_list:
+        target = os.path.join(media_root, variant_name(digest, size))
+        if os.path.exists(target):
+            continue
+        if not os.path.isdir(os.path.dirname(target)):
+            try:
+                os.makedirs(os.path.dirname(target))
+            except OSError:
+                pass    # another worker made it
+        image = original.copy()
+        image.thumbnail(size, Image.ANTIALIAS)
+        partial = '%s.%d.tmp' % (target, os.getpid())
+        image.save(partial, 'JPEG', quality=quality, optimize=True, progressive=True)
+        os.rename(partial, target)
+    return digest
+
+
+_pool = None
+_pool_pid = None
+_lock = threading.Lock()
+_deferred = threading.local()
+
+def get_pool():
+    ''' this process' pool, None when THUMBNAIL_WORKERS is 0 '''
+    global _pool, _pool_pid
+    workers = getattr(settings, 'THUMBNAIL_WORKERS', 2)
+    if not workers:
+        return None
+    with _lock:
+        if _pool is None or _pool_pid != os.getpid():
+            # only processes that handle an image load multiprocessing
+            from multiprocessing import Pool
+            _pool = Pool(workers)
+            _pool_pid = os.getpid()
+    return _pool
+
+
+def job(game):
+    ''' render_variants arguments for @game '''
+    return (game.image.path, settings.MEDIA_ROOT,
+        [size for name, size in sizes()],
+        getattr(settings, 'THUMBNAIL_QUALITY', 85))
+
+
+def finished(game_id, name, digest):
+    ''' record the variants, unless the game's image changed meanwhile '''
+    from games.models import Game
+    if digest is None:
+        _log.error("game %s image %s is missing or not an image", game_id, name)
+        return
+    if Game.objects.filter(pk=game_id, image=name).update(image_hash=digest):
+        # only pages showing images care; the catalog (vote form, fuzzy index) is unchanged
+        versions.bump(versions.THUMBNAILS)
+    elif not Game.objects.filter(pk=game_id).exists():
+        _log.warning("game %s is not in the database (deleted, or its save rolled back); "
+            "variants of %s are unused", game_id, name)
+    else:
+        _log.info("game %s image changed from %s before its variants were ready", game_id, name)
+
+
+def generate(game):
+    ''' make @game's variants in the pool (or now, with no pool) '''
+    pool = get_pool()
+    args = job(game)
+    if pool is None:
+        digest = render_variants(*args)
+        finished(game.pk, game.image.name, digest)
+        game.image_hash = digest or ''
+        return
+    if connection.in_atomic_block:
+        if not hasattr(_deferred, 'jobs'):
+            _deferred.jobs = []
+        _deferred.jobs.append((game.pk, game.image.name, args))
+        return
+    _dispatch(pool, game.pk, game.image.name, args)
+
+
+def _dispatch(pool, game_id, name, args):
+    def callback(digest):
+        # runs on the pool's result thread
+        try:
+            finished(game_id, name, digest)
+        except Exception:
+            _log.exception("thumbnails for game %s", game_id)
+    pool.apply_async(render_variants, args, callback=callback)
+
+
+def dispatch_deferred(**kwargs):
+    '''
+        hand the images saved inside this thread's transactions to the
+        pool; call once they commit (GameAdmin does, after each save,
+        and every request does when it finishes)
+    '''
+    jobs = getattr(_deferred, 'jobs', None)
+    if not jobs or connection.in_atomic_block:
+        return
+    _deferred.jobs = []
+    pool = get_pool()
+    for game_id, name, args in jobs:
+        _dispatch(pool, game_id, name, args)
+
+request_finished.connect(dispatch_deferred)
+
+
+def url(game, size=None):
+    '''
+        URL of @game's variant: @size is a THUMBNAIL_SIZES name, or a width
+        (the smallest variant at least that wide); the original
+        until the variants are ready
+    '''
+    if not game.image:
+        return ''
+    if not game.image_hash:
+        return game.image.url
+    available = sizes()
+    chosen = available[-1][1]
+    for name, dims in available:
+        if name == size or (isinstance(size, int) and dims[0] >= size):
+            chosen = dims
+            break
+    return settings.MEDIA_URL + variant_name(game.image_hash, chosen)
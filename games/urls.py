@@ -1,17 +1,29 @@
-""" UrlConf file """
-from django.conf import settings
+""" UrlConf file
+
+    views are named by path, so a worker imports a view module
+    (games.api, say) only when a request first resolves to it
+"""
 from django.conf.urls import patterns, url
 
-from games import views
+urlpatterns = patterns('games.views',
+    url(r'^games/$', 'games'),
+    url(r'^main/$', 'main'),
+    url(r'^vote_index/$', 'vote_index'),
+    url(r'^vote/$', 'game_vote'),
+    url(r'^vote/game_id/(?P<game_id>\d+)/$', 'game_vote'),
+    url(r'^vote/batch/$', 'vote_batch'),
+    url(r'^top_votes/$', 'top_votes'),
+    url(r'^live/$', 'live_leaderboard'),
+    url(r'^vote_range/$', 'vote_range'),
+    url(r'^all_votes/$', 'all_votes'),
+    url(r'^my_votes/$', 'my_votes'),
+    url(r'^add/$', 'game_add'),
+    url(r'^rate/(?P<game_id>\d+)/$', 'rate_game'),
+    url(r'^export/(?P<fmt>csv|ndjson)/$', 'export_activity'),
+)
 
-urlpatterns = patterns('',
-    url(r'^games/$', views.games),
-    url(r'^main/$', views.main),
-    url(r'^vote_index/$', views.vote_index),
-    url(r'^vote/$', views.game_vote),
-    url(r'^vote/game_id/(?P<game_id>\d+)/$', views.game_vote),
-    url(r'^top_votes/$', views.top_votes),
-    url(r'^all_votes/$', views.AllVotes.as_view()),
-    url(r'^my_votes/$', views.my_votes),
-    url(r'^add/$', views.game_add),
+urlpatterns += patterns('games.api',
+    url(r'^api/leaderboard/$', 'leaderboard'),
+    url(r'^api/games/$', 'game_list'),
+    url(r'^api/games/(?P<game_id>\d+)/votes/$', 'game_votes'),
 )
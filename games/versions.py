@@ -0,0 +1,54 @@
+"""
+    Data version stamps kept in the cache
+
+    bump(name) whenever the data behind @name changes; anything derived
+    from that data (cached HTML, in-process indexes, ETags) is keyed on
+    get(name).  A stamp missing from the cache (cold start, eviction)
+    restarts at the current time in ms, so it never repeats an old value.
+    Stamps only reach other processes through a shared CACHES backend
+    (settings configures one); shared() says whether this one is.
+"""
+import time
+
+from django.core.cache import cache
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+CATALOG = 'catalog'
+VOTES = 'votes'
+RATINGS = 'ratings'
+THUMBNAILS = 'thumbnails'   # a game's image variants became ready
+
+
+def shared():
+    ''' is a bump seen by every process (not a per-process or dummy cache) '''
+    return not isinstance(cache, (LocMemCache, DummyCache))
+
+
+def _key(name):
+    return 'games.version.%s' % name
+
+
+def _fresh():
+    return int(time.time() * 1000)
+
+
+def get(name):
+    ''' current stamp for @name '''
+    key = _key(name)
+    version = cache.get(key)
+    if version is None:
+        cache.add(key, _fresh(), None)
+        version = cache.get(key)
+    return version
+
+
+def bump(name):
+    ''' move @name to a new stamp and return it '''
+    key = _key(name)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        version = _fresh()
+        cache.set(key, version, None)
+        return version
@@ -1,26 +1,37 @@
+import json
 import logging
 from datetime import datetime, timedelta, date
-import pytz
 
 from collections import OrderedDict
-from django.http import Http404, HttpResponseServerError
+from django.http import Http404, HttpResponseServerError, StreamingHttpResponse
+from django.http import HttpResponseBadRequest, HttpResponseNotAllowed
 from django.shortcuts import render_to_response, HttpResponse
 from django.shortcuts import render
 from django.core.exceptions import ValidationError
-from django.contrib.auth.decorators import login_required
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.contrib.auth import authenticate, login
+from django.contrib.auth.views import redirect_to_login
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
 from django.contrib.auth.models import User
-from games.models import Game, Vote
-from games.models import UserActivityLog
+from django.core.cache import cache
+from django.db import transaction, IntegrityError
+from games.models import Game, Vote, Rating, normalize_title
+from games.models import UserActivityLog, LeaderboardEntry, voting_week
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import require_safe
 from django.views.generic import DetailView, ListView
 from games.forms import GameAddForm 
 from games.forms import GameVoteForm 
 from games.forms import VoteCountForm 
+from games.forms import RatingForm 
+from games import eligibility, fuzzy, ingest, live, rollups, versions
+from games.pagination import paginate
+from nat.routers import pin_primary, replica_reads
 
 
 from django.conf import settings
-from django.utils.timezone import activate
-activate(settings.TIME_ZONE)
 
 _log = logging.getLogger(__name__)
 
@@ -31,47 +42,57 @@ def _raise_error(reason=''):
     response = HttpResponseServerError(reason)
     return response
 
-def _say_thanks(request, msg):
-    ''' be polite '''
+def _say_thanks(request, msg, game=None):
+    ''' be polite
+        after a vote, show the game's total
+        including votes still in the ingest queue
+    '''
     return render(request, "games/thanks.html", {
-        "msg" : msg })
+        "msg" : msg,
+        "game" : game,
+        "votes" : ingest.vote_total(game) if game else None })
+
+def _record_vote(request, game):
+    ''' count the vote now, or queue it when ingest is buffered '''
+    if ingest.buffered():
+        ingest.enqueue_vote(request.user.username, game)
+    else:
+        Vote.increment_count(game.title)
+        UserActivityLog.log_user_action(request.user, "voted", game.title)
+    # read your own vote: skip the replicas for a while
+    pin_primary(request)
 
 def _can_act(user):
     ''' has this user acted today
-        check the activity log
+        check the shared eligibility store
     '''
-    tz = pytz.timezone(settings.TIME_ZONE)
-    ual = UserActivityLog.last_acted(user)
-
-    _log.debug("user %s activity log : %s " % (user, ual))
-
-    if ual is None :
-        return True
-    if ual.day == datetime.now(tz=tz).day:
-        return False
-    elif datetime.now(tz=tz).weekday() >= 5:
-        ''' is it the weekend  '''
-        return False
-    else:
-        return True
+    return eligibility.can_act(unicode(user))
 
 def _count_votes():
     ''' aggregate votes
-        based on a filter (if exists)
+        all time totals for games we don't own
         return ordered dict
         of games and vote counts
     '''
-    context = {}
-     
-    votes = Vote.objects.all().select_related('game')
-    for vote in votes:
-        game = Game.objects.get(pk=vote.game.id)
-        if game.owned == False:
-            context[game.title] = vote.count
-    return OrderedDict(reversed(sorted(context.items(), key=lambda t: t[1])))
-        
+    entries = LeaderboardEntry.top(LeaderboardEntry.ALL_TIME, owned=False)
+    return _board(entries)
+
+def _board(entries):
+    ''' leaderboard rows -> ordered dict of title : votes '''
+    return OrderedDict((e.game.title, e.votes) for e in entries)
+
+def _section(name, queryset, *stamps):
+    '''
+        the rows of @queryset, cached for everyone until one of the
+        version @stamps moves or FRAGMENT_CACHE_TIMEOUT passes
+    '''
+    key = 'games.page.%s.%s' % (name, '.'.join(str(versions.get(stamp)) for stamp in stamps))
+    rows = cache.get(key)
+    if rows is None:
+        rows = list(queryset)
+        cache.set(key, rows, getattr(settings, 'FRAGMENT_CACHE_TIMEOUT', 600))
+    return rows
 
-    
 # views 
 def login(request):
     ''' login view for adding or voting
@@ -87,20 +108,31 @@ def login(request):
         else:
             raise Http404
             
+@replica_reads
 def games(request):
     """
         games we own 
+        each section's rows are cached, keyed on the catalog /
+        votes / ratings versions, and shared by every viewer;
+        the vote and rate links are drawn per request, so a
+        cache hit runs no queries
     """
-    voted = Vote.objects.filter(count__gt=0).select_related('game')
-    owned = Game.objects.filter(owned=True)
+    alltime = LeaderboardEntry.objects.filter(
+        week=LeaderboardEntry.ALL_TIME, votes__gt=0)
+    voted = alltime.select_related('game__rating_summary').order_by('-votes')
+    owned = Game.objects.filter(owned=True).select_related('rating_summary')
     no_votes = Game.objects.filter(owned=False).exclude(
-        id__in=Vote.objects.filter(count__gt=0).values_list('game', flat=True)
-        )
+        id__in=alltime.values_list('game', flat=True)
+        ).select_related('rating_summary')
 
     return render(request, 'games/games.html', {
-        'owned' : owned,
-        'voted' : voted,
-        'no_votes' : no_votes
+        'signed_in' : request.user.is_authenticated(),
+        'owned' : _section('owned', owned,
+            versions.CATALOG, versions.RATINGS, versions.THUMBNAILS),
+        'voted' : _section('voted', voted,
+            versions.CATALOG, versions.VOTES, versions.RATINGS),
+        'no_votes' : _section('added', no_votes,
+            versions.CATALOG, versions.VOTES, versions.RATINGS),
         })
 
 def main(request):
@@ -110,40 +142,63 @@ def main(request):
     '''
     return render(request, 'games/main.html')
     
+@replica_reads
 def vote_index(request):
     """ votes view 
         show table of games and votes
-        sloppy date handling
-        refactor
+        cast since this Monday
     """
-    context = {}
-    d = date.today().weekday()
-    # only want gmes voted on since this Monday
-    votes = Vote.objects.filter(
-        created__gte=date.today()-timedelta(days=d), count__gt=0).select_related('game')
-    for vote in votes:
-        #game = Game.objects.get(pk=vote.game.id)
-        if vote.game.owned == False:
-            context[vote.game.title] = vote.count
-    context = OrderedDict(reversed(sorted(context.items(), key=lambda t: t[1])))
-    return render(request, 'games/votes_list.html', {"context" : context })
+    context = _board(LeaderboardEntry.top(voting_week(), owned=False))
+    return render(request, 'games/votes_list.html', dict(live.page_context(),
+        context=context))
 
 
+@replica_reads
 def top_votes(request):
     """
         top votes this week
     """
-    context = {}
-    today = date.today()
-    monday = today - timedelta(days=today.weekday())
-    votes = Vote.objects.filter(created__gte=monday)
-    for vote in votes:
-        game = Game.objects.get(pk=vote.game.id)
-        context[game.title] = vote.count
-    ordered = OrderedDict(reversed(sorted(context.items(), key=lambda t: t[1])))
-
-    return render(request, "games/vote_count.html", {
-        'context' : ordered, 
+    ordered = _board(LeaderboardEntry.top(voting_week()))
+
+    return render(request, "games/vote_count.html", dict(live.page_context(),
+        context=ordered))
+
+
+@require_safe
+def live_leaderboard(request):
+    """
+        this week's standings as server-sent events:
+        a standings event, then a diff event as votes land
+        only with LIVE_LEADERBOARD, and only on a threaded
+        or async worker: a sync worker would be held by
+        every open page
+    """
+    if not live.enabled():
+        raise Http404
+    if not request.META.get('wsgi.multithread'):
+        return HttpResponse("live leaderboard needs a threaded or gevent worker",
+            status=503, content_type='text/plain')
+    response = StreamingHttpResponse(live.stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # nginx: pass each event on as it is written
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@replica_reads
+def vote_range(request):
+    """
+        top votes between from_t and to_t
+        summed from the hourly / daily rollups
+    """
+    form = VoteCountForm(request.GET or None)
+    ordered = None
+    if form.is_valid():
+        ordered = OrderedDict((game.title, votes) for game, votes in
+            rollups.top(form.cleaned_data['from_t'], form.cleaned_data['to_t']))
+    return render(request, "games/vote_range.html", {
+        'form' : form,
+        'context' : ordered,
         })
 
 
@@ -157,6 +212,18 @@ class AllVotes(ListView):
     queryset = UserActivityLog.objects.filter(
         action='voted').select_related(
         'game', 'user').order_by('created')
+    paginate_by = getattr(settings, 'ACTIVITY_PAGE_SIZE', 50)
+
+    @method_decorator(replica_reads)
+    def dispatch(self, *args, **kwargs):
+        return super(AllVotes, self).dispatch(*args, **kwargs)
+
+    def paginate_queryset(self, queryset, page_size):
+        ''' keyset pages instead of OFFSET pages '''
+        page = paginate(queryset, self.request.GET.get('cursor'), page_size)
+        return (None, page, page.object_list, True)
+
+all_votes = AllVotes.as_view()
 
 
 @login_required
@@ -164,45 +231,102 @@ def my_votes(request):
     ''' see what I have added and voted for '''
     actions = UserActivityLog.objects.filter(
         user=request.user, action='voted').select_related(
-            'game', 'user').order_by('-created')
-    return render(request, 'games/vote_list.html', {"actions" : actions })
+            'game', 'user')
+    page = paginate(actions, request.GET.get('cursor'),
+        getattr(settings, 'ACTIVITY_PAGE_SIZE', 50), descending=True)
+    return render(request, 'games/vote_list.html', {
+        "actions" : page,
+        "page_obj" : page })
+
+@login_required
+@user_passes_test(lambda u: u.is_staff)
+def export_activity(request, fmt='csv'):
+    ''' stream the activity log as csv or ndjson
+        ?from=YYYY-MM-DD&to=YYYY-MM-DD&action=voted
+    '''
+    # rarely used: not loaded with the other views
+    from games import export
+    try:
+        filters = export.parse_filters(request.GET.get('from'),
+            request.GET.get('to'), request.GET.get('action'))
+    except ValueError:
+        return _raise_error("dates must look like YYYY-MM-DD")
+    response = StreamingHttpResponse(
+        export.lines(fmt, export.activity_rows(**filters)),
+        content_type=export.FORMATS[fmt])
+    response['Content-Disposition'] = 'attachment; filename="activity.%s"' % fmt
+    return response
+
+def _batch_token(request):
+    ''' does the request carry "Authorization: Token <key>" with a key from VOTE_BATCH_TOKENS '''
+    scheme, _, key = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return scheme.lower() == 'token' and bool(key) and any(
+        constant_time_compare(key, token) for token in getattr(settings, 'VOTE_BATCH_TOKENS', ()))
+
+@csrf_exempt
+def vote_batch(request):
+    ''' POST {"votes": [{"user": username, "game": game id}, ...]}
+        votes for many users at once (kiosks, bots)
+        returns {"results": [{"user", "game", "status"}, ...], "counted": n}
+        bots send an Authorization: Token header (no CSRF token);
+        a signed-in staff browser sends the csrftoken cookie back as X-CSRFToken
+    '''
+    if not _batch_token(request):
+        if not (request.user.is_authenticated() and request.user.is_staff):
+            return redirect_to_login(request.get_full_path())
+        # csrf_exempt only lets token requests through
+        rejected = CsrfViewMiddleware().process_view(request, None, (), {})
+        if rejected is not None:
+            return rejected
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        items = json.loads(request.body)['votes']
+        pairs = [(unicode(item['user']), int(item['game'])) for item in items]
+    except (ValueError, KeyError, TypeError):
+        return HttpResponseBadRequest("expected {\"votes\": [{\"user\": ..., \"game\": ...}]}")
+    if len(pairs) > getattr(settings, 'VOTE_BATCH_SIZE', 500):
+        return HttpResponseBadRequest("at most %d votes per batch"
+            % getattr(settings, 'VOTE_BATCH_SIZE', 500))
+    statuses = ingest.vote_batch(pairs)
+    return HttpResponse(json.dumps({
+        'results': [{'user': user, 'game': game, 'status': status}
+            for (user, game), status in zip(pairs, statuses)],
+        'counted': statuses.count('counted'),
+        }), content_type='application/json')
 
 # methods below require a logged in user 
 # This definately could be more DRY ... just a first pass
 @login_required
 def game_vote(request, game_id=''):
     """ logged in user votes for a game here """
-    _log.debug( "game_vote : user : %s" % request.user.username )
+    _log.debug("game_vote : user : %s", request.user.username)
     if request.method == 'POST':
         form = GameVoteForm(request.POST)
         if form.is_valid():
             title = form.cleaned_data['title']
-            _log.debug("game_vote ; title is : %s " % title)
+            _log.debug("game_vote ; title is : %s", title.title)
             # see if this user has voted or added today
             if _can_act(request.user.username) == False:
-                _log.debug("%s acted today" % request.user)
+                _log.debug("%s acted today", request.user.username)
                 response = _raise_error(reason="You Can Only Vote/Add once a day")
                 return response
              
             # remember to get out and vote! 
-            Vote.increment_count(title)
-            # make entry in user activity log
-            UserActivityLog.log_user_action(request.user, "voted", title)
+            _record_vote(request, title)
             #say thanks!
-            return _say_thanks(request, "your vote for %s has been counted!" % title)
+            return _say_thanks(request, "your vote for %s has been counted!" % title, title)
     elif request.method == 'GET' and  game_id:
         # if object does not exist, punt to 500 handler
         game = Game.objects.get(pk=game_id)
         if _can_act(request.user.username) == False:
-            _log.debug("%s acted in the last day" % request.user)
+            _log.debug("%s acted in the last day", request.user.username)
             response = _raise_error(reason="You Can't Vote till tomorrow, sorry")
             return response
         else:
             # user can vote
-            Vote.increment_count(game.title)
-            # log user action
-            UserActivityLog.log_user_action(request.user, "voted", game.title)
-            return _say_thanks(request, "your vote for %s has been counted!" % game.title)
+            _record_vote(request, game)
+            return _say_thanks(request, "your vote for %s has been counted!" % game.title, game)
     else:
         # if this is a GET, print form
         form = GameVoteForm()
@@ -224,51 +348,58 @@ def game_add(request):
     if request.method == 'POST':
         form = GameAddForm(request.POST)
         if form.is_valid():
-            title = form.cleaned_data['title']
-            # clean title
-            tite= title.strip()
-            if title == '':
+            title = form.cleaned_data['title'].strip()
+            key = normalize_title(title)
+            if key == '':
                 return _raise_error("No title")
+            # same title up to case, spacing and punctuation?
+            game = Game.matching(title).first()
+            if game is None and not form.cleaned_data['confirmed']:
+                # titles above FUZZY_MATCH_THRESHOLD are only suggestions
+                # ("2004" vs "2006"): the user picks one or confirms the new title
+                matches = fuzzy.similar(title)
+                if matches:
+                    return render(request, 'games/add_game.html', {
+                        'form': GameAddForm(initial={'title': title, 'confirmed': True}),
+                        'suggestions': matches,
+                    })
+
             # see if this game is already owned 
-            # would like this to be fuzzy
-            # case-insensitive for now
-            qs = Game.objects.filter(title__icontains=title, owned=True)
-            if qs:
-                _log.error("%s is already owned" % title)
-                return _raise_error("%s is already owned" % title)
+            if game is not None and game.owned:
+                _log.error("%s is already owned", title)
+                return _raise_error("%s is already owned" % game.title)
             
             # see if this game has been added 
-            qs = Game.objects.filter(title__icontains=title, owned=False)
-            if qs:
+            if game is not None:
                 # test if user has added or voted today
                 if _can_act(request.user.username) == False:
-                    _log.debug("%s acted in the last day" % request.user)
+                    _log.debug("%s acted in the last day", request.user.username)
                     response = _raise_error(reason="You Can Only Vote/Add once a day")
                     return response
                 # insert since this title exists
                 # this is a vote
-                Vote.increment_count(title)
-                UserActivityLog.log_user_action( request.user, "voted", title )
-                return _say_thanks(request, "You Voted for %s" % title)
+                _record_vote(request, game)
+                return _say_thanks(request, "You Voted for %s" % game.title, game)
                 
             else:
-                # need a User
-                user_obj = User.objects.get(username=request.user)
                 # check this user's activity log
                 if _can_act(request.user) == False:
-                    _log.debug("%s acted today" % request.user)
+                    _log.debug("%s acted today", request.user.username)
                     return _raise_error(reason="You Can Only Vote/Add once a day")
                     
-                try:
-                    obj = Game.objects.create(title=title, user=user_obj)
-                except IntegrityError:
-                    _raise_error("%s exists" % title)
+                obj = Game(title=title, user=request.user)
                 try:
                     obj.full_clean()
                 except ValidationError as e:
                     return _raise_error(str(e))
-                obj.save()
+                try:
+                    with transaction.atomic():
+                        obj.save()
+                except IntegrityError:
+                    # someone added the same title (key) just now
+                    return _raise_error("%s exists" % title)
                 UserActivityLog.log_user_action( request.user, "added", obj.title )
+                pin_primary(request)
                 return _say_thanks(request, "%s has been saved" % title)
     else:
         form = GameAddForm()
@@ -276,3 +407,23 @@ def game_add(request):
         'form': form,
     })
     
+
+
+@login_required
+def rate_game(request, game_id):
+    """ logged in user gives a game one to five stars """
+    # if object does not exist, punt to 500 handler
+    game = Game.objects.get(pk=game_id)
+    if request.method == 'POST':
+        form = RatingForm(request.POST)
+        if form.is_valid():
+            Rating.rate(game, request.user, form.cleaned_data['stars'])
+            pin_primary(request)
+            return render(request, "games/thanks.html", {
+                "msg" : "You gave %s %d stars" % (game.title, form.cleaned_data['stars']) })
+    else:
+        form = RatingForm()
+    return render(request, 'games/rate.html', {
+        'form' : form,
+        'game' : game,
+    })
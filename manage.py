@@ -4,6 +4,8 @@ import sys
 
 if __name__ == "__main__":
     os.environ.setdefault("DJANGO_SETTINGS_MODULE", "nat.settings")
+    # south and shell_plus (nat/settings.py)
+    os.environ.setdefault("NAT_MANAGEMENT_APPS", "1")
 
     from django.core.management import execute_from_command_line
 
@@ -0,0 +1,6 @@
+""" the admin site, included lazily by nat.urls """
+from django.contrib import admin
+
+admin.autodiscover()
+
+urlpatterns = admin.site.get_urls()
@@ -0,0 +1,73 @@
+"""
+    Cached request.user
+
+    CachedAuthenticationMiddleware replaces django's
+    AuthenticationMiddleware: the user named by the session is read
+    from the cache, and from the database only on a miss.  With the
+    cached_db session engine a warm request resolves its identity
+    without a query.  Saving or deleting a user (deactivating them in
+    the admin, say) drops the cached copy.  Logging in writes it
+    through, and inactive users are treated as logged out.
+    That drop only reaches every worker through a shared cache: with a
+    per-process backend the user is read from the database every time.
+"""
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth.models import AnonymousUser, User
+from django.contrib.auth.signals import user_logged_in
+from django.core.cache import cache
+from django.db.models.signals import post_save, post_delete
+from django.utils.functional import SimpleLazyObject
+
+from games import versions
+
+
+def _key(user_id):
+    return 'nat.user.%s' % user_id
+
+
+def _timeout():
+    return getattr(settings, 'USER_CACHE_TIMEOUT', 300)
+
+
+def get_user(request):
+    ''' the session's user, from the cache when possible '''
+    try:
+        user_id = request.session[auth.SESSION_KEY]
+        backend_path = request.session[auth.BACKEND_SESSION_KEY]
+    except KeyError:
+        return AnonymousUser()
+    if backend_path not in settings.AUTHENTICATION_BACKENDS:
+        return AnonymousUser()
+    shared = versions.shared()
+    user = cache.get(_key(user_id)) if shared else None
+    if user is None:
+        user = auth.load_backend(backend_path).get_user(user_id)
+        if user is None:
+            return AnonymousUser()
+        if shared:
+            cache.set(_key(user_id), user, _timeout())
+    if not user.is_active:
+        return AnonymousUser()
+    user.backend = backend_path
+    return user
+
+
+class CachedAuthenticationMiddleware(object):
+    def process_request(self, request):
+        assert hasattr(request, 'session'), (
+            "CachedAuthenticationMiddleware needs SessionMiddleware before it")
+        request.user = SimpleLazyObject(lambda: get_user(request))
+
+
+def forget_user(sender, instance, **kwargs):
+    cache.delete(_key(instance.pk))
+
+def remember_user(sender, request, user, **kwargs):
+    # runs after update_last_login has saved (and so forgotten) the user
+    if versions.shared():
+        cache.set(_key(user.pk), user, _timeout())
+
+post_save.connect(forget_user, sender=User)
+post_delete.connect(forget_user, sender=User)
+user_logged_in.connect(remember_user)
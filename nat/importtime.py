@@ -0,0 +1,121 @@
+"""
+    Import time of a cold worker
+
+    python -m nat.importtime [path] (or manage.py trace_imports, which
+    runs it in a fresh interpreter) replaces __import__ with a timer,
+    loads settings.WSGI_APPLICATION the way a new gunicorn worker does,
+    then passes one GET for @path through it.  Every import that
+    loaded something new is reported with its cumulative time and its
+    self time (minus the imports it triggered) and the module that
+    asked for it, split into the two phases, as JSON on stdout.
+
+    Nothing here may import django before the hook is in place.
+"""
+import __builtin__
+import json
+import sys
+import time
+from StringIO import StringIO
+
+
+class Tracer(object):
+    def __init__(self):
+        self.original = __builtin__.__import__
+        self.phase = 'startup'
+        self.stack = []
+        self.modules = []
+
+    def install(self):
+        __builtin__.__import__ = self.hook
+
+    def uninstall(self):
+        __builtin__.__import__ = self.original
+
+    def names(self, name, globals, level):
+        ''' what an import statement may name, relative (python 2) first '''
+        if level == 0 or not globals or not globals.get('__name__'):
+            return [name]
+        package = globals.get('__package__') or (globals['__name__']
+            if '__path__' in globals else globals['__name__'].rpartition('.')[0])
+        for i in range(level - 1):
+            package = package.rpartition('.')[0]
+        if not package:
+            return [name]
+        relative = '%s.%s' % (package, name) if name else package
+        return [relative] if level > 0 else [relative, name]
+
+    def hook(self, name, globals=None, locals=None, fromlist=None, level=-1):
+        loaded = len(sys.modules)
+        names = self.names(name, globals, level)
+        absent = set('%s.%s' % (base, item) for base in names
+            for item in fromlist or () if '%s.%s' % (base, item) not in sys.modules)
+        self.stack.append(0.0)
+        started = time.time()
+        try:
+            return self.original(name, globals, locals, fromlist, level)
+        finally:
+            elapsed = time.time() - started
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+            if len(sys.modules) > loaded:
+                target = next((base for base in names
+                    if sys.modules.get(base) is not None), name)
+                # from package import submodule: name the submodule
+                for item in fromlist or ():
+                    sub = '%s.%s' % (target, item)
+                    if sub in absent and sys.modules.get(sub) is not None:
+                        target = sub
+                        break
+                self.modules.append({'module': target, 'phase': self.phase,
+                    'by': (globals or {}).get('__name__'),
+                    'cumulative': elapsed, 'self': elapsed - nested,
+                    'loaded': len(sys.modules) - loaded})
+
+
+def _environ(path):
+    return {
+        'REQUEST_METHOD': 'GET', 'PATH_INFO': path, 'QUERY_STRING': '',
+        'SERVER_NAME': 'localhost', 'SERVER_PORT': '80', 'HTTP_HOST': 'localhost',
+        'REMOTE_ADDR': '127.0.0.1', 'SCRIPT_NAME': '', 'SERVER_PROTOCOL': 'HTTP/1.1',
+        'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': StringIO(),
+        'wsgi.errors': sys.stderr, 'wsgi.multithread': False,
+        'wsgi.multiprocess': True, 'wsgi.run_once': False,
+    }
+
+
+def trace(path):
+    ''' report (a dict) for loading the application and serving @path '''
+    tracer = Tracer()
+    tracer.install()
+    started = time.time()
+    try:
+        from django.conf import settings
+        from django.utils.module_loading import import_by_path
+        application = import_by_path(settings.WSGI_APPLICATION)
+        ready = time.time()
+
+        tracer.phase = 'request'
+        status = []
+        response = application(_environ(path), lambda s, headers, exc_info=None: status.append(s))
+        for chunk in response:
+            pass
+        if hasattr(response, 'close'):
+            response.close()
+        done = time.time()
+    finally:
+        tracer.uninstall()
+    return {
+        'path': path,
+        'status': status[0] if status else None,
+        'startup_seconds': ready - started,
+        'request_seconds': done - ready,
+        'modules_loaded': len(sys.modules),
+        'imports': tracer.modules,
+    }
+
+
+if __name__ == '__main__':
+    report = trace(sys.argv[1] if len(sys.argv) > 1 else '/')
+    # the last line, whatever the application printed before it
+    sys.stdout.write('\n' + json.dumps(report) + '\n')
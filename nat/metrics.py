@@ -0,0 +1,211 @@
+"""
+    Per-view request metrics
+
+    MetricsMiddleware records, per resolved view: wall time, SQL query
+    count and SQL time (timed in a wrapper around each connection's
+    cursor), template render time and response size.  Observations go
+    into in-process histograms served at /metrics in the Prometheus
+    text format.  Each gunicorn worker keeps its own histograms, so
+    scrape every worker or sum them at the collector.
+
+    settings.METRICS_ENABLED = False takes the middleware out entirely.
+    /metrics answers METRICS_ALLOWED_IPS and bearer tokens from
+    METRICS_TOKENS only: view names and timings map the site for anyone.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.http import Http404, HttpResponse
+from django.utils.crypto import constant_time_compare
+from django.template.base import Template
+
+SECONDS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERIES = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+BYTES = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+_local = threading.local()
+
+
+class Histogram(object):
+    ''' cumulative-bucket histogram, one series per view '''
+    def __init__(self, name, help, buckets):
+        self.name, self.help, self.buckets = name, help, buckets
+        self.series = {}
+        self.lock = threading.Lock()
+
+    def observe(self, view, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(view)
+            if series is None:
+                series = self.series[view] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def exposition(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s histogram' % self.name]
+        with self.lock:
+            series = sorted((view, list(counts), total)
+                for view, (counts, total) in self.series.items())
+        for view, counts, total in series:
+            label = 'view="%s"' % view.replace('\\', '\\\\').replace('"', '\\"')
+            running = 0
+            for bound, n in zip(self.buckets, counts):
+                running += n
+                lines.append('%s_bucket{%s,le="%s"} %d' % (self.name, label, bound, running))
+            running += counts[-1]
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (self.name, label, running))
+            lines.append('%s_sum{%s} %r' % (self.name, label, total))
+            lines.append('%s_count{%s} %d' % (self.name, label, running))
+        return lines
+
+
+REQUEST_SECONDS = Histogram('nat_request_seconds', 'Wall time per request.', SECONDS)
+SQL_QUERIES = Histogram('nat_sql_queries', 'SQL statements per request.', QUERIES)
+SQL_SECONDS = Histogram('nat_sql_seconds', 'Time in SQL per request.', SECONDS)
+TEMPLATE_SECONDS = Histogram('nat_template_seconds', 'Template render time per request.', SECONDS)
+RESPONSE_BYTES = Histogram('nat_response_bytes', 'Response body size.', BYTES)
+
+HISTOGRAMS = (REQUEST_SECONDS, SQL_QUERIES, SQL_SECONDS, TEMPLATE_SECONDS, RESPONSE_BYTES)
+
+
+class RequestStats(object):
+    __slots__ = ('started', 'queries', 'sql', 'template', 'depth')
+
+    def __init__(self):
+        self.started = time.time()
+        self.queries = 0
+        self.sql = self.template = 0.0
+        self.depth = 0
+
+
+class TimedCursor(object):
+    ''' wraps whatever cursor the connection made (debug or not) '''
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def _timed(self, method, *args):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return method(*args)
+        started = time.time()
+        try:
+            return method(*args)
+        finally:
+            stats.sql += time.time() - started
+            stats.queries += 1
+
+    def execute(self, sql, params=None):
+        return self._timed(self.cursor.execute, sql, params)
+
+    def executemany(self, sql, param_list):
+        return self._timed(self.cursor.executemany, sql, param_list)
+
+
+def _wrap_cursors():
+    ''' connections are per thread: wrap this thread's once '''
+    for conn in connections.all():
+        if getattr(conn, '_metrics_cursor', False):
+            continue
+        make = conn.cursor
+        conn.cursor = lambda make=make: TimedCursor(make())
+        conn._metrics_cursor = True
+
+
+_patched = []
+
+def _wrap_templates():
+    ''' time the outermost Template.render; includes and extends nest inside it '''
+    if _patched:
+        return
+    render = Template.render
+
+    def timed_render(self, context):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return render(self, context)
+        stats.depth += 1
+        started = time.time()
+        try:
+            return render(self, context)
+        finally:
+            stats.depth -= 1
+            if not stats.depth:
+                stats.template += time.time() - started
+
+    Template.render = timed_render
+    _patched.append(render)
+
+
+def view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return 'unresolved'
+    func = match.func
+    return '%s.%s' % (func.__module__, getattr(func, '__name__', func.__class__.__name__))
+
+
+def _counted(content, view):
+    size = 0
+    for chunk in content:
+        size += len(chunk)
+        yield chunk
+    RESPONSE_BYTES.observe(view, size)
+
+
+class MetricsMiddleware(object):
+    ''' keep first in MIDDLEWARE_CLASSES so it times the other middleware too '''
+    def __init__(self):
+        if not getattr(settings, 'METRICS_ENABLED', True):
+            raise MiddlewareNotUsed
+        _wrap_templates()
+
+    def process_request(self, request):
+        _wrap_cursors()
+        _local.stats = RequestStats()
+
+    def process_response(self, request, response):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return response
+        _local.stats = None
+        view = view_name(request)
+        REQUEST_SECONDS.observe(view, time.time() - stats.started)
+        SQL_QUERIES.observe(view, stats.queries)
+        SQL_SECONDS.observe(view, stats.sql)
+        TEMPLATE_SECONDS.observe(view, stats.template)
+        if response.streaming:
+            # size is known once the body has been sent
+            response.streaming_content = _counted(response.streaming_content, view)
+        else:
+            RESPONSE_BYTES.observe(view, len(response.content))
+        return response
+
+
+def _allowed(request):
+    ''' scraper from METRICS_ALLOWED_IPS, or with a METRICS_TOKENS bearer token '''
+    if request.META.get('REMOTE_ADDR') in getattr(settings, 'METRICS_ALLOWED_IPS', ()):
+        return True
+    scheme, _, key = request.META.get('HTTP_AUTHORIZATION', '').partition(' ')
+    return scheme.lower() in ('bearer', 'token') and bool(key) and any(
+        constant_time_compare(key, token) for token in getattr(settings, 'METRICS_TOKENS', ()))
+
+
+def metrics(request):
+    ''' Prometheus text exposition of this process' histograms '''
+    if not _allowed(request):
+        raise Http404
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.exposition())
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4')
@@ -0,0 +1,72 @@
+"""
+    Read replicas
+
+    views wrapped in @replica_reads run their queries against one of
+    settings.REPLICA_DATABASES; everything else, and every write, uses
+    'default'.  A user who has just voted is pinned to 'default' for
+    REPLICA_PIN_SECONDS (pin_primary), so they see their own vote while
+    the replicas catch up.
+"""
+import random
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+
+PIN_KEY = '_pin_primary_until'
+
+_local = threading.local()
+
+
+def replicas():
+    return getattr(settings, 'REPLICA_DATABASES', [])
+
+
+def reading_replica():
+    ''' alias this thread is reading from, None for the primary '''
+    return getattr(_local, 'replica', None)
+
+
+class ReplicaRouter(object):
+    def db_for_read(self, model, **hints):
+        return reading_replica()
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same rows as the primary
+        return True
+
+    def allow_syncdb(self, db, model):
+        return db not in replicas()
+
+
+def pin_primary(request):
+    ''' read @request's session from the primary for a while '''
+    if hasattr(request, 'session'):
+        request.session[PIN_KEY] = time.time() + getattr(settings, 'REPLICA_PIN_SECONDS', 10)
+
+
+def pinned(request):
+    return hasattr(request, 'session') and request.session.get(PIN_KEY, 0) > time.time()
+
+
+def replica_reads(view):
+    ''' run @view, and render its response, against a replica '''
+    @wraps(view)
+    def wrapped(request, *args, **kwargs):
+        aliases = replicas()
+        if not aliases or pinned(request):
+            return view(request, *args, **kwargs)
+        _local.replica = random.choice(aliases)
+        try:
+            response = view(request, *args, **kwargs)
+            if getattr(response, 'is_rendered', True) is False:
+                # TemplateResponse: its querysets run while rendering
+                response.render()
+            return response
+        finally:
+            _local.replica = None
+    return wrapped
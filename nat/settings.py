@@ -23,7 +23,28 @@ DATABASES = {
     }
 }
 if 'test' in sys.argv:
-    DATABASES['default'] = {'ENGINE': 'django.db.backends.sqlite3'}
+    # two SQLite files stand in for a primary and its replica
+    import tempfile
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(tempfile.gettempdir(), 'nat_primary.sqlite3'),
+            'TEST_NAME': os.path.join(tempfile.gettempdir(), 'test_nat_primary.sqlite3'),
+        },
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(tempfile.gettempdir(), 'nat_replica.sqlite3'),
+            'TEST_MIRROR': 'default',
+        },
+    }
+
+# read views (nat.routers.replica_reads) use these DATABASES aliases;
+# a session that just voted reads from 'default' for REPLICA_PIN_SECONDS.
+# Empty in tests too: TestCase rows are uncommitted, so a second
+# connection cannot see them (ReplicaRouterTests turns it on)
+DATABASE_ROUTERS = ['nat.routers.ReplicaRouter']
+REPLICA_DATABASES = []
+REPLICA_PIN_SECONDS = 10
 
 SITE_ROOT = os.path.abspath(os.path.dirname(__file__))
 
@@ -106,10 +127,11 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'nat.metrics.MetricsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
-    'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'nat.auth.CachedAuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
@@ -138,13 +160,137 @@ INSTALLED_APPS = (
     # Uncomment the next line to enable admin documentation:
     # 'django.contrib.admindocs',
     'games',
-    'south',
-    'shell_plus',
 )
 
+# migrations and shell_plus are only used by management commands, so web
+# workers do not load them: manage.py sets NAT_MANAGEMENT_APPS=1 (set it
+# yourself when running django-admin)
+if os.environ.get('NAT_MANAGEMENT_APPS') == '1':
+    INSTALLED_APPS += ('south', 'shell_plus')
+
+# one cache shared by every process: version stamps (games.versions),
+# cached pages, choices and users are only invalidated everywhere if a
+# bump made in one worker or manage.py command is seen by all of them.
+# Memcached when MEMCACHED_LOCATION (host:port[,host:port]) is set,
+# otherwise files under CACHE_DIR, which is enough for a single host
+CACHE_DIR = os.environ.get('CACHE_DIR', os.path.join(SITE_ROOT, 'cache'))
+if 'test' in sys.argv and 'CACHE_DIR' not in os.environ:
+    CACHE_DIR = os.path.join(tempfile.gettempdir(), 'nat_test_cache')
+if os.environ.get('MEMCACHED_LOCATION'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': os.environ['MEMCACHED_LOCATION'].split(','),
+        },
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': CACHE_DIR,
+            'OPTIONS': {'MAX_ENTRIES': 20000},
+        },
+    }
+
+# sessions and request.user come from the cache, the database only on
+# a miss (nat.auth); a user saved in one worker is dropped from the
+# shared cache, so every worker sees the change
+SESSION_ENGINE = 'django.contrib.sessions.backends.cached_db'
+USER_CACHE_TIMEOUT = 300
+
+# per-view request histograms served at /metrics (nat.metrics), only to
+# METRICS_ALLOWED_IPS (REMOTE_ADDR, so put the proxy's address here only if
+# it is the scraper) or to scrapers sending "Authorization: Bearer <key>"
+# with a key from METRICS_TOKENS; anyone else gets a 404
+METRICS_ENABLED = True
+METRICS_ALLOWED_IPS = [ip for ip in os.environ.get(
+    'METRICS_ALLOWED_IPS', '127.0.0.1,::1').split(',') if ip]
+METRICS_TOKENS = [token for token in os.environ.get('METRICS_TOKENS', '').split(',') if token]
+
+# resized variants made for each Game.image (max width, max height),
+# JPEG quality, and the processes making them (0 = in the request)
+THUMBNAIL_SIZES = {
+    'small': (120, 90),
+    'medium': (300, 225),
+    'large': (600, 450),
+}
+THUMBNAIL_QUALITY = 85
+THUMBNAIL_WORKERS = 0 if 'test' in sys.argv else 2
+
+# games shown on the vote_index / top_votes leaderboards
+LEADERBOARD_SIZE = 50
+
+# game_add treats a title at least this similar (0..1, trigram overlap)
+# to an existing one as the same game; 'auto' matches in PostgreSQL when
+# the pg_trgm extension is installed, otherwise in memory
+FUZZY_MATCH_THRESHOLD = 0.6
+FUZZY_BACKEND = 'auto'
+
+# seconds a rendered vote dropdown stays cached (it is also replaced
+# whenever a game is added, edited or deleted)
+VOTE_CHOICES_CACHE_TIMEOUT = 3600
+
+# seconds a games page section's rows stay cached; sections are also
+# keyed on data versions, so votes and catalog edits show at once
+FRAGMENT_CACHE_TIMEOUT = 600
+
+# rows per page on the vote history pages
+ACTIVITY_PAGE_SIZE = 50
+
+# most votes accepted by one /games/vote/batch/ request
+VOTE_BATCH_SIZE = 500
+
+# API keys for /games/vote/batch/ clients that are not a browser session:
+# they send "Authorization: Token <key>" and need no CSRF token
+VOTE_BATCH_TOKENS = [token for token in os.environ.get('VOTE_BATCH_TOKENS', '').split(',') if token]
+
+# rows per game that Vote.increment_count spreads its updates over,
+# and how long (seconds) a summed Vote.count is cached
+VOTE_COUNTER_SHARDS = 8
+VOTE_COUNT_CACHE_TIMEOUT = 60
+
+# 'sync' writes each vote before responding, 'buffered' appends it to the
+# local queue at VOTE_QUEUE_PATH and a background thread applies up to
+# VOTE_QUEUE_FLUSH_SIZE votes per transaction every VOTE_QUEUE_FLUSH_INTERVAL
+# seconds (0 disables the thread; run manage.py flush_votes instead)
+VOTE_INGEST = 'sync'
+VOTE_QUEUE_PATH = os.path.join(SITE_ROOT, 'vote_queue.sqlite3')
+VOTE_QUEUE_FLUSH_SIZE = 200
+VOTE_QUEUE_FLUSH_INTERVAL = 2.0
+
+# votes append pending deltas that games.tally folds into the leaderboard and
+# the hourly/daily rollups every VOTE_FOLD_INTERVAL seconds, so concurrent
+# votes never wait on one game's rows (0 folds as each vote is logged)
+VOTE_FOLD_INTERVAL = 0 if 'test' in sys.argv else 1.0
+
+# each user's last vote/add time, shared by all workers on the host
+ELIGIBILITY_STORE_PATH = os.path.join(SITE_ROOT, 'eligibility.sqlite3')
+if 'test' in sys.argv:
+    ELIGIBILITY_STORE_PATH = ':memory:'
+
+# /games/live/ streams, off unless LIVE_LEADERBOARD: an open stream holds its
+# request for as long as the page stays open, so it is refused on sync workers
+# (wsgi.multithread false); serve it from a threaded or gevent pool and point
+# LIVE_STREAM_URL at that pool's route (README, LIVE LEADERBOARD).
+# Votes are announced to every worker on the host through LIVE_BROKER_PATH,
+# which each worker checks every LIVE_POLL_INTERVAL seconds (0 disables the
+# thread); idle streams get a comment every LIVE_HEARTBEAT seconds
+LIVE_LEADERBOARD = os.environ.get('LIVE_LEADERBOARD') == '1'
+LIVE_STREAM_URL = os.environ.get('LIVE_STREAM_URL', '/games/live/')
+LIVE_BROKER_PATH = os.path.join(SITE_ROOT, 'live.sqlite3')
+LIVE_POLL_INTERVAL = 0.5
+LIVE_HEARTBEAT = 15
+if 'test' in sys.argv:
+    LIVE_BROKER_PATH = ':memory:'
+    LIVE_POLL_INTERVAL = 0
+
 # See http://docs.djangoproject.com/en/dev/topics/logging for
 # more details on how to customize your logging configuration.
 
+# 'queued' never blocks a request on the log file; 'logfile' writes
+# each record before returning
+LOG_HANDLER = 'queued'
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': True,
@@ -154,6 +300,13 @@ LOGGING = {
             'datefmt' : "%d/%b/%Y %H:%M:%S"
         },
     },
+    'filters': {
+        # fraction of DEBUG/INFO records kept, by logger name prefix
+        'sample': {
+            '()': 'games.logqueue.SampleFilter',
+            'rates': {'': 1.0},
+        },
+    },
     'handlers': {
         'null': {
             'level':'DEBUG',
@@ -167,6 +320,16 @@ LOGGING = {
             'backupCount': 2,
             'formatter': 'standard',
         },
+        # same file, written in batches by a background thread
+        'queued': {
+            'level': 'DEBUG',
+            '()': 'games.logqueue.QueueHandler',
+            'filename': SITE_ROOT + "/logfile",
+            'maxBytes': 5000000,
+            'backupCount': 2,
+            'formatter': 'standard',
+            'filters': ['sample'],
+        },
         'console':{
             'level':'DEBUG',
             'class':'logging.StreamHandler',
@@ -175,17 +338,17 @@ LOGGING = {
     },
     'loggers': {
         'django': {
-            'handlers':['logfile'],
+            'handlers':[LOG_HANDLER],
             'propagate': True,
             'level':'DEBUG',
         },
         'django.db.backends': {
-            'handlers': ['logfile'],
+            'handlers': [LOG_HANDLER],
             'level': 'ERROR',
             'propagate': False,
         },
         'games': {
-            'handlers': ['logfile'],
+            'handlers': [LOG_HANDLER],
             'level': 'DEBUG',
         },
     }
@@ -1,19 +1,14 @@
 from django.conf.urls import patterns, include, url
 
-from games import urls
-# Uncomment the next two lines to enable the admin:
-from django.contrib import admin
-admin.autodiscover()
-
-from nat.views import Login, Logout
-from games.views import main
-#from games import admin
-
+# views are named by path, and the admin's urls (and admin.autodiscover)
+# load on the first /admin/ request, so a new worker only imports what
+# its first request needs.  include() would import nat.admin_urls now;
+# the (module name, app name, namespace) tuple leaves it to the resolver
 urlpatterns = patterns('',
-    url(r'^login/', Login.as_view(), name='login-view'),
-    url(r'^logout/', Logout.as_view(), name='logout-view'),
-    # Uncomment the next line to enable the admin:
-    url(r'^admin/', include(admin.site.urls)),
+    url(r'^login/', 'nat.views.login_view', name='login-view'),
+    url(r'^logout/', 'nat.views.logout_view', name='logout-view'),
+    url(r'^admin/', ('nat.admin_urls', 'admin', 'admin')),
     url(r'^games/', include('games.urls')),
-    url(r'^$', main),
+    url(r'^metrics$', 'nat.metrics.metrics'),
+    url(r'^$', 'games.views.main'),
 )
@@ -35,3 +35,5 @@ class Logout(View):
         return HttpResponseRedirect(settings.LOGOUT_REDIRECT_URL)
 
 
+login_view = Login.as_view()
+logout_view = Logout.as_view()